@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Runs several Interface operations within a single request to the batch endpoint
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from api.backend.interfaces import Interface
+from api.backend.schemas import OPERATION_ARGS
+from base.backend import db_router
+from base.backend.request_parser import validate
+
+lgr = logging.getLogger(__name__)
+
+# operation name => (whether it only reads, the call of the Interface method with the args of the operation)
+OPERATIONS = {
+	'risk_types': (True, lambda interface, args: interface.risk_types(args)),
+	'customers': (True, lambda interface, args: interface.get_customers(args)),
+	'customer_portfolio': (True, lambda interface, args: interface.get_customer_portfolio(args.get('id'))),
+	'get_risk_type': (True, lambda interface, args: interface.get_risk_type(args.get('id'))),
+	'get_risk_types': (True, lambda interface, args: interface.get_risk_types(args.get('ids'))),
+	'add_risk_type': (
+		False, lambda interface, args: interface.add_risk_type(args.get('name'), args.get('description'))),
+	'add_risk_type_fields': (
+		False, lambda interface, args: interface.add_risk_type_fields(args.get('id'), args.get('fields'))),
+	'register_customer': (False, lambda interface, args: interface.register_customer(
+		args.get('first_name'), args.get('last_name'), args.get('phone_number'), args.get('date_of_birth'),
+		args.get('gender'), args.get('salutation'), args.get('email'))),
+	'search_risks': (True, lambda interface, args: interface.search_risks(
+		args.get('risk_type_id'), args.get('where'), args.get('cursor'), args.get('limit'))),
+	'submit_risk': (False, lambda interface, args: interface.submit_risk(
+		args.get('customer_id'), args.get('risk_type_id'), args.get('values'))),
+}
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def executor():
+	"""
+	Retrieves the thread pool of the current process, the pool of a parent process being of no use after a fork.
+	@return: The thread pool running the concurrent read operations.
+	@rtype: ThreadPoolExecutor
+	"""
+	global _executor, _executor_pid
+	with _executor_lock:
+		if _executor is None or _executor_pid != os.getpid():
+			_executor = ThreadPoolExecutor(max_workers = getattr(settings, 'BATCH', {}).get('MAX_WORKERS', 4))
+			_executor_pid = os.getpid()
+		return _executor
+
+
+def run_operation(operation):
+	"""
+	Runs a single operation of a batch.
+	@param operation: The operation, e.g. {'op': 'get_risk_type', 'args': {'id': '...'}}
+	@type operation: dict
+	@return: The response of the Interface method.
+	@rtype: dict
+	"""
+	try:
+		read_only, call = OPERATIONS[operation.get('op')]
+		args = dict(operation.get('args') or {})
+		if operation.get('op') in OPERATION_ARGS:
+			errors = validate(args, OPERATION_ARGS[operation.get('op')])
+			if errors:
+				return Interface.response('Invalid request', data = {'errors': errors})
+		return call(Interface(), args)
+	except Exception as e:
+		lgr.exception('batch operation exception: %s', e)
+	return Interface.response('Batch operation Exception')
+
+
+def run_in_thread(operation, pinned):
+	"""
+	Runs a read operation on a pool thread, reading from the primary database if the request does.
+	The thread's connections are closed afterwards as nothing else closes them once the request is over.
+	"""
+	db_router.reset(pinned = pinned)
+	try:
+		return run_operation(operation)
+	finally:
+		connections.close_all()
+
+
+def run_batch(operations, atomic = False, parallel = False):
+	"""
+	Runs a batch of operations in order and collects their responses.
+	@param operations: The operations, each holding the name of the op and its args.
+	@type operations: list
+	@param atomic: Whether to run all the operations in one transaction, rolled back if any of them fails.
+	@type atomic: bool
+	@param parallel: Whether to run the operations concurrently. Only honoured if they all just read.
+	@type parallel: bool
+	@return: response containing a status, message and the response of each operation in the order of the operations
+	@rtype: dict
+	"""
+	try:
+		if not isinstance(operations, list) or not operations:
+			return Interface.response('Operations must be provided')
+		if len(operations) > getattr(settings, 'BATCH', {}).get('MAX_OPERATIONS', 20):
+			return Interface.response('Too many operations in the batch')
+		unknown = [
+			index for index, operation in enumerate(operations)
+			if not isinstance(operation, dict) or operation.get('op') not in OPERATIONS]
+		if unknown:
+			return Interface.response('Unknown operations at %s' % ', '.join(str(index) for index in unknown))
+
+		if atomic:
+			with transaction.atomic():
+				results = [run_operation(operation) for operation in operations]
+				failed = [index for index, result in enumerate(results) if result.get('status') != 'success']
+				if failed:
+					transaction.set_rollback(True)
+					return Interface.response(
+						'Batch rolled back, operations at %s failed' % ', '.join(str(index) for index in failed),
+						data = results)
+			return Interface.response('Batch processed successfully', 'success', results)
+
+		if parallel and len(operations) > 1 and all(OPERATIONS[operation['op']][0] for operation in operations):
+			pinned = db_router.is_pinned()
+			results = list(executor().map(lambda operation: run_in_thread(operation, pinned), operations))
+		else:
+			results = [run_operation(operation) for operation in operations]
+		return Interface.response('Batch processed successfully', 'success', results)
+	except Exception as e:
+		lgr.exception('run_batch exception: %s', e)
+	return Interface.response('Batch Exception')
@@ -9,6 +9,9 @@ from django.http import JsonResponse
 from django.utils.decorators import available_attrs
 from django.utils.six import wraps
 
+from api.backend.interfaces import Interface
+from base.backend.request_parser import RequestError, parse_request
+
 lgr = logging.getLogger(__name__)
 
 
@@ -38,3 +41,27 @@ def enable_spa(fn):
 			req += 1
 
 	return wraps(fn, assigned = available_attrs(fn))(json_wrap)
+
+
+def validate_request(schema, max_size = None):
+	"""
+	Parses the body of the request to a view method once and validates it against the schema of the endpoint.
+	The validated data is passed to the method after the request, e.g. def post(self, request, data). An invalid
+	request gets the standard failed response with the error of each field, without reaching the method.
+	@param schema: The schema of the endpoint, see base.backend.request_parser.validate
+	@type schema: dict
+	@param max_size: The maximum number of bytes of the body. Defaults to REQUEST_PARSER MAX_BODY_SIZE.
+	@type max_size: int | None
+	"""
+
+	def decorator(fn):
+		def wrapped(view, request, *args, **kwargs):
+			try:
+				data = parse_request(request, schema, max_size)
+			except RequestError as e:
+				return JsonResponse(Interface.response(e.message, data = {'errors': e.errors}), status = e.status)
+			return fn(view, request, data, *args, **kwargs)
+
+		return wraps(fn, assigned = available_attrs(fn))(wrapped)
+
+	return decorator
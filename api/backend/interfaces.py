@@ -2,24 +2,54 @@
 """
 defines the interfaces that the user will call
 """
+import itertools
 import logging
+from collections import OrderedDict
+from datetime import datetime, time, timedelta
+from operator import itemgetter
 
+from django.conf import settings
 from django.db import transaction
 from django.db.models import Q, F, Value
 from django.db.models.functions import Concat
+from django.utils import timezone
 
-from base.backend.services import StateService
-from core.backend.services import RiskTypeService, RiskFieldService, CustomerService
+from base.backend.db_pool import pool_stats
+from base.backend.db_router import use_primary
+from base.backend.pagination import ORDERING, keyset_page, sort_ordering, sorted_page
+from base.backend.query_cache import query_cache
+from base.backend.single_flight import coalesce
+from base.backend.state_registry import state_registry
+from core.backend.catalog import catalog_snapshot
+from core.backend.form_cache import FORM_FIELDS, FORM_FIELDS_ORDER, build_forms, form_cache, form_digest
+from core.backend.services import (
+	RiskTypeService, RiskFieldService, CustomerService, RiskService, RiskDataService)
+from core.backend.projections import BASE_COLUMNS, wide_tables
+from core.backend.risk_query import answer, display_value, filter_risks, to_date, typed_columns
+from core.backend.validators import form_validators
 
 lgr = logging.getLogger(__name__)
 
+COLUMNAR_MEDIA_TYPE = 'application/vnd.columnar+json'
+
 
 class Interface(object):
 	"""
 	class containing the methods that will retrieve, add and manipulate data in the system
 	"""
+	# the fields the listings can return, narrowed down by their fields parameter
+	RISK_TYPE_FIELDS = ('name', 'description', 'state__name', 'id', 'has_form', 'date_created', 'form_digest')
+	# the form_digest needs the form of each RiskType, which is only built for the RiskTypes of a page
+	STREAMED_RISK_TYPE_FIELDS = tuple(field for field in RISK_TYPE_FIELDS if field != 'form_digest')
+	CUSTOMER_FIELDS = (
+		'name', 'phone_number', 'gender', 'date_of_birth', 'state__name', 'id', 'email', 'date_created', 'risk_count',
+		'risk_type_count', 'risk_types', 'last_risk_date', 'last_activity')
+	# the fields of the Customers read off their CustomerSummary, and the ones the Customers can be sorted on
+	CUSTOMER_SUMMARY_FIELDS = ('risk_count', 'risk_type_count', 'risk_types', 'last_risk_date', 'last_activity')
+	CUSTOMER_SORTS = ('risk_count', 'last_risk_date', 'last_activity')
+
 	@staticmethod
-	def response(message, status = 'failed', data = None):
+	def response(message, status = 'failed', data = None, **extra):
 		"""
 		Returns a standard response to the user after processing the request made
 		:param message: the message returned after processing
@@ -28,18 +58,34 @@ class Interface(object):
 		:type status: str
 		:param data: data returned after processing
 		:type data: any | None
+		:param extra: any other keys of the response, e.g. the next_cursor of a paginated list
 		:return: a dictionary containing the status, message and data after processing
 		:rtype: dict
 		"""
-		return {'status': status.lower(), 'message': message, 'data': data}
+		response = {'status': status.lower(), 'message': message, 'data': data}
+		response.update(extra)
+		return response
 
-	# @staticmethod
+	@staticmethod
+	def page_params(request):
+		"""
+		Reads the pagination parameters of a list request
+		:param request: the request, or a dictionary of its parameters
+		:type request: WSGIRequest | dict
+		:return: the cursor and the limit requested
+		:rtype: tuple
+		"""
+		params = getattr(request, 'GET', request) or {}
+		return params.get('cursor') or None, params.get('limit')
+
+	# concurrent renders of the same form wait for a single lookup instead of all querying the db
+	@coalesce(key = lambda self, risk_type_id: 'get_risk_type:%s' % risk_type_id)
 	def get_risk_type(self, risk_type_id):
 		"""
 		retrieves the RiskType object matching the provided id and it's declared fields
 		:param risk_type_id: the unique identifier for the RiskType we are interested in or RiskType Name
 		:type risk_type_id: str
-		:return: response containing a status, message and data returned after processing
+		:return: response containing a status, message, data and the digest of the form returned after processing
 		:rtype: dict
 		"""
 		try:
@@ -47,73 +93,367 @@ class Interface(object):
 			if not risk_type_id:
 				return self.response('RiskType must be selected')
 
-			# now that we have the id, lets call the risk_type matching that id,
-			# note that the user might pass the name instead of the id, so we have to factor that in
-			# lastly, we have to use filter instead of get since we might have different RiskTypes
-			#  bearing the same name and we need the most recent. get() throws an exception if it encounters more than one result
-			risk_type = RiskTypeService().filter(Q(id = risk_type_id) | Q(name = risk_type_id)).order_by(
-				'-date_created').first()
-			if not risk_type:
-				return self.response('selected RiskType does not exist')
+			# the key is taken before reading so that a write committed meanwhile cannot be cached as current
+			cache_key = form_cache.make_key(risk_type_id)
+			form = form_cache.get(cache_key)
+			if form is not None:
+				return self.response('RiskType retrieved successfully', 'success', form[0], digest = form[1])
 
-			# now we need to retrieve the fields declared for this RiskType
-			risk_fields = list(RiskFieldService().filter(
-				risk_type = risk_type, state__name = 'Active').order_by('order').values(
-				'caption', 'field_type', 'order', 'min_length', 'max_length', 'decimal_places', 'nullable',
-				'default_value', 'id'))
-			if risk_fields is None:
-				return self.response('RiskFields encountered an exception while retrieving values')
+			# the forms are served from the catalog snapshot shared by the workers whenever it is up to date
+			data = catalog_snapshot.form(risk_type_id)
+			if data is None:
+				# now that we have the id, lets call the risk_type matching that id,
+				# note that the user might pass the name instead of the id, so we have to factor that in
+				# lastly, we have to use filter instead of get since we might have different RiskTypes
+				#  bearing the same name and we need the most recent. get() throws an exception if it encounters more than one result
+				risk_type = RiskTypeService().filter(
+					Q(id = risk_type_id) | Q(name = risk_type_id), profile = 'form').order_by('-date_created').first()
+				if not risk_type:
+					return self.response('selected RiskType does not exist')
 
-			# now that we have both the RiskType and the fields, lets return the data to the user to render the form
-			data = {
-				'risk_type': {'name': risk_type.name, 'id': risk_type.id},
-				'risk_fields': risk_fields
-			}
-			return self.response('RiskType retrieved successfully', 'success', data)
+				# now we need to retrieve the fields declared for this RiskType
+				risk_fields = list(RiskFieldService().filter(
+					risk_type = risk_type, state_id__in = state_registry.ids('Active')).order_by(
+					*FORM_FIELDS_ORDER).values(*FORM_FIELDS))
+				if risk_fields is None:
+					return self.response('RiskFields encountered an exception while retrieving values')
+
+				# now that we have both the RiskType and the fields, lets return the data to the user to render the form
+				data = {
+					'risk_type': {'name': risk_type.name, 'id': risk_type.id},
+					'risk_fields': risk_fields
+				}
+			data, digest = form_cache.set(cache_key, data)
+			return self.response('RiskType retrieved successfully', 'success', data, digest = digest)
 		except Exception as e:
 			lgr.exception('get_risk_type exception: %s', e)
 		return self.response('get_risk_type Exception')
 
+	def get_risk_types(self, risk_type_ids):
+		"""
+		retrieves the forms of several RiskTypes at once, with the same number of queries however many are requested
+		:param risk_type_ids: the ids or names of the RiskTypes we are interested in
+		:type risk_type_ids: list
+		:return: response containing a status, message and the forms keyed by RiskType id, with the digest of each form
+		and the ids or names that did not match any RiskType
+		:rtype: dict
+		"""
+		try:
+			risk_type_ids = list(OrderedDict.fromkeys(str(i) for i in risk_type_ids or [] if i))
+			if not risk_type_ids:
+				return self.response('RiskTypes must be selected')
+			if len(risk_type_ids) > getattr(settings, 'PAGINATION', {}).get('MAX_LIMIT', 1000):
+				return self.response('Too many RiskTypes selected')
+
+			# the snapshot serves each form without a query, the rest are resolved from the db in one go
+			forms, missing = {}, []
+			for risk_type_id in risk_type_ids:
+				form = catalog_snapshot.form(risk_type_id)
+				if form is not None:
+					forms[form['risk_type']['id']] = form
+				else:
+					missing.append(risk_type_id)
+			if missing:
+				# one query for all the ids and names, ordered so that the most recent RiskType keeps a shared name
+				by_key = {}
+				for risk_type in RiskTypeService().filter(
+						Q(id__in = missing) | Q(name__in = missing)).order_by('date_created').values('id', 'name'):
+					by_key[risk_type['id']] = by_key[risk_type['name']] = risk_type
+				matched = OrderedDict((by_key[i]['id'], by_key[i]) for i in missing if i in by_key)
+				# and one query for the active RiskFields of all of them
+				forms.update(build_forms(list(matched.values())))
+				missing = [i for i in missing if i not in by_key]
+			digests = dict((risk_type_id, form_digest(form)) for risk_type_id, form in forms.items())
+			return self.response(
+				'RiskTypes retrieved successfully', 'success', forms, digests = digests, missing = missing)
+		except Exception as e:
+			lgr.exception('get_risk_types exception: %s', e)
+		return self.response('get_risk_types Exception')
+
+	@staticmethod
+	def sparse_fields(request, allowed):
+		"""
+		Reads the fields a list request asks for, e.g. ?fields=id,name for a dropdown
+		:param request: the request, or a dictionary of its parameters
+		:type request: WSGIRequest | dict
+		:param allowed: the fields the endpoint can return, all of them being returned if none are asked for
+		:type allowed: tuple
+		:return: the fields to return
+		:rtype: tuple
+		:raise ValueError: if a field is not one of the allowed fields
+		"""
+		params = getattr(request, 'GET', request) or {}
+		fields = params.get('fields')
+		if not fields:
+			return allowed
+		if not isinstance(fields, (list, tuple)):
+			fields = fields.split(',')
+		fields = tuple(field.strip() for field in fields if field.strip())
+		unknown = [field for field in fields if field not in allowed]
+		if unknown or not fields:
+			raise ValueError('Unknown fields: %s, choose from %s' % (', '.join(unknown), ', '.join(allowed)))
+		return fields
+
+	@staticmethod
+	def wants_columnar(request):
+		"""
+		Checks whether a list request negotiated the columnar format, i.e. {columns: [...], rows: [[...], ...]},
+		through ?format=columnar or an Accept header of application/vnd.columnar+json
+		:param request: the request, or a dictionary of its parameters
+		:type request: WSGIRequest | dict
+		:rtype: bool
+		"""
+		params = getattr(request, 'GET', request) or {}
+		accept = getattr(request, 'META', {}).get('HTTP_ACCEPT', '')
+		return params.get('format') == 'columnar' or COLUMNAR_MEDIA_TYPE in accept
+
+	@staticmethod
+	def listing_columns(fields, computed):
+		"""
+		Maps the fields of a listing to the columns to select, always including the id and date_created to page by
+		"""
+		columns = [field for field in fields if field not in computed and field != 'state__name']
+		if 'state__name' in fields:
+			columns.append('state_id')
+		return tuple(OrderedDict.fromkeys(columns + ['id', 'date_created']))
+
+	@staticmethod
+	def row_getters(columns, fields, computed = None):
+		"""
+		Builds the callables reading each requested field out of a values_list() row
+		:param columns: the columns of the rows
+		:type columns: tuple
+		:param fields: the fields requested
+		:type fields: tuple
+		:param computed: callables computing the fields that are not columns, keyed by field
+		:type computed: dict | None
+		:return: a callable per field, in the order of the fields
+		:rtype: list
+		"""
+		index = dict((column, position) for position, column in enumerate(columns))
+		getters = []
+		for field in fields:
+			if computed and field in computed:
+				getters.append(computed[field])
+			elif field == 'state__name':
+				# states are resolved from the in-memory registry, so there is no need to join the State table
+				getters.append(lambda row, position = index['state_id']: state_registry.name(row[position]))
+			else:
+				getters.append(itemgetter(index[field]))
+		return getters
+
+	@staticmethod
+	def shape(rows, fields, getters, columnar = False):
+		"""
+		Turns values_list() rows into the data of a listing response
+		:param rows: the rows
+		:type rows: list
+		:param fields: the fields requested
+		:type fields: tuple
+		:param getters: the callables reading the fields, as returned by row_getters
+		:type getters: list
+		:param columnar: whether to return the columns once and each row as a list, rather than a dict per row
+		:type columnar: bool
+		:return: the rows as dicts, or the columnar {columns, rows}
+		:rtype: list | dict
+		"""
+		if columnar:
+			return {'columns': list(fields), 'rows': [[get(row) for get in getters] for row in rows]}
+		return [dict(zip(fields, [get(row) for get in getters])) for row in rows]
+
+	@staticmethod
+	def risk_types_queryset(fields = RISK_TYPE_FIELDS):
+		"""
+		The rows listed by risk_types, i.e. the RiskTypes whose state is not Deleted
+		@param fields: the fields requested, see RISK_TYPE_FIELDS
+		@type fields: tuple
+		@return: the values_list queryset of the RiskTypes and its columns
+		@rtype: tuple
+		"""
+		columns = Interface.listing_columns(fields, ('form_digest', ))
+		if 'form_digest' in fields and 'name' not in columns:
+			columns += ('name', )  # the forms the digests are computed from hold the name
+		return RiskTypeService().filter(
+			~Q(state_id__in = state_registry.ids('Deleted'))).values_list(*columns), columns
+
+	@staticmethod
+	def customer_filters(request):
+		"""
+		Reads the filters of a Customers listing, e.g. ?min_risks=2&risk_since=2019-01-01&risk_type=AutoMobile Cover
+		:param request: the request, or a dictionary of its parameters
+		:type request: WSGIRequest | dict
+		:return: the lookups filtering the Customers, on their CustomerSummary but for the RiskType held
+		:rtype: dict
+		:raise ValueError: if a filter is not valid
+		"""
+		params = getattr(request, 'GET', request) or {}
+		lookups = {}
+		for param, lookup in (('min_risks', 'summary__risk_count__gte'), ('max_risks', 'summary__risk_count__lte')):
+			if params.get(param) not in (None, ''):
+				try:
+					lookups[lookup] = int(params[param])
+				except (TypeError, ValueError):
+					raise ValueError('%s must be an integer' % param)
+		# the days are turned into bounds on last_risk_date, which its index can seek
+		for param, lookup, days in (
+				('risk_since', 'summary__last_risk_date__gte', 0), ('risk_until', 'summary__last_risk_date__lt', 1)):
+			if params.get(param):
+				try:
+					bound = datetime.combine(to_date(params[param]) + timedelta(days = days), time.min)
+				except (TypeError, ValueError):
+					raise ValueError('%s must be a date formatted as YYYY-MM-DD' % param)
+				lookups[lookup] = timezone.make_aware(bound) if settings.USE_TZ else bound
+		if params.get('risk_type'):
+			lookups['id__in'] = RiskService().filter(
+				Q(risk_type_id = params['risk_type']) | Q(risk_type__name = params['risk_type'])).exclude(
+				state_id__in = state_registry.ids('Deleted')).values('customer_id')
+		return lookups
+
+	@staticmethod
+	def customer_sort(request):
+		"""
+		Reads the sort parameter of a Customers listing, paged or streamed
+		@param request: the request, or its parameters
+		@type request: WSGIRequest | dict
+		@return: one of CUSTOMER_SORTS prefixed with - for the descending order, None for the most recent first
+		@rtype: str | None
+		@raise ValueError: if the Customers cannot be sorted on the parameter
+		"""
+		sort = (getattr(request, 'GET', request) or {}).get('sort') or None
+		if sort is not None and sort.lstrip('-') not in Interface.CUSTOMER_SORTS:
+			raise ValueError('Unknown sort: %s, choose from %s' % (sort, ', '.join(Interface.CUSTOMER_SORTS)))
+		return sort
+
+	@staticmethod
+	def customers_queryset(fields = CUSTOMER_FIELDS, lookups = None, sort = None):
+		"""
+		The rows listed by get_customers, i.e. the Customers whose state is not Deleted
+		@param fields: the fields requested, see CUSTOMER_FIELDS. The name is only computed if it is requested and
+		the CustomerSummary is only joined if one of its fields is requested, filtered or sorted on.
+		@type fields: tuple
+		@param lookups: the filters, as returned by customer_filters
+		@type lookups: dict | None
+		@param sort: the field to sort on, one of CUSTOMER_SORTS prefixed with - for the descending order
+		@type sort: str | None
+		@return: the values_list queryset of the Customers and its columns
+		@rtype: tuple
+		"""
+		annotations = {}
+		if 'name' in fields:
+			annotations['name'] = Concat(F('first_name'), Value(' '), F('last_name'))
+		if sort:
+			fields = tuple(fields) + (sort.lstrip('-'), )
+		for field in Interface.CUSTOMER_SUMMARY_FIELDS:
+			if field in fields:
+				annotations[field] = F('summary__%s' % field)
+		columns = Interface.listing_columns(fields, ())
+		return CustomerService(**annotations).filter(
+			~Q(state_id__in = state_registry.ids('Deleted')), **(lookups or {})).values_list(*columns), columns
+
+	@staticmethod
+	def iter_rows(queryset, columns, fields, columnar = False, chunk_size = 2000, sort = None):
+		"""
+		Walks all the rows of a listing queryset in (-date_created, id) order, or in the order of the sorted pages,
+		without loading them all at once.
+		The rows are fetched chunk_size at a time through a server-side cursor where the database supports it.
+		@param queryset: the queryset as returned by risk_types_queryset or customers_queryset
+		@type queryset: QuerySet
+		@param columns: the columns of the queryset
+		@type columns: tuple
+		@param fields: the fields to return
+		@type fields: tuple
+		@param columnar: whether to yield each row as a list of the fields' values rather than a dict
+		@type columnar: bool
+		@param chunk_size: the number of rows fetched from the database at a time
+		@type chunk_size: int
+		@param sort: the column the rows are sorted on, see sorted_page. None for the (-date_created, id) order
+		@type sort: str | None
+		@return: the rows with their state__name resolved
+		@rtype: generator
+		"""
+		getters = Interface.row_getters(columns, fields)
+		for row in queryset.order_by(*(sort_ordering(sort) if sort else ORDERING)).iterator(chunk_size = chunk_size):
+			values = [get(row) for get in getters]
+			yield values if columnar else dict(zip(fields, values))
+
 	def risk_types(self, request):
 		"""
-		Retrieves all the RiskTypes defined in the system
-		@param request: The Django WSGIRequest to process.
+		Retrieves a page of the RiskTypes defined in the system, most recent first
+		@param request: The Django WSGIRequest to process. Its cursor and limit parameters select the page, of the
+		PAGINATION DEFAULT_LIMIT rows when no limit is given, followed by the next_cursor if there are more,
+		its fields parameter the fields returned and its format parameter or Accept header the columnar format.
 		@type request: WSGIRequest
-		@return: response containing a status, message and data returned after processing
+		@return: response containing a status, message, data and the next_cursor returned after processing
 		@rtype: dict
 		"""
 		try:
-			# retrieve all the RiskType objects in the system whose state is not Deleted
+			cursor, limit = self.page_params(request)
+			fields = self.sparse_fields(request, self.RISK_TYPE_FIELDS)
+			columnar = self.wants_columnar(request)
+			page = catalog_snapshot.risk_types(cursor, limit)
+			if page is not None:
+				return self.response(
+					'RiskTypes retrieved successfully', 'success',
+					self.shape(page[0], fields, [itemgetter(field) for field in fields], columnar),
+					next_cursor = page[1])
+
+			# retrieve a page of the RiskType objects in the system whose state is not Deleted
 			# to maintain the db integrity, we shall be marking a record as Deleted once the user 'Deletes' it
-			risk_types = list(RiskTypeService().filter(~Q(state__name = 'Deleted')).order_by(
-				'-date_created').values(
-				'name', 'description', 'state__name', 'id', 'has_form', 'date_created'))
-			return self.response('RiskTypes retrieved successfully', 'success', risk_types)
+			queryset, columns = self.risk_types_queryset(fields)
+			id_at, name_at = columns.index('id'), columns.index('name') if 'name' in columns else None
+			risk_types, next_cursor = keyset_page(
+				queryset, cursor, limit, key = itemgetter(columns.index('date_created'), id_at))
+			computed = {}
+			if 'form_digest' in fields:
+				# the digest of each form tells the clients which /api/forms/<id>/<digest>.json to fetch
+				forms = build_forms([{'id': row[id_at], 'name': row[name_at]} for row in risk_types])
+				computed['form_digest'] = lambda row: form_digest(forms[row[id_at]])
+			return self.response(
+				'RiskTypes retrieved successfully', 'success',
+				self.shape(risk_types, fields, self.row_getters(columns, fields, computed), columnar),
+				next_cursor = next_cursor)
+		except ValueError as e:
+			return self.response(str(e))
 		except Exception as e:
 			lgr.exception('risk_types exception: %s', e)
 		return self.response('Failed to retrieve the RiskTypes')
 
 	def get_customers(self, request):
 		"""
-		Retrieves all the RiskTypes defined in the system
-		@param request: The Django WSGIRequest to process.
+		Retrieves a page of the Customers registered in the system, most recent first unless sorted otherwise
+		@param request: The Django WSGIRequest to process. Its cursor and limit parameters select the page, of the
+		PAGINATION DEFAULT_LIMIT rows when no limit is given, followed by the next_cursor if there are more,
+		its fields parameter the fields returned and its format parameter or Accept header the columnar format.
+		Its sort parameter, e.g. -risk_count, sorts on one of CUSTOMER_SORTS and the filters of customer_filters
+		narrow the Customers down.
 		@type request: WSGIRequest
-		@return: response containing a status, message and data returned after processing
+		@return: response containing a status, message, data and the next_cursor returned after processing
 		@rtype: dict
 		"""
 		try:
-			# retrieve all the RiskType objects in the system whose state is not Deleted
+			cursor, limit = self.page_params(request)
+			fields = self.sparse_fields(request, self.CUSTOMER_FIELDS)
+			sort = self.customer_sort(request)
+			# retrieve a page of the Customer objects in the system whose state is not Deleted
 			# to maintain the db integrity, we shall be marking a record as Deleted once the user 'Deletes' it
-			risk_types = list(CustomerService(
-				name = Concat(F('first_name'), Value(' '), F('last_name'))).filter(
-				~Q(state__name = 'Deleted')).order_by('-date_created').values(
-				'name', 'phone_number', 'gender', 'date_of_birth', 'state__name', 'id',
-				'email', 'date_created'))
-			return self.response('RiskTypes retrieved successfully', 'success', risk_types)
+			queryset, columns = self.customers_queryset(fields, self.customer_filters(request), sort)
+			key = (columns.index('date_created'), columns.index('id'))
+			if sort is None:
+				customers, next_cursor = keyset_page(queryset, cursor, limit, key = itemgetter(*key))
+			else:
+				customers, next_cursor = sorted_page(
+					queryset, sort, cursor, limit, key = itemgetter(columns.index(sort.lstrip('-')), *key))
+			return self.response(
+				'RiskTypes retrieved successfully', 'success',
+				self.shape(customers, fields, self.row_getters(columns, fields), self.wants_columnar(request)),
+				next_cursor = next_cursor)
+		except ValueError as e:
+			return self.response(str(e))
 		except Exception as e:
 			lgr.exception('risk_types exception: %s', e)
 		return self.response('Failed to retrieve the RiskTypes')
 
+	@use_primary
 	def add_risk_type(self, name, description = None):
 		"""
 		Creates a new instance of a RiskTye using the provided parameters
@@ -129,25 +469,27 @@ class Interface(object):
 			if not name:
 				return self.response('A required parameter is missing')
 
-			active = StateService().get(name = 'Active')
+			active_id = state_registry.get_id('Active')
 			# check if there is another Active RiskType with the provided name to avoid duplicates
-			risk_type = RiskTypeService().filter(name = name).order_by('-date_created').first()
+			risk_type = RiskTypeService().filter(name = name, profile = 'write').order_by('-date_created').first()
 
 			# if there exists a RiskType with the provided name, update its status and description if the status is
 			# not Active, else return since it already exists and it's Active
 			if risk_type is not None:
-				if risk_type.state.name != 'Active':
-					update = RiskTypeService().update(risk_type.id, description = description, state = active)
+				if risk_type.state_id not in state_registry.ids('Active'):
+					update = RiskTypeService().update_columns(
+						risk_type.id, risk_type.date_modified, description = description, state_id = active_id)
 					if not update:
 						return self.response('Failed to update the RiskType')
 					return self.response('Existing RiskType updated successfully', 'success')
-				update = RiskTypeService().update(risk_type.id, description = description)
+				update = RiskTypeService().update_columns(
+					risk_type.id, risk_type.date_modified, description = description)
 				if not update:
 					return self.response('Failed to update the RiskType')
 				return self.response('Existing RiskType updated successfully', 'success')
 
 			# now that we are certain the RiskType does not exist, let's create a new one
-			risk_type = RiskTypeService().create(name = name, description = description, state = active)
+			risk_type = RiskTypeService().create(name = name, description = description, state_id = active_id)
 			if not risk_type:
 				return self.response('Failed to create a RiskType')
 			return self.response('RiskType created successfully', 'success')
@@ -155,6 +497,7 @@ class Interface(object):
 			lgr.exception('add_risk_type exception: %s', e)
 		return self.response('add_risk_type Exception')
 
+	@use_primary
 	def add_risk_type_fields(self, risk_type_id, fields):
 		"""
 		Persists RiskTypeFields selected by the user into the database
@@ -171,7 +514,8 @@ class Interface(object):
 				return self.response('Some required fields are missing.')
 
 			# check whether the provided RiskType exists, and if it does, check whether it already has a Form
-			risk_type = RiskTypeService().get(~Q(state__name = 'Deleted'), id = risk_type_id)
+			risk_type = RiskTypeService().get(
+				~Q(state_id__in = state_registry.ids('Deleted')), id = risk_type_id, profile = 'write')
 			if not risk_type:
 				return self.response('Selected Risk Type does not exist')
 			if risk_type.has_form:
@@ -179,26 +523,28 @@ class Interface(object):
 			# now lets add the fields for the RiskType and mark it as has_form
 			with transaction.atomic():
 				try:
-					active = StateService().get(name = 'Active')
-					for order, s_field in enumerate(fields):
-						risk_field = RiskFieldService().create(
-							risk_type = risk_type, field_type = s_field.get('field_type'),
-							caption = s_field.get('caption'), state = active,
-							default_value = s_field.get('default_value'),
-							order = order)
-						if not risk_field:
-							raise Exception('Error creating RiskField')
-					risk_type = RiskTypeService().update(risk_type.id, has_form = True)
+					active_id = state_registry.get_id('Active')
+					risk_fields = RiskFieldService().bulk_create([dict(
+						risk_type = risk_type, field_type = s_field.get('field_type'),
+						caption = s_field.get('caption'), state_id = active_id,
+						default_value = s_field.get('default_value'),
+						order = order) for order, s_field in enumerate(fields)])
+					if not risk_fields or risk_fields[1]:
+						raise Exception('Error creating RiskFields')
+					# guard against a concurrent request having added a form since we read the RiskType
+					risk_type = RiskTypeService().update_columns(risk_type.id, risk_type.date_modified, has_form = True)
 					if not risk_type:
 						raise Exception('RiskType update failed')
 				except Exception as e1:
 					lgr.exception('add_risk_type_fields atomic exception: %s', e1)
+					transaction.set_rollback(True)
 					return self.response('Failed to add fields for the selected RiskType')
 			return self.response('RiskType fields added successfully', 'success')
 		except Exception as e:
 			lgr.exception('add_risk_type_fields exception: %s', e)
 		return self.response('Exception creating RiskType fields')
 
+	@use_primary
 	def register_customer(
 			self, first_name, last_name, phone_number, date_of_birth, gender, salutation, email):
 		"""
@@ -233,10 +579,229 @@ class Interface(object):
 				first_name = first_name, last_name = last_name,
 				phone_number = phone_number, date_of_birth = date_of_birth,
 				gender = gender, salutation = salutation,
-				email = email, state = StateService().get(name = 'Active'))
+				email = email, state_id = state_registry.get_id('Active'))
 			if not customer:
 				return self.response('Failed to register customer')
 			return self.response('Customer registration successful', 'success')
 		except Exception as e:
 			lgr.exception('register_customer exception: %s', e)
 		return self.response('Exception registering the customer')
+
+	@use_primary
+	def submit_risk(self, customer_id, risk_type_id, values):
+		"""
+		Records a Customer's answers to the form of a RiskType, i.e. a Risk and a RiskData for each RiskField answered,
+		with the same number of queries however many RiskFields the form has
+		:param customer_id: the id of the Customer subscribing to the RiskType
+		:type customer_id: str
+		:param risk_type_id: the id or name of the RiskType
+		:type risk_type_id: str
+		:param values: the value of each RiskField, keyed by the id of the RiskField
+		:type values: dict
+		:return: response containing a status, message and the id of the Risk created, or the error of each invalid
+		RiskField
+		:rtype: dict
+		"""
+		try:
+			if not (customer_id and risk_type_id) or not isinstance(values, dict):
+				return self.response('Some required parameters are missing')
+
+			# the form comes from the form cache or the catalog snapshot, and is validated by its compiled version
+			form = self.get_risk_type(risk_type_id)
+			if form.get('status') != 'success':
+				return self.response(form.get('message'))
+			if not form['data']['risk_fields']:
+				return self.response('The selected RiskType has no Form associated with it')
+			compiled = form_validators.get(form['data'], form['digest'])
+			cleaned, errors = compiled.validate(values)
+			if errors:
+				return self.response('Some values are invalid', data = {'errors': errors})
+
+			customer = CustomerService().get(~Q(state_id__in = state_registry.ids('Deleted')), id = customer_id)
+			if customer is None:
+				return self.response('Selected Customer does not exist')
+			with transaction.atomic():
+				try:
+					active_id = state_registry.get_id('Active')
+					risk = RiskService().create(
+						customer_id = customer.id, risk_type_id = form['data']['risk_type']['id'], state_id = active_id)
+					if not risk:
+						raise Exception('Error creating the Risk')
+					# every RiskData goes in a single INSERT, typed so that it can be queried through its indexes
+					risk_data = RiskDataService().bulk_create([
+						dict(
+							risk_id = risk.id, risk_field_id = field_id, value = value, state_id = active_id,
+							**typed_columns(compiled.field_types[field_id], value))
+						for field_id, value in cleaned.items()], batch_size = max(len(cleaned), 1))
+					if not risk_data or risk_data[1]:
+						raise Exception('Error creating the RiskData')
+					# the wide tables are resolved under the lock of their RiskProjection, so none is swapped meanwhile
+					for wide_table in wide_tables.targets(form['data'], form['digest']):
+						wide_tables.insert(wide_table, form['data'], risk, cleaned)
+				except Exception as e1:
+					lgr.exception('submit_risk atomic exception: %s', e1)
+					transaction.set_rollback(True)
+					return self.response('Failed to record the Risk')
+			return self.response('Risk submitted successfully', 'success', {'id': risk.id})
+		except Exception as e:
+			lgr.exception('submit_risk exception: %s', e)
+		return self.response('submit_risk Exception')
+
+	def search_risks(self, risk_type_id, where = None, cursor = None, limit = None):
+		"""
+		Lists the Risks of a RiskType whose values match all the predicates, a page at a time, e.g. the AutoMobile
+		Covers with [{"field": "Year", "op": "gt", "value": 2015}]
+		:param risk_type_id: the id or name of the RiskType
+		:type risk_type_id: str
+		:param where: the predicates on the values of the RiskFields, see core.backend.risk_query.compile_predicate
+		:type where: list | None
+		:param cursor: the next_cursor returned with the previous page
+		:type cursor: str | None
+		:param limit: the number of Risks per page
+		:type limit: str | int | None
+		:return: response containing a status, message, the Risks with their values keyed by RiskField id and the
+		next_cursor
+		:rtype: dict
+		"""
+		try:
+			if not risk_type_id:
+				return self.response('RiskType must be selected')
+			form = self.get_risk_type(risk_type_id)
+			if form.get('status') != 'success':
+				return self.response(form.get('message'))
+			# the wide table of the RiskType, if it has a current one, holds each Risk and its values in a single row
+			wide_table = wide_tables.current(form['data'], form['digest'])
+			if wide_table is not None:
+				queryset, columns = wide_tables.filter(wide_table, form['data'], where)
+				rows, next_cursor = keyset_page(queryset.values(*(BASE_COLUMNS + tuple(columns))), cursor, limit)
+				risks = [dict(
+					[(column, row[column]) for column in BASE_COLUMNS] + [('values', wide_tables.values(row, columns))])
+					for row in rows]
+				return self.response('Risks retrieved successfully', 'success', risks, next_cursor = next_cursor)
+
+			risks, next_cursor = keyset_page(
+				filter_risks(form['data'], where).values(*BASE_COLUMNS), cursor, limit)
+			# one more query for the values of the whole page
+			values = self.risk_values([risk['id'] for risk in risks])
+			for risk in risks:
+				risk['values'] = values.get(risk['id'], {})
+			return self.response('Risks retrieved successfully', 'success', risks, next_cursor = next_cursor)
+		except ValueError as e:
+			return self.response(str(e))
+		except Exception as e:
+			lgr.exception('search_risks exception: %s', e)
+		return self.response('search_risks Exception')
+
+	@staticmethod
+	def risk_values(risk_ids):
+		"""
+		Pivots the RiskData of several Risks with a single query, the typed values in their canonical text form as
+		listed off the wide tables, leaving out the Deleted RiskData
+		:param risk_ids: the ids of the Risks
+		:type risk_ids: list
+		:return: the value of each RiskField keyed by the id of the RiskField, for each Risk keyed by its id
+		:rtype: dict
+		"""
+		values = {}
+		risk_data = RiskDataService().filter(risk_id__in = risk_ids).exclude(
+			state_id__in = state_registry.ids('Deleted'))
+		for risk_id, field_id, value, number, date in risk_data.values_list(
+				'risk_id', 'risk_field_id', 'value', 'value_number', 'value_date'):
+			values.setdefault(risk_id, {})[str(field_id)] = answer(value, number, date)
+		return values
+
+	def export_risks(self, risk_type_id, where = None, chunk_size = 500):
+		"""
+		Lists all the Risks of a RiskType matching the predicates for an export, one list of values per Risk
+		:param risk_type_id: the id or name of the RiskType
+		:type risk_type_id: str
+		:param where: the predicates on the values of the RiskFields, see core.backend.risk_query.compile_predicate
+		:type where: list | None
+		:param chunk_size: the number of Risks read at a time
+		:type chunk_size: int
+		:return: the columns, i.e. the id, customer_id and date_created of the Risk and the caption of each RiskField,
+		and an iterator over the rows
+		:rtype: tuple
+		:raise ValueError: if the RiskType does not exist or a predicate does not fit its form
+		"""
+		form = self.get_risk_type(risk_type_id)
+		if form.get('status') != 'success':
+			raise ValueError(form.get('message'))
+		risk_fields = form['data']['risk_fields']
+		columns = list(BASE_COLUMNS) + [risk_field['caption'] for risk_field in risk_fields]
+		wide_table = wide_tables.current(form['data'], form['digest'])
+		if wide_table is not None:
+			queryset, wide_columns = wide_tables.filter(wide_table, form['data'], where)
+			rows = queryset.order_by(*ORDERING).values_list(*(BASE_COLUMNS + tuple(wide_columns))).iterator(
+				chunk_size = chunk_size)
+			return columns, (list(row[:3]) + [display_value(value) for value in row[3:]] for row in rows)
+
+		def pivot(risks):
+			# the RiskData are read a chunk of Risks at a time
+			while True:
+				chunk = list(itertools.islice(risks, chunk_size))
+				if not chunk:
+					return
+				values = self.risk_values([risk[0] for risk in chunk])
+				for risk in chunk:
+					found = values.get(risk[0], {})
+					yield list(risk) + [found.get(str(risk_field['id'])) for risk_field in risk_fields]
+
+		risks = filter_risks(form['data'], where).order_by(*ORDERING).values_list(*BASE_COLUMNS)
+		return columns, pivot(risks.iterator(chunk_size = chunk_size))
+
+	def get_customer_portfolio(self, customer_id):
+		"""
+		retrieves a Customer with their Risks and the answers of each Risk, listed under the caption of their RiskField
+		as several RiskFields may share one, in the same number of queries however many Risks and answers the Customer
+		has. The answers that are Deleted, or whose RiskField is no longer Active, are left out.
+		:param customer_id: the id of the Customer
+		:type customer_id: str
+		:return: response containing a status, message and the Customer with their Risks
+		:rtype: dict
+		"""
+		try:
+			if not customer_id:
+				return self.response('Customer must be selected')
+			customer = CustomerService().get(
+				~Q(state_id__in = state_registry.ids('Deleted')), id = customer_id, profile = 'portfolio')
+			if customer is None:
+				return self.response('Selected Customer does not exist')
+			active, deleted = state_registry.ids('Active'), state_registry.ids('Deleted')
+			risks = []
+			for risk in customer.risk_set.all():
+				if risk.state_id in deleted:
+					continue
+				answers = OrderedDict()
+				for risk_data in risk.riskdata_set.all():
+					if risk_data.state_id in deleted or risk_data.risk_field.state_id not in active:
+						continue
+					answers.setdefault(risk_data.risk_field.caption, []).append(
+						answer(risk_data.value, risk_data.value_number, risk_data.value_date))
+				risks.append({
+					'id': risk.id, 'risk_type': {'id': risk.risk_type.id, 'name': risk.risk_type.name},
+					'state__name': state_registry.name(risk.state_id), 'date_created': risk.date_created,
+					'answers': answers})
+			data = {
+				'id': customer.id, 'salutation': customer.salutation, 'first_name': customer.first_name,
+				'last_name': customer.last_name, 'phone_number': customer.phone_number, 'email': customer.email,
+				'gender': customer.gender, 'date_of_birth': customer.date_of_birth,
+				'state__name': state_registry.name(customer.state_id), 'risks': risks}
+			return self.response('Customer portfolio retrieved successfully', 'success', data)
+		except Exception as e:
+			lgr.exception('get_customer_portfolio exception: %s', e)
+		return self.response('get_customer_portfolio Exception')
+
+	def get_stats(self):
+		"""
+		retrieves the usage counters of the worker process serving the request, i.e. how busy its database connection
+		pools are (connections in use, idle, callers waiting, waits and timeouts) and how its query cache performs
+		:return: response containing a status, message and the counters
+		:rtype: dict
+		"""
+		try:
+			data = {'db_pools': pool_stats(), 'query_cache': query_cache.stats()}
+			return self.response('Stats retrieved successfully', 'success', data)
+		except Exception as e:
+			lgr.exception('get_stats exception: %s', e)
+		return self.response('get_stats Exception')
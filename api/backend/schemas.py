@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+The schema of the data posted to each endpoint, see base.backend.request_parser.validate for the rules
+"""
+from core.models import field_types, gender, salutation
+
+GET_RISK_TYPE = {
+	'id': {'type': str, 'required': True, 'max_length': 100, 'aliases': ('risk_type_id', )},
+}
+
+GET_RISK_TYPES = {
+	'ids': {'type': list, 'required': True, 'items': {'type': str, 'max_length': 100}},
+}
+
+ADD_RISK_TYPE = {
+	'name': {'type': str, 'required': True, 'max_length': 100},
+	'description': {'type': str, 'max_length': 300},
+}
+
+RISK_FIELD = {
+	'caption': {'type': str, 'required': True, 'max_length': 100},
+	'field_type': {'type': str, 'required': True, 'choices': tuple(choice for choice, _ in field_types())},
+	'default_value': {'type': str, 'max_length': 100},
+}
+
+ADD_RISK_TYPE_FIELDS = {
+	'id': {'type': str, 'required': True, 'max_length': 100, 'aliases': ('risk_type_id', )},
+	'fields': {'type': list, 'required': True, 'items': {'type': dict, 'fields': RISK_FIELD}},
+}
+
+REGISTER_CUSTOMER = {
+	'first_name': {'type': str, 'required': True, 'max_length': 30},
+	'last_name': {'type': str, 'required': True, 'max_length': 30},
+	'phone_number': {'type': str, 'required': True, 'max_length': 50},
+	'date_of_birth': {'type': str, 'required': True, 'format': '%Y-%m-%d'},
+	'gender': {'type': str, 'required': True, 'choices': tuple(choice for choice, _ in gender())},
+	'salutation': {'type': str, 'required': True, 'choices': tuple(choice for choice, _ in salutation())},
+	'email': {'type': str, 'required': True, 'max_length': 50},
+}
+
+SUBMIT_RISK = {
+	'customer_id': {'type': str, 'required': True, 'max_length': 100},
+	'risk_type_id': {'type': str, 'required': True, 'max_length': 100},
+	'values': {'type': dict, 'required': True},
+}
+
+SEARCH_RISKS = {
+	'risk_type_id': {'type': str, 'required': True, 'max_length': 100},
+	'where': {'type': list, 'default': [], 'max_length': 20, 'items': {'type': dict, 'fields': {
+		'field': {'type': str, 'required': True, 'max_length': 100},
+		'op': {'type': str, 'default': 'eq', 'choices': ('eq', 'lt', 'lte', 'gt', 'gte', 'in', 'range', 'startswith')},
+		'value': {'required': True}}}},
+	'cursor': {'type': str, 'max_length': 200},
+	'limit': {'type': (int, str)},
+}
+
+BATCH = {
+	'operations': {'type': list, 'required': True, 'items': {'type': dict}},
+	'atomic': {'type': bool, 'default': False},
+	'parallel': {'type': bool, 'default': False},
+}
+
+# the schema of the args of the batch operations that write, so that a batch is held to the same rules as the endpoints
+OPERATION_ARGS = {
+	'add_risk_type': ADD_RISK_TYPE,
+	'add_risk_type_fields': ADD_RISK_TYPE_FIELDS,
+	'register_customer': REGISTER_CUSTOMER,
+	'submit_risk': SUBMIT_RISK,
+}
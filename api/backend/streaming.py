@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Streams the standard {status, message, data} response of a list endpoint without holding the list in memory
+"""
+import logging
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+from base.backend import db_router
+
+lgr = logging.getLogger(__name__)
+
+
+def stream_envelope(
+		rows, message, failure_message = 'Failed to retrieve the records', flush_every = 500, columns = None):
+	"""
+	Encodes the rows into the standard response envelope a few rows at a time.
+	The data comes first so that a failure half way through the rows can still be reported in the status and message.
+	:param rows: an iterator over the rows to send, e.g. from QuerySet.iterator()
+	:type rows: iterable
+	:param message: the message of the response once all the rows are sent
+	:type message: str
+	:param failure_message: the message of the response if the rows could not all be sent
+	:type failure_message: str
+	:param flush_every: the number of rows encoded into each chunk written to the client
+	:type flush_every: int
+	:param columns: the columns of the rows for the columnar format, where each row is a list of values
+	:type columns: list | None
+	:return: the chunks of the JSON document
+	:rtype: generator
+	"""
+	encoder = DjangoJSONEncoder(separators = (',', ':'))
+	status, separator, chunk = 'success', '', []
+	yield '{"data":[' if columns is None else '{"data":{"columns":%s,"rows":[' % encoder.encode(list(columns))
+	try:
+		for row in rows:
+			chunk.append(encoder.encode(row))
+			if len(chunk) >= flush_every:
+				yield separator + ','.join(chunk)
+				separator, chunk = ',', []
+		if chunk:
+			yield separator + ','.join(chunk)
+	except Exception as e:
+		lgr.exception('stream_envelope exception: %s', e)
+		status, message = 'failed', failure_message
+	yield '%s,"status":%s,"message":%s}' % (
+		']' if columns is None else ']}', encoder.encode(status), encoder.encode(message))
+
+
+def pinned(chunks):
+	"""
+	Pins the reads made while the chunks are generated to the primary database.
+	:param chunks: the chunks of the response
+	:type chunks: generator
+	:return: the same chunks
+	:rtype: generator
+	"""
+	with db_router.pin_primary():
+		for chunk in chunks:
+			yield chunk
+
+
+def streaming_json_response(rows, message, failure_message = 'Failed to retrieve the records', columns = None):
+	"""
+	Wraps stream_envelope into a StreamingHttpResponse
+	The rows are only read once the response is sent, after the ReplicaPinningMiddleware has reset the pin of the
+	request, so a request pinned to the primary database keeps its pin for the whole stream.
+	:param rows: an iterator over the rows to send
+	:type rows: iterable
+	:param message: the message of the response once all the rows are sent
+	:type message: str
+	:param failure_message: the message of the response if the rows could not all be sent
+	:type failure_message: str
+	:param columns: the columns of the rows for the columnar format
+	:type columns: list | None
+	:return: the streaming response
+	:rtype: StreamingHttpResponse
+	"""
+	chunks = stream_envelope(rows, message, failure_message, columns = columns)
+	if db_router.is_pinned():
+		chunks = pinned(chunks)
+	return StreamingHttpResponse(chunks, content_type = 'application/json')
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+tests for the batch endpoint
+"""
+import json
+
+import pytest
+from mixer.backend.django import mixer
+
+from api.backend.batch import run_batch
+from core.models import RiskType
+
+pytestmark = pytest.mark.django_db
+
+
+class TestBatch(object):
+	"""
+	Tests for the batch runner
+	"""
+	def test_run_batch(self, client):
+		"""
+		Test that the operations run in order and each returns its own response
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		risk_type = mixer.blend('core.RiskType', state = state)
+		response = client.post('/api/batch/', json.dumps({'operations': [
+			{'op': 'add_risk_type', 'args': {'name': 'Robbery Cover'}},
+			{'op': 'risk_types', 'args': {'limit': 10}},
+			{'op': 'get_risk_type', 'args': {'id': str(risk_type.id)}}]}), content_type = 'application/json')
+		content = json.loads(response.content)
+		assert content['status'] == 'success', 'Should process the batch'
+		assert [r['status'] for r in content['data']] == ['success'] * 3, 'Should run every operation'
+		assert len(content['data'][1]['data']) == 2, 'Should see the writes of the previous operations'
+		assert run_batch([{'op': 'delete_everything'}])['status'] == 'failed', 'Should reject unknown operations'
+
+	def test_atomic(self):
+		"""
+		Test that an atomic batch is rolled back when one of its operations fails
+		"""
+		mixer.blend('base.State', name = 'Active')
+		response = run_batch([
+			{'op': 'add_risk_type', 'args': {'name': 'Robbery Cover'}},
+			{'op': 'add_risk_type', 'args': {}}], atomic = True)
+		assert response['status'] == 'failed' and response['data'][0]['status'] == 'success', 'Should fail the batch'
+		assert not RiskType.objects.filter(name = 'Robbery Cover').exists(), 'Should roll back the first operation'
+		assert response['data'][1]['data'] == {'errors': {'name': 'is required'}}, \
+			'Should validate the args of the operations against the schema of their endpoint'
+
+	@pytest.mark.django_db(transaction = True)
+	def test_parallel(self):
+		"""
+		Test that read-only operations run concurrently return the same results as in sequence
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		risk_types = mixer.cycle(3).blend('core.RiskType', state = state)
+		operations = [{'op': 'get_risk_type', 'args': {'id': str(r.id)}} for r in risk_types]
+		operations.append({'op': 'risk_types'})
+		assert run_batch(operations, parallel = True) == run_batch(operations), 'Should return the same results'
@@ -2,9 +2,21 @@
 """
 test for the interfaces
 """
+import json
+import timeit
+import uuid
+from datetime import date, datetime
+from operator import itemgetter
+
 import pytest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from mixer.backend.django import mixer
 
+from base.backend.query_cache import query_cache
+from core.backend.services import RiskTypeService
+from core.models import Risk, RiskData
 from api.backend.interfaces import Interface
 
 pytestmark = pytest.mark.django_db
@@ -79,3 +91,244 @@ class TestInterfaces(object):
 			first_name = 'Kevin', last_name = 'Macharia', phone_number = '254717072416', date_of_birth = '1993-04-08',
 			gender = 'Male', salutation = 'Mr', email = 'kelvinmacharia078@gmail.com')
 		assert response['status'] == 'success', 'Should successfully create a new Customer'
+
+	def test_paginated_listings(self):
+		"""
+		Test that risk_types and get_customers return a page at a time with a cursor to the next
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		mixer.cycle(5).blend('core.RiskType', state = state)
+		mixer.cycle(3).blend('core.Customer', state = state)
+		first = Interface().risk_types({'limit': '3'})
+		assert len(first['data']) == 3 and first['next_cursor'], 'Should return the first page and a cursor'
+		second = Interface().risk_types({'limit': '3', 'cursor': first['next_cursor']})
+		assert len(second['data']) == 2 and second['next_cursor'] is None, 'Should return the last page'
+		assert not set(r['id'] for r in first['data']) & set(r['id'] for r in second['data']), 'Should not repeat rows'
+		assert Interface().risk_types({'cursor': 'garbage'})['status'] == 'failed', 'Should reject a bad cursor'
+
+		customers = Interface().get_customers({'limit': '2'})
+		assert len(customers['data']) == 2 and customers['next_cursor'], 'Should paginate the Customers'
+		customers = Interface().get_customers({'cursor': customers['next_cursor']})
+		assert len(customers['data']) == 1 and customers['next_cursor'] is None, 'Should return the last Customer'
+
+	def test_get_risk_types(self):
+		"""
+		Test for the get_risk_types API interface
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		risk_types = mixer.cycle(4).blend('core.RiskType', state = state)
+		for risk_type in risk_types:
+			mixer.cycle(2).blend('core.RiskField', risk_type = risk_type, state = state)
+		Interface().get_risk_types([risk_types[0].id])  # loads the State registry
+		with CaptureQueriesContext(connection) as few:
+			Interface().get_risk_types([risk_types[0].id])
+		with CaptureQueriesContext(connection) as many:
+			response = Interface().get_risk_types(
+				[r.id for r in risk_types[1:]] + [risk_types[0].name, 'Unknown Cover'])
+		assert response['status'] == 'success', 'Should successfully return the forms'
+		assert len(many) == len(few) == 2, 'Should not run more queries for more forms'
+		assert sorted(response['data']) == sorted(str(r.id) for r in risk_types), 'Should key the forms by id'
+		assert all(len(form['risk_fields']) == 2 for form in response['data'].values()), 'Should return the fields'
+		assert response['missing'] == ['Unknown Cover'], 'Should report the unknown RiskTypes'
+		assert Interface().get_risk_types([])['status'] == 'failed', 'Should require RiskTypes'
+
+	def test_sparse_fields(self):
+		"""
+		Test that the listings return and select only the fields asked for
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		mixer.cycle(2).blend('core.RiskType', state = state)
+		mixer.cycle(2).blend('core.Customer', state = state)
+		response = Interface().risk_types({'fields': 'id,name'})
+		assert all(sorted(r) == ['id', 'name'] for r in response['data']), 'Should only return the id and name'
+		with CaptureQueriesContext(connection) as queries:
+			response = Interface().get_customers({'fields': 'id,phone_number'})
+		assert all(sorted(r) == ['id', 'phone_number'] for r in response['data']), 'Should narrow the Customers'
+		assert 'first_name' not in queries[-1]['sql'], 'Should skip the name annotation'
+		response = Interface().get_customers({'fields': 'id,password'})
+		assert response['status'] == 'failed', 'Should reject the fields that are not whitelisted'
+
+	def test_customer_summaries(self):
+		"""
+		Test that get_customers lists, sorts and filters the Customers on their summary without aggregating the Risks
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		auto = mixer.blend('core.RiskType', name = 'AutoMobile Cover', state = state)
+		house = mixer.blend('core.RiskType', name = 'House Cover', state = state)
+		customers = mixer.cycle(4).blend('core.Customer', state = state)
+		for customer, risk_types in zip(customers, ((auto, auto, house), (house, ), (), (auto, auto))):
+			for risk_type in risk_types:
+				mixer.blend('core.Risk', customer = customer, risk_type = risk_type, state = state)
+		Interface().get_customers({})  # loads the State registry
+		with CaptureQueriesContext(connection) as queries:
+			first = Interface().get_customers({'sort': '-risk_count', 'limit': 2, 'fields': 'id,risk_count,risk_types'})
+		assert len(queries) == 1 and 'GROUP BY' not in queries[0]['sql'], 'Should join the summaries in one query'
+		assert first['data'] == [
+			{'id': str(customers[0].id), 'risk_count': 3, 'risk_types': 'AutoMobile Cover, House Cover'},
+			{'id': str(customers[3].id), 'risk_count': 2, 'risk_types': 'AutoMobile Cover'}], \
+			'Should sort the Customers on their number of Risks'
+		second = Interface().get_customers({'sort': '-risk_count', 'cursor': first['next_cursor'], 'fields': 'id'})
+		assert second['data'] == [{'id': str(customers[1].id)}, {'id': str(customers[2].id)}], \
+			'Should page through the sorted Customers'
+		filtered = Interface().get_customers({'min_risks': '1', 'risk_type': 'House Cover', 'sort': 'risk_count'})
+		assert [row['id'] for row in filtered['data']] == [str(customers[1].id), str(customers[0].id)], \
+			'Should filter the Customers on their summary and the RiskTypes they hold'
+		assert Interface().get_customers({'sort': 'email'})['status'] == 'failed', 'Should reject the unknown sorts'
+		assert Interface().get_customers({'risk_since': 'today'})['status'] == 'failed', 'Should reject bad filters'
+
+	@pytest.mark.django_db(transaction = True)
+	def test_customers_risk_type_cached(self):
+		"""
+		Test that the Customers cached for a risk_type filter are read again once the Risks or RiskTypes change
+		"""
+		query_cache.backend.clear()
+		state = mixer.blend('base.State', name = 'Active')
+		auto = mixer.blend('core.RiskType', name = 'AutoMobile Cover', state = state)
+		customer = mixer.blend('core.Customer', state = state)
+		def holders():
+			response = Interface().get_customers({'risk_type': 'AutoMobile Cover', 'fields': 'id'})
+			return [row['id'] for row in response['data']]
+
+		assert holders() == [], 'Should list no Customers before they hold the RiskType'
+		mixer.blend('core.Risk', customer = customer, risk_type = auto, state = state)
+		assert holders() == [str(customer.id)], 'Should list the Customer once they hold the RiskType'
+		RiskTypeService().update_columns(auto.id, name = 'House Cover')
+		assert holders() == [], 'Should stop listing the Customer once the RiskType is renamed'
+
+	def test_columnar(self):
+		"""
+		Test that the columnar format returns the same values as the rows, in a smaller payload
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		mixer.cycle(30).blend('core.Customer', state = state)
+		rows = Interface().get_customers({'limit': 20})
+		columnar = Interface().get_customers({'limit': 20, 'format': 'columnar'})
+		data = columnar['data']
+		assert data['columns'] == list(Interface.CUSTOMER_FIELDS), 'Should list the columns once'
+		assert [dict(zip(data['columns'], row)) for row in data['rows']] == rows['data'], 'Should hold the same values'
+		assert columnar['next_cursor'] == rows['next_cursor'], 'Should page the same way'
+		sizes = [len(json.dumps(payload, cls = DjangoJSONEncoder)) for payload in (data, rows['data'])]
+		assert sizes[0] < sizes[1], 'Should make a smaller payload'
+		risk_types = Interface().risk_types({'format': 'columnar', 'fields': 'id,state__name'})['data']
+		assert risk_types == {'columns': ['id', 'state__name'], 'rows': []}, 'Should narrow the columns'
+
+	def test_columnar_encoding(self):
+		"""
+		Test that a page in the columnar format is shaped and encoded faster than the same page as a dict per row
+		"""
+		fields = ('name', 'phone_number', 'gender', 'date_of_birth', 'id', 'email', 'date_created')
+		rows = [
+			('Mr Kevin Macharia %s' % i, '0700%06d' % i, 'Male', date(1993, 4, 8), str(uuid.uuid4()),
+				'kevin%s@example.com' % i, datetime(2019, 1, 1, 12, 0, i % 60)) for i in range(2000)]
+		getters = [itemgetter(position) for position in range(len(fields))]
+		encoder = DjangoJSONEncoder(separators = (',', ':'))
+		timings = dict(
+			(columnar, min(timeit.repeat(
+				lambda: encoder.encode(Interface.shape(rows, fields, getters, columnar)), number = 1, repeat = 5)))
+			for columnar in (False, True))
+		assert timings[True] < timings[False], \
+			'Should encode the columnar page faster, took %.4fs against %.4fs' % (timings[True], timings[False])
+
+	def test_submit_risk(self):
+		"""
+		Test for the submit_risk API interface
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		customer = mixer.blend('core.Customer', state = state)
+		small, large = mixer.cycle(2).blend('core.RiskType', state = state)
+		forms = {}
+		for risk_type, count in ((small, 2), (large, 8)):
+			forms[risk_type.id] = mixer.cycle(count).blend(
+				'core.RiskField', risk_type = risk_type, field_type = 'text', min_length = 0, max_length = 50,
+				nullable = False, default_value = None, state = state)
+		Interface().get_risk_type(small.id)  # loads the State registry
+		counts = []
+		for risk_type in (small, large):
+			values = dict((str(field.id), 'value %s' % i) for i, field in enumerate(forms[risk_type.id]))
+			with CaptureQueriesContext(connection) as queries:
+				response = Interface().submit_risk(str(customer.id), str(risk_type.id), values)
+			assert response['status'] == 'success', 'Should record the Risk'
+			counts.append(len(queries))
+		assert counts[0] == counts[1], 'Should not run more queries for more fields'
+		risk = Risk.objects.get(id = response['data']['id'])
+		assert sorted(RiskData.objects.filter(risk = risk).values_list('value', flat = True)) == sorted(values.values()),\
+			'Should record a RiskData per field'
+		response = Interface().submit_risk(str(customer.id), str(small.id), {str(forms[small.id][0].id): 'x' * 51})
+		assert response['data'] == {'errors': {
+			str(forms[small.id][0].id): 'must be at most 50 characters', str(forms[small.id][1].id): 'is required'}}, \
+			'Should validate the values against the RiskFields'
+		assert Risk.objects.count() == 2, 'Should not record an invalid Risk'
+
+	def test_search_risks(self):
+		"""
+		Test for the search_risks API interface
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		customer = mixer.blend('core.Customer', state = state)
+		risk_type = mixer.blend('core.RiskType', name = 'AutoMobile Cover', state = state)
+		year = mixer.blend(
+			'core.RiskField', risk_type = risk_type, caption = 'Year', field_type = 'number', min_length = 0,
+			max_length = 4, max_digits = 4, decimal_places = 0, nullable = False, default_value = None, state = state)
+		for value in ('2012', '2016', '2019'):
+			Interface().submit_risk(str(customer.id), str(risk_type.id), {str(year.id): value})
+		response = Interface().search_risks(
+			'AutoMobile Cover', [{'field': 'Year', 'op': 'gt', 'value': 2015}], limit = 1)
+		assert response['status'] == 'success' and response['next_cursor'], 'Should page the matching Risks'
+		page = Interface().search_risks(
+			'AutoMobile Cover', [{'field': 'Year', 'op': 'gt', 'value': 2015}], response['next_cursor'])
+		assert sorted(r['values'][str(year.id)] for r in response['data'] + page['data']) == ['2016', '2019'], \
+			'Should return the values of the matching Risks'
+		assert Interface().search_risks('AutoMobile Cover', [{'field': 'Colour', 'value': 'red'}])['status'] == \
+			'failed', 'Should reject the fields that are not in the form'
+		deleted = mixer.blend('base.State', name = 'Deleted')
+		RiskData.objects.filter(value = '2019').update(state = deleted)
+		Risk.objects.filter(riskdata__value = '2016').update(state = deleted)
+		values = sorted(r['values'].get(str(year.id), '') for r in Interface().search_risks('AutoMobile Cover')['data'])
+		assert values == ['', '2012'], 'Should leave out the Deleted Risks and values'
+
+	def test_get_customer_portfolio(self):
+		"""
+		Test for the get_customer_portfolio API interface
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		deleted = mixer.blend('base.State', name = 'Deleted')
+		inactive = mixer.blend('base.State', name = 'Inactive')
+		customer = mixer.blend('core.Customer', state = state)
+
+		def add_risks(count, fields):
+			for risk_type in mixer.cycle(count).blend('core.RiskType', state = state):
+				risk = mixer.blend('core.Risk', customer = customer, risk_type = risk_type, state = state)
+				for order in range(fields):
+					risk_field = mixer.blend(
+						'core.RiskField', risk_type = risk_type, caption = 'Field %s' % order, field_type = 'text',
+						order = order, state = state)
+					mixer.blend(
+						'core.RiskData', risk = risk, risk_field = risk_field, value = 'Answer %s' % order,
+						state = state)
+
+		add_risks(1, 1)
+		Interface().get_customer_portfolio(customer.id)  # loads the State registry
+		with CaptureQueriesContext(connection) as few:
+			Interface().get_customer_portfolio(customer.id)
+		add_risks(4, 5)
+		with CaptureQueriesContext(connection) as many:
+			response = Interface().get_customer_portfolio(customer.id)
+		assert response['status'] == 'success', 'Should return the portfolio'
+		assert len(many) == len(few) == 3, 'Should not run more queries for more Risks and answers'
+		assert len(response['data']['risks']) == 5, 'Should return every Risk of the Customer'
+		assert list(response['data']['risks'][0]['answers'].items()) == [
+			('Field %s' % i, ['Answer %s' % i]) for i in range(5)], 'Should list the answers by caption in field order'
+		json.dumps(response, cls = DjangoJSONEncoder)
+
+		risk = mixer.blend('core.Risk', customer = customer, state = state, risk_type__state = state)
+		for order, (caption, field_state, data_state) in enumerate([
+				('Name', state, state), ('Name', state, state), ('Name', state, deleted), ('Model', inactive, state)]):
+			mixer.blend(
+				'core.RiskData', risk = risk, value = 'Answer %s' % order, state = data_state,
+				risk_field = mixer.blend(
+					'core.RiskField', risk_type = risk.risk_type, caption = caption, field_type = 'text', order = order,
+					state = field_state))
+		answers = Interface().get_customer_portfolio(customer.id)['data']['risks'][0]['answers']
+		assert answers == {'Name': ['Answer 0', 'Answer 1']}, \
+			'Should list the answers of a shared caption together, leaving out the Deleted and inactive ones'
+		assert Interface().get_customer_portfolio('unknown')['status'] == 'failed', 'Should reject unknown Customers'
@@ -3,7 +3,10 @@ import json
 import pytest
 from django.test import RequestFactory
 from mixer.backend.django import mixer
-from api.views import GetRiskType, RiskTypes, AddRiskType
+from api.backend.streaming import stream_envelope
+from base.backend import db_pool
+from base.backend.db_pool import ConnectionPool, get_pool
+from api.views import GetRiskType, RiskTypes, AddRiskType, GetAllCustomers
 
 pytestmark = pytest.mark.django_db
 
@@ -44,3 +47,103 @@ class TestApiViews(object):
 			'api/add_risk_type/', {'name': 'Robbery Cover', 'description': 'Cover against theft and robbery'})
 		response = AddRiskType().post(request)
 		# assert json.loads(response.content)['status'] == 'success', 'Should create a RiskType successfully'
+
+	def test_streamed_listings(self):
+		"""
+		Test for the streaming mode of the RiskTypes and GetAllCustomers get endpoints
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		mixer.cycle(5).blend('core.RiskType', state = state)
+		mixer.cycle(3).blend('core.Customer', state = state)
+		response = RiskTypes().get(RequestFactory().get('api/risk_types/', {'stream': 1}))
+		assert response.streaming, 'Should stream the RiskTypes'
+		content = json.loads(b''.join(response.streaming_content))
+		assert content['status'] == 'success' and len(content['data']) == 5, 'Should stream all the RiskTypes'
+		assert content['data'][0]['state__name'] == 'Active', 'Should resolve the state names'
+		assert 'form_digest' not in content['data'][0], 'Should stream the RiskTypes without their form_digest'
+		response = RiskTypes().get(RequestFactory().get('api/risk_types/', {'stream': 1, 'fields': 'id,form_digest'}))
+		content = json.loads(response.content)
+		assert content['status'] == 'failed' and content['message'].startswith('Unknown fields: form_digest'), \
+			'Should reject the form_digest rather than stream the RiskTypes without it'
+		response = GetAllCustomers().get(RequestFactory().get('api/customers/', {'stream': 1}))
+		content = json.loads(b''.join(response.streaming_content))
+		assert len(content['data']) == 3, 'Should stream all the Customers'
+		response = GetAllCustomers().get(RequestFactory().get(
+			'api/customers/', {'stream': 1, 'fields': 'id,name'}, HTTP_ACCEPT = 'application/vnd.columnar+json'))
+		content = json.loads(b''.join(response.streaming_content))
+		assert content['data']['columns'] == ['id', 'name'] and len(content['data']['rows']) == 3, \
+			'Should stream the columnar format'
+
+	def test_streamed_customers_sort(self):
+		"""
+		Test that the streamed Customers are sorted like the paged ones
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		for count, customer in enumerate(mixer.cycle(3).blend('core.Customer', state = state)):
+			mixer.cycle(count * 2 % 3).blend('core.Risk', customer = customer, state = state, risk_type__state = state)
+		params = {'sort': '-risk_count', 'fields': 'id,risk_count'}
+		paged = json.loads(GetAllCustomers().get(RequestFactory().get('api/customers/', params)).content)['data']
+		response = GetAllCustomers().get(RequestFactory().get('api/customers/', dict(params, stream = 1)))
+		streamed = json.loads(b''.join(response.streaming_content))['data']
+		assert [c['risk_count'] for c in streamed] == [2, 1, 0] and streamed == paged, \
+			'Should stream the Customers in the order of the sort'
+		response = GetAllCustomers().get(RequestFactory().get('api/customers/', {'stream': 1, 'sort': 'name'}))
+		assert json.loads(response.content)['message'].startswith('Unknown sort: name'), \
+			'Should reject the unknown sorts rather than stream the Customers unsorted'
+
+	def test_stream_envelope(self):
+		"""
+		Test that a failure half way through the rows is reported in the streamed envelope
+		"""
+		def rows():
+			for i in range(3):
+				yield {'id': i}
+			raise Exception('connection lost')
+
+		content = json.loads(''.join(stream_envelope(rows(), 'ok', 'failed to stream', flush_every = 2)))
+		assert content == {'data': [{'id': 0}, {'id': 1}], 'status': 'failed', 'message': 'failed to stream'}, \
+			'Should close the envelope with the failure'
+
+	def test_get_risk_types(self, client):
+		"""
+		Test for the GetRiskTypes get and post endpoints
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		risk_types = mixer.cycle(2).blend('core.RiskType', state = state)
+		ids = [str(r.id) for r in risk_types]
+		response = client.get('/api/get_risk_types/', {'ids': ','.join(ids)})
+		assert sorted(json.loads(response.content)['data']) == sorted(ids), 'Should return the requested forms'
+		response = client.post('/api/get_risk_types/', json.dumps({'ids': ids}), content_type = 'application/json')
+		assert sorted(json.loads(response.content)['data']) == sorted(ids), 'Should accept the ids in the body'
+
+	def test_request_validation(self, client, settings):
+		"""
+		Test that the POST endpoints reject the bodies not matching their schema in the standard response shape
+		"""
+		response = client.post('/api/add_risk_type/', json.dumps({'description': 1}), content_type = 'application/json')
+		assert response.status_code == 400, 'Should reject an invalid body'
+		assert json.loads(response.content) == {
+			'status': 'failed', 'message': 'Invalid request',
+			'data': {'errors': {'name': 'is required', 'description': 'must be of type str'}}}, \
+			'Should return the error of each field'
+		response = client.post('/api/register_customer/', json.dumps({
+			'first_name': 'Jane', 'last_name': 'Doe', 'phone_number': '0700000000', 'date_of_birth': '01-01-1990',
+			'gender': 'Female', 'salutation': 'Mrs', 'email': 'jane@example.com'}), content_type = 'application/json')
+		assert json.loads(response.content)['data']['errors'] == {'date_of_birth': 'must match the format %Y-%m-%d'}, \
+			'Should validate the format of the dates'
+		settings.REQUEST_PARSER = {'MAX_BODY_SIZE': 64}
+		response = client.post(
+			'/api/get_risk_types/', json.dumps({'ids': ['a' * 36] * 3}), content_type = 'application/json')
+		assert response.status_code == 413, 'Should reject a body larger than the maximum size'
+
+	def test_stats(self, client, monkeypatch):
+		"""
+		Test for the Stats get endpoint
+		"""
+		monkeypatch.setattr(db_pool, '_pools', {})  # the pool registered here must not outlive the test
+		get_pool('test_stats', lambda: ConnectionPool(object))
+		content = json.loads(client.get('/api/stats/').content)
+		assert content['status'] == 'success', 'Should return the stats of the worker'
+		assert set(content['data']['db_pools']['test_stats']) >= {'in_use', 'idle', 'waiting', 'waits', 'timeouts'}, \
+			'Should report the usage of the connection pools'
+		assert 'hits' in content['data']['query_cache'], 'Should report the usage of the query cache'
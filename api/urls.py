@@ -2,13 +2,25 @@
 
 from django.conf.urls import url
 
-from api.views import GetRiskType, RiskTypes, AddRiskType, AddRiskTypeFields, GetAllCustomers, RegisterCustomer
+from api.views import (
+	GetRiskType, RiskTypes, AddRiskType, AddRiskTypeFields, GetAllCustomers, RegisterCustomer, FormSchema,
+	GetRiskTypes, Batch, SubmitRisk, SearchRisks, ExportRisks, CustomerPortfolio, Stats)
 
 urlpatterns = [
+	url(r'^get_risk_types/', GetRiskTypes().as_view(), name = 'get_risk_types'),  # ahead of risk_types/, it matches too
 	url(r'risk_types/', RiskTypes().as_view(), name = 'risk_types'),
 	url(r'get_risk_type/', GetRiskType().as_view(), name = 'get_risk_type'),
+	url(
+		r'forms/(?P<risk_type_id>[^/]+)/(?P<digest>[0-9a-f]{40})\.json$', FormSchema().as_view(),
+		name = 'form_schema'),
 	url(r'add_risk_type/', AddRiskType().as_view(), name = 'add_risk_type'),
 	url(r'add_risk_type_fields/', AddRiskTypeFields().as_view(), name = 'add_risk_type_fields'),
+	url(r'batch/', Batch().as_view(), name = 'batch'),
 	url(r'customers/', GetAllCustomers().as_view(), name = 'customers'),
+	url(r'customer_portfolio/', CustomerPortfolio().as_view(), name = 'customer_portfolio'),
 	url(r'register_customer/', RegisterCustomer().as_view(), name = 'register_customer'),
+	url(r'submit_risk/', SubmitRisk().as_view(), name = 'submit_risk'),
+	url(r'search_risks/', SearchRisks().as_view(), name = 'search_risks'),
+	url(r'export_risks/', ExportRisks().as_view(), name = 'export_risks'),
+	url(r'stats/', Stats().as_view(), name = 'stats'),
 ]
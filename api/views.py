@@ -3,14 +3,21 @@ from __future__ import unicode_literals
 
 import json
 
-from django.http import JsonResponse
+from django.http import HttpResponseNotModified, HttpResponseRedirect, JsonResponse
 import logging
 
+from django.urls import reverse
 from django.utils.decorators import method_decorator
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.views import APIView
 
+from api.backend import schemas
+from api.backend.batch import run_batch
+from api.backend.decorators import validate_request
 from api.backend.interfaces import Interface
+from api.backend.streaming import streaming_json_response
 
 lgr = logging.getLogger(__name__)
 
@@ -20,14 +27,28 @@ class RiskTypes(APIView):
 	def get(self, request):
 		"""
 		Api endpoint for the risk_types.
-		it will receive a request, forward it to the respective interface and return the result
+		it will receive a request, forward it to the respective interface and return the result.
+		with ?stream=1 all the RiskTypes are streamed instead of a page of them, without their form_digest, which is
+		rejected if asked for
 		:param request: request passed by the user for processing
 		:type request: WSGIRequest
 		:return: JSonResponse containing processing results
-		:rtype: JsonResponse
+		:rtype: JsonResponse | StreamingHttpResponse
 		"""
 		try:
-			return JsonResponse(Interface().risk_types(request))
+			if request.GET.get('stream'):
+				fields = Interface.sparse_fields(request, Interface.STREAMED_RISK_TYPE_FIELDS)
+				columnar = Interface.wants_columnar(request)
+				queryset, columns = Interface.risk_types_queryset(fields)
+				return streaming_json_response(
+					Interface.iter_rows(queryset, columns, fields, columnar),
+					'RiskTypes retrieved successfully', 'Failed to retrieve the RiskTypes',
+					fields if columnar else None)
+			response = JsonResponse(Interface().risk_types(request))
+			patch_vary_headers(response, ('Accept', ))  # the Accept header can ask for the columnar format
+			return response
+		except ValueError as e:
+			return JsonResponse(Interface.response(str(e)))
 		except Exception as e:
 			lgr.exception('risk_types endpoint exception: %s', e)
 		return JsonResponse({'status': 'failed', 'message': 'Internal server error'})
@@ -38,51 +59,209 @@ class GetAllCustomers(APIView):
 	def get(self, request):
 		"""
 		Api endpoint for fetching all customers.
-		it will receive a request, forward it to the respective interface and return the result
+		it will receive a request, forward it to the respective interface and return the result.
+		with ?stream=1 all the Customers are streamed instead of a page of them
 		:param request: request passed by the user for processing
 		:type request: WSGIRequest
 		:return: JSonResponse containing processing results
-		:rtype: JsonResponse
+		:rtype: JsonResponse | StreamingHttpResponse
 		"""
 		try:
-			return JsonResponse(Interface().get_customers(request))
+			if request.GET.get('stream'):
+				fields = Interface.sparse_fields(request, Interface.CUSTOMER_FIELDS)
+				columnar, sort = Interface.wants_columnar(request), Interface.customer_sort(request)
+				queryset, columns = Interface.customers_queryset(fields, Interface.customer_filters(request), sort)
+				return streaming_json_response(
+					Interface.iter_rows(queryset, columns, fields, columnar, sort = sort),
+					'Customers retrieved successfully', 'Failed to retrieve the Customers',
+					fields if columnar else None)
+			response = JsonResponse(Interface().get_customers(request))
+			patch_vary_headers(response, ('Accept', ))  # the Accept header can ask for the columnar format
+			return response
+		except ValueError as e:
+			return JsonResponse(Interface.response(str(e)))
 		except Exception as e:
 			lgr.exception('customers endpoint exception: %s', e)
 		return JsonResponse({'status': 'failed', 'message': 'Internal server error'})
 
 
+def form_response(request, risk_type_id):
+	"""
+	Builds the response of a RiskType form, tagged with the digest of the form as a strong ETag.
+	A client already holding the form, as told by its If-None-Match header, gets a 304 without the body.
+	:param request: request passed by the user for processing
+	:type request: WSGIRequest
+	:param risk_type_id: the id or name of the RiskType
+	:type risk_type_id: str
+	:return: the form or a 304 Not Modified
+	:rtype: JsonResponse | HttpResponseNotModified
+	"""
+	result = dict(Interface().get_risk_type(risk_type_id = risk_type_id))
+	digest = result.pop('digest', None)
+	if digest is None:
+		return JsonResponse(result)
+	etag = '"%s"' % digest
+	if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+	if if_none_match:
+		etags = [tag[2:] if tag.startswith('W/') else tag for tag in parse_etags(if_none_match)]
+		if etag in etags or '*' in etags:
+			response = HttpResponseNotModified()
+			response['ETag'] = etag
+			return response
+	response = JsonResponse(result)
+	response['ETag'] = etag
+	response.compression_cacheable = True  # the same form goes out until its digest changes
+	return response
+
+
 class GetRiskType(APIView):
 	@csrf_exempt
-	def post(self, request):
+	def get(self, request):
+		"""
+		Api endpoint for the form of a RiskType, selected by the id query parameter.
+		it will receive a request, forward it to the respective interface and return the result
+		:param request: request passed by the user for processing
+		:type request: WSGIRequest
+		:return: JSonResponse containing processing results, or a 304 if the client's copy is current
+		:rtype: JsonResponse | HttpResponseNotModified
+		"""
+		try:
+			return form_response(request, request.GET.get('id'))
+		except Exception as e:
+			lgr.exception('get_risk_type endpoint exception: %s', e)
+		return JsonResponse({'status': 'failed', 'message': 'Internal server error'})
+
+	@csrf_exempt
+	@validate_request(schemas.GET_RISK_TYPE)
+	def post(self, request, data):
 		"""
 		Api endpoint for the risk_types.
 		it will receive a request, forward it to the respective interface and return the result
 		:param request: request passed by the user for processing
 		:type request: WSGIRequest
+		:param data: the body of the request, validated against the schema of the endpoint
+		:type data: dict
+		:return: JSonResponse containing processing results, or a 304 if the client's copy is current
+		:rtype: JsonResponse | HttpResponseNotModified
+		"""
+		try:
+			return form_response(request, data.get('id'))
+		except Exception as e:
+			lgr.exception('get_risk_type endpoint exception: %s', e)
+		return JsonResponse({'status': 'failed', 'message': 'Internal server error'})
+
+
+class GetRiskTypes(APIView):
+	@csrf_exempt
+	def get(self, request):
+		"""
+		Api endpoint for the forms of several RiskTypes, selected by the comma separated ids query parameter.
+		it will receive a request, forward it to the respective interface and return the result
+		:param request: request passed by the user for processing
+		:type request: WSGIRequest
 		:return: JSonResponse containing processing results
 		:rtype: JsonResponse
 		"""
 		try:
-			data = json.loads(json.dumps(request.data))
-			return JsonResponse(Interface().get_risk_type(risk_type_id = data.get('id')))
+			return JsonResponse(Interface().get_risk_types(request.GET.get('ids', '').split(',')))
 		except Exception as e:
-			lgr.exception('get_risk_type endpoint exception: %s', e)
+			lgr.exception('get_risk_types endpoint exception: %s', e)
+		return JsonResponse({'status': 'failed', 'message': 'Internal server error'})
+
+	@csrf_exempt
+	@validate_request(schemas.GET_RISK_TYPES)
+	def post(self, request, data):
+		"""
+		Api endpoint for the forms of several RiskTypes, selected by the list of ids or names posted.
+		it will receive a request, forward it to the respective interface and return the result
+		:param request: request passed by the user for processing
+		:type request: WSGIRequest
+		:param data: the body of the request, validated against the schema of the endpoint
+		:type data: dict
+		:return: JSonResponse containing processing results
+		:rtype: JsonResponse
+		"""
+		try:
+			return JsonResponse(Interface().get_risk_types(data.get('ids')))
+		except Exception as e:
+			lgr.exception('get_risk_types endpoint exception: %s', e)
+		return JsonResponse({'status': 'failed', 'message': 'Internal server error'})
+
+
+class FormSchema(APIView):
+	@csrf_exempt
+	def get(self, request, risk_type_id, digest):
+		"""
+		Api endpoint for the form of a RiskType at a given digest, e.g. /api/forms/<risk_type_id>/<digest>.json
+		The content of such a url never changes, so it is cached by the browsers and CDNs for a year. A digest that is
+		no longer current is redirected to the url of the current form.
+		:param request: request passed by the user for processing
+		:type request: WSGIRequest
+		:param risk_type_id: the id of the RiskType
+		:type risk_type_id: str
+		:param digest: the digest of the form as listed by the risk_types endpoint
+		:type digest: str
+		:return: JSonResponse containing the form, or a redirect to the current form
+		:rtype: JsonResponse | HttpResponseRedirect
+		"""
+		try:
+			result = dict(Interface().get_risk_type(risk_type_id = risk_type_id))
+			current = result.pop('digest', None)
+			if current is None:
+				response = JsonResponse(result, status = 404)
+			elif current != digest:
+				response = HttpResponseRedirect(
+					reverse('form_schema', kwargs = {'risk_type_id': risk_type_id, 'digest': current}))
+			else:
+				response = JsonResponse(result)
+				response['ETag'] = '"%s"' % current
+				response['Cache-Control'] = 'public, max-age=31536000, immutable'
+				response.compression_cacheable = True
+				return response
+			response['Cache-Control'] = 'no-cache'
+			return response
+		except Exception as e:
+			lgr.exception('form_schema endpoint exception: %s', e)
+		return JsonResponse({'status': 'failed', 'message': 'Internal server error'})
+
+
+class Batch(APIView):
+	@csrf_exempt
+	@validate_request(schemas.BATCH)
+	def post(self, request, data):
+		"""
+		Api endpoint running several operations in one request, e.g.
+		{"parallel": true, "operations": [{"op": "risk_types"}, {"op": "get_risk_type", "args": {"id": "..."}}]}
+		it will receive a request, forward it to the batch runner and return the result
+		:param request: request passed by the user for processing
+		:type request: WSGIRequest
+		:param data: the body of the request, validated against the schema of the endpoint
+		:type data: dict
+		:return: JSonResponse containing the result of each operation
+		:rtype: JsonResponse
+		"""
+		try:
+			return JsonResponse(run_batch(data.get('operations'), data.get('atomic'), data.get('parallel')))
+		except Exception as e:
+			lgr.exception('batch endpoint exception: %s', e)
 		return JsonResponse({'status': 'failed', 'message': 'Internal server error'})
 
 
 class AddRiskType(APIView):
 	@csrf_exempt
-	def post(self, request):
+	@validate_request(schemas.ADD_RISK_TYPE)
+	def post(self, request, data):
 		"""
 		Api endpoint for creating a RiskType.
 		it will receive a request, forward it to the respective interface and return the result
 		:param request: request passed by the user for processing
 		:type request: WSGIRequest
+		:param data: the body of the request, validated against the schema of the endpoint
+		:type data: dict
 		:return: JSonResponse containing processing results
 		:rtype: JsonResponse
 		"""
 		try:
-			data = json.loads(json.dumps(request.data))
 			return JsonResponse(Interface().add_risk_type(data.get('name'), data.get('description')))
 		except Exception as e:
 			lgr.exception('add_risk_type endpoint exception: %s', e)
@@ -91,17 +270,19 @@ class AddRiskType(APIView):
 
 class AddRiskTypeFields(APIView):
 	@csrf_exempt
-	def post(self, request):
+	@validate_request(schemas.ADD_RISK_TYPE_FIELDS)
+	def post(self, request, data):
 		"""
 		Api endpoint for creating RiskFields and mapping them to a RiskType.
 		it will receive a request, forward it to the respective interface and return the result
 		:param request: request passed by the user for processing
 		:type request: WSGIRequest
+		:param data: the body of the request, validated against the schema of the endpoint
+		:type data: dict
 		:return: JSonResponse containing processing results
 		:rtype: JsonResponse
 		"""
 		try:
-			data = json.loads(json.dumps(request.data))
 			return JsonResponse(Interface().add_risk_type_fields(data.get('id'), data.get('fields')))
 		except Exception as e:
 			lgr.exception('add_risk_type_fields endpoint exception: %s', e)
@@ -110,20 +291,129 @@ class AddRiskTypeFields(APIView):
 
 class RegisterCustomer(APIView):
 	@csrf_exempt
-	def post(self, request):
+	@validate_request(schemas.REGISTER_CUSTOMER)
+	def post(self, request, data):
 		"""
 		Api endpoint for registering a new Customer into the system.
 		it will receive a request, forward it to the respective interface and return the result
 		:param request: request passed by the user for processing
 		:type request: WSGIRequest
+		:param data: the body of the request, validated against the schema of the endpoint
+		:type data: dict
 		:return: JSonResponse containing processing results
 		:rtype: JsonResponse
 		"""
 		try:
-			data = json.loads(json.dumps(request.data))
 			return JsonResponse(Interface().register_customer(
 				data.get('first_name'), data.get('last_name'), data.get('phone_number'), data.get('date_of_birth'),
 				data.get('gender'), data.get('salutation'), data.get('email')))
 		except Exception as e:
 			lgr.exception('add_risk_type_fields endpoint exception: %s', e)
 		return JsonResponse({'status': 'failed', 'message': 'Internal server error'})
+
+
+class SubmitRisk(APIView):
+	@csrf_exempt
+	@validate_request(schemas.SUBMIT_RISK)
+	def post(self, request, data):
+		"""
+		Api endpoint recording a Customer's answers to the form of a RiskType, e.g.
+		{"customer_id": "...", "risk_type_id": "...", "values": {"<risk_field_id>": "KZB 302Y"}}
+		it will receive a request, forward it to the respective interface and return the result
+		:param request: request passed by the user for processing
+		:type request: WSGIRequest
+		:param data: the body of the request, validated against the schema of the endpoint
+		:type data: dict
+		:return: JSonResponse containing processing results
+		:rtype: JsonResponse
+		"""
+		try:
+			return JsonResponse(Interface().submit_risk(
+				data.get('customer_id'), data.get('risk_type_id'), data.get('values')))
+		except Exception as e:
+			lgr.exception('submit_risk endpoint exception: %s', e)
+		return JsonResponse({'status': 'failed', 'message': 'Internal server error'})
+
+
+class SearchRisks(APIView):
+	@csrf_exempt
+	@validate_request(schemas.SEARCH_RISKS)
+	def post(self, request, data):
+		"""
+		Api endpoint listing the Risks of a RiskType whose values match the predicates posted, e.g.
+		{"risk_type_id": "AutoMobile Cover", "where": [{"field": "Year", "op": "gt", "value": 2015}], "limit": 50}
+		it will receive a request, forward it to the respective interface and return the result
+		:param request: request passed by the user for processing
+		:type request: WSGIRequest
+		:param data: the body of the request, validated against the schema of the endpoint
+		:type data: dict
+		:return: JSonResponse containing processing results
+		:rtype: JsonResponse
+		"""
+		try:
+			return JsonResponse(Interface().search_risks(
+				data.get('risk_type_id'), data.get('where'), data.get('cursor'), data.get('limit')))
+		except Exception as e:
+			lgr.exception('search_risks endpoint exception: %s', e)
+		return JsonResponse({'status': 'failed', 'message': 'Internal server error'})
+
+
+class ExportRisks(APIView):
+	@csrf_exempt
+	def get(self, request):
+		"""
+		Api endpoint streaming all the Risks of a RiskType in the columnar format, one column per RiskField, e.g.
+		?risk_type_id=AutoMobile Cover&where=[{"field": "Year", "op": "gt", "value": 2015}]
+		it will receive a request, forward it to the respective interface and return the result
+		:param request: request passed by the user for processing
+		:type request: WSGIRequest
+		:return: the streamed Risks
+		:rtype: StreamingHttpResponse | JsonResponse
+		"""
+		try:
+			where = json.loads(request.GET.get('where') or '[]')
+			if not isinstance(where, list):
+				raise ValueError('where must be a list of predicates')
+			columns, rows = Interface().export_risks(request.GET.get('risk_type_id'), where)
+			return streaming_json_response(rows, 'Risks exported successfully', 'Failed to export the Risks', columns)
+		except ValueError as e:
+			return JsonResponse(Interface.response(str(e)))
+		except Exception as e:
+			lgr.exception('export_risks endpoint exception: %s', e)
+		return JsonResponse({'status': 'failed', 'message': 'Internal server error'})
+
+
+class CustomerPortfolio(APIView):
+	@csrf_exempt
+	def get(self, request):
+		"""
+		Api endpoint for a Customer with their Risks and answers, selected by the id query parameter.
+		it will receive a request, forward it to the respective interface and return the result
+		:param request: request passed by the user for processing
+		:type request: WSGIRequest
+		:return: JSonResponse containing processing results
+		:rtype: JsonResponse
+		"""
+		try:
+			return JsonResponse(Interface().get_customer_portfolio(request.GET.get('id')))
+		except Exception as e:
+			lgr.exception('customer_portfolio endpoint exception: %s', e)
+		return JsonResponse({'status': 'failed', 'message': 'Internal server error'})
+
+
+class Stats(APIView):
+	@csrf_exempt
+	def get(self, request):
+		"""
+		Api endpoint for the usage counters of the connection pools and the query cache of the worker process.
+		it will receive a request, forward it to the respective interface and return the result
+		:param request: request passed by the user for processing
+		:type request: WSGIRequest
+		:return: JSonResponse containing processing results
+		:rtype: JsonResponse
+		"""
+		try:
+			return JsonResponse(Interface().get_stats())
+		except Exception as e:
+			lgr.exception('stats endpoint exception: %s', e)
+		return JsonResponse({'status': 'failed', 'message': 'Internal server error'})
@@ -1 +1,3 @@
 from __future__ import unicode_literals
+
+default_app_config = 'base.apps.BaseConfig'
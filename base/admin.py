@@ -3,7 +3,7 @@ from __future__ import unicode_literals
 
 from django.contrib import admin
 
-from base.models import State
+from base.models import CacheGeneration, State
 
 
 @admin.register(State)
@@ -14,3 +14,12 @@ class StateAdmin(admin.ModelAdmin):
 	list_filter = ('date_created',)
 	list_display = ('name', 'description', 'date_modified', 'date_created')
 	search_fields = ('name',)
+
+
+@admin.register(CacheGeneration)
+class CacheGenerationAdmin(admin.ModelAdmin):
+	"""
+	Admin class for the CacheGeneration model. defines the fields to display and which are searchable
+	"""
+	list_display = ('label', 'generation', 'date_modified', 'date_created')
+	search_fields = ('label',)
@@ -6,3 +6,6 @@ from django.apps import AppConfig
 
 class BaseConfig(AppConfig):
     name = 'base'
+
+    def ready(self):
+        import base.signals  # noqa: F401
@@ -5,7 +5,6 @@ This defines the methods and functions that perform common functionality require
 """
 import base64
 import binascii
-import json
 import os
 import logging
 import hashlib
@@ -19,6 +18,8 @@ from django.core.files.storage import FileSystemStorage
 
 from pytz import timezone
 
+from base.backend.request_parser import decode_request
+
 lgr = logging.getLogger(__name__)
 
 
@@ -230,32 +231,11 @@ def get_request_data(request):
 	@param request: The Django HttpRequest.
 	@type request: WSGIRequest
 	@return: The data from the request as a dict
-	@rtype: QueryDict
+	@rtype: dict | None
 	"""
 	try:
-		data = None
 		if request is not None:
-			request_meta = getattr(request, 'META', {})
-			request_method = getattr(request, 'method', None)
-			if request_meta.get('CONTENT_TYPE', '') == 'application/json':
-				data = json.loads(request.body)
-			elif str(request_meta.get('CONTENT_TYPE', '')).startswith('multipart/form-data;'):  # Special handling for
-				# Form Data?
-				data = request.POST.copy()
-				data = data.dict()
-			elif request_method == 'GET':
-				data = request.GET.copy()
-				data = data.dict()
-			elif request_method == 'POST':
-				data = request.POST.copy()
-				data = data.dict()
-			if not data:
-				request_body = getattr(request, 'body', None)
-				if request_body:
-					data = json.loads(request_body)
-				else:
-					data = QueryDict()
-			return data
+			return decode_request(request)
 	except Exception as e:
 		lgr.exception('get_request_data Exception: %s', e)
 	return QueryDict()
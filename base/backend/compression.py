@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Compression of the response bodies, negotiated with the Accept-Encoding of the client.
+Bodies served from a cache are compressed once: their compressed bytes are kept in an LRU store keyed by the digest of
+the body and the encoding, so that the next response with the same body skips the compression.
+"""
+import gzip
+import hashlib
+import logging
+import re
+
+from django.conf import settings
+from django.utils.text import compress_sequence
+
+from base.backend.query_cache import LocMemLRUBackend
+
+try:
+	import brotli
+except ImportError:  # pragma: no cover - brotli is optional, gzip is always available
+	brotli = None
+
+lgr = logging.getLogger(__name__)
+
+COMPRESSIBLE_TYPES = re.compile(r'^(text/|application/([\w.+-]*\+)?(json|javascript|xml))')
+
+
+class Compressor(object):
+	"""
+	Compresses the response bodies and caches the compressed bytes of the bodies that come from a cache.
+	"""
+
+	def __init__(self):
+		super(Compressor, self).__init__()
+		self._store = None
+		self.hits = 0
+		self.misses = 0
+
+	@property
+	def config(self):
+		return getattr(settings, 'COMPRESSION', {})
+
+	@property
+	def store(self):
+		if self._store is None:
+			self._store = LocMemLRUBackend(**self.config.get('CACHE_OPTIONS', {}))
+		return self._store
+
+	def encodings(self, streaming = False):
+		"""
+		Lists the encodings this process can produce, most preferred first.
+		@param streaming: Whether the body is streamed, in which case only gzip is produced.
+		@type streaming: bool
+		@rtype: list
+		"""
+		if brotli is not None and self.config.get('BROTLI', True) and not streaming:
+			return ['br', 'gzip']
+		return ['gzip']
+
+	def negotiate(self, accept_encoding, streaming = False):
+		"""
+		Picks the encoding of a response from the Accept-Encoding header of the request.
+		@param accept_encoding: The Accept-Encoding header, e.g. 'gzip, deflate, br;q=0.9'
+		@type accept_encoding: str
+		@param streaming: Whether the body is streamed.
+		@type streaming: bool
+		@return: The encoding with the highest q-value among the ones we produce, or None to send the body as is.
+		@rtype: str | None
+		"""
+		accepted = {}
+		for part in accept_encoding.split(','):
+			name, _, params = part.strip().partition(';')
+			quality = 1.0
+			for param in params.split(';'):
+				key, _, value = param.strip().partition('=')
+				if key == 'q':
+					try:
+						quality = float(value)
+					except ValueError:
+						quality = 0.0
+			if name:
+				accepted[name.strip().lower()] = quality
+		best, best_quality = None, 0.0
+		for encoding in self.encodings(streaming):
+			quality = accepted.get(encoding, accepted.get('*', 0.0))
+			if quality > best_quality:
+				best, best_quality = encoding, quality
+		return best
+
+	def compressible(self, response):
+		"""
+		Checks whether a response is worth compressing: of a textual type, not yet encoded and not too small.
+		@type response: HttpResponseBase
+		@rtype: bool
+		"""
+		if response.has_header('Content-Encoding') or not COMPRESSIBLE_TYPES.match(response.get('Content-Type', '')):
+			return False
+		return response.streaming or len(response.content) >= self.config.get('MIN_SIZE', 1024)
+
+	def compress(self, content, encoding, cacheable = False):
+		"""
+		Compresses a body, reusing the compressed bytes of an identical cacheable body.
+		@param content: The body to compress.
+		@type content: bytes
+		@param encoding: The encoding as returned by negotiate.
+		@type encoding: str
+		@param cacheable: Whether the body comes from a cache and is likely to be sent again.
+		@type cacheable: bool
+		@return: The compressed body.
+		@rtype: bytes
+		"""
+		key = None
+		if cacheable:
+			key = 'compressed:%s:%s' % (encoding, hashlib.sha1(content).hexdigest())
+			found, compressed = self.store.get(key)
+			if found:
+				self.hits += 1
+				return compressed
+			self.misses += 1
+		level = self.config.get('LEVEL', 6)
+		if encoding == 'br':
+			compressed = brotli.compress(content, quality = self.config.get('BROTLI_QUALITY', 5))
+		else:
+			compressed = gzip.compress(content, compresslevel = level)
+		if key is not None:
+			self.store.set(key, compressed)
+		return compressed
+
+	def compress_stream(self, chunks):
+		"""
+		Gzips a streamed body chunk by chunk.
+		@param chunks: The chunks of the body.
+		@type chunks: iterable
+		@rtype: generator
+		"""
+		return compress_sequence(chunks)
+
+
+compressor = Compressor()
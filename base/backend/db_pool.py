@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Per-process pool of database connections shared by the threads of a worker.
+Connections are validated before they are handed out again, discarded once they break or reach their lifetime, and the
+pool keeps counters of how long callers waited for a connection and how much of it is in use.
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+lgr = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+	"""
+	Raised when no connection is freed up within the pool timeout.
+	"""
+
+
+class ConnectionPool(object):
+	"""
+	A bounded LIFO pool of connections.
+	"""
+
+	def __init__(
+			self, connect, validate = None, reset = None, max_size = 10, timeout = 5, validate_after = 30,
+			max_lifetime = 3600, warn_wait = 0.1):
+		"""
+		@param connect: Callable opening a new connection.
+		@param validate: Callable checking that an idle connection is still usable. Returns a bool.
+		@param reset: Callable preparing a released connection for reuse. Returns False if it has to be discarded.
+		@param max_size: The maximum number of connections this process opens.
+		@type max_size: int
+		@param timeout: The number of seconds to wait for a connection once max_size connections are in use.
+		@type timeout: float
+		@param validate_after: The number of seconds a connection can stay idle before it is validated on reuse.
+		0 validates it on every reuse.
+		@type validate_after: float
+		@param max_lifetime: The number of seconds after which a connection is closed instead of reused.
+		@type max_lifetime: float
+		@param warn_wait: Checkouts waiting longer than this number of seconds are logged.
+		@type warn_wait: float
+		"""
+		super(ConnectionPool, self).__init__()
+		self.connect = connect
+		self.validate = validate
+		self.reset = reset
+		self.max_size = max_size
+		self.timeout = timeout
+		self.validate_after = validate_after
+		self.max_lifetime = max_lifetime
+		self.warn_wait = warn_wait
+		self._idle = deque()
+		self._created = {}  # id(connection) => the time it was opened
+		self._size = 0
+		self._in_use = 0
+		self._waiting = 0  # the number of callers currently waiting for a connection
+		self._cond = threading.Condition()
+		self.checkouts = 0
+		self.waits = 0
+		self.wait_time = 0.0
+		self.max_wait_time = 0.0
+		self.timeouts = 0
+		self.opened = 0
+		self.discarded = 0
+
+	def _close(self, connection):
+		self._created.pop(id(connection), None)
+		self.discarded += 1
+		try:
+			connection.close()
+		except Exception as e:
+			lgr.warning('ConnectionPool close exception: %s' % e)
+
+	def _usable(self, connection, last_used):
+		"""
+		Checks whether an idle connection can be handed out again.
+		"""
+		now = time.time()
+		if now - self._created.get(id(connection), now) > self.max_lifetime:
+			return False
+		if self.validate is not None and now - last_used >= self.validate_after:
+			try:
+				return bool(self.validate(connection))
+			except Exception as e:
+				lgr.warning('ConnectionPool validation failed: %s' % e)
+				return False
+		return True
+
+	def acquire(self):
+		"""
+		Hands out an idle connection or opens a new one, waiting for a release if the pool is exhausted.
+		@return: A usable connection.
+		@raise PoolTimeout: If no connection is released within the timeout.
+		"""
+		start = time.time()
+		entry = None
+		with self._cond:
+			waited = False
+			while True:
+				if self._idle:
+					entry = self._idle.pop()
+					break
+				if self._size < self.max_size:
+					self._size += 1
+					break
+				remaining = start + self.timeout - time.time()
+				if remaining <= 0:
+					self.timeouts += 1
+					raise PoolTimeout('No connection available within %ss (%s in use)' % (self.timeout, self._in_use))
+				waited = True
+				self._waiting += 1
+				try:
+					self._cond.wait(remaining)
+				finally:
+					self._waiting -= 1
+			wait = time.time() - start
+			self._in_use += 1
+			self.checkouts += 1
+			self.wait_time += wait
+			self.max_wait_time = max(self.max_wait_time, wait)
+			if waited:
+				self.waits += 1
+		if wait > self.warn_wait:
+			lgr.warning('ConnectionPool waited %.3fs for a connection: %s' % (wait, self.stats()))
+		if entry is not None:
+			connection, last_used = entry
+			if self._usable(connection, last_used):
+				return connection
+			self._close(connection)
+		try:
+			connection = self.connect()
+		except Exception:
+			with self._cond:
+				self._size -= 1
+				self._in_use -= 1
+				self._cond.notify()
+			raise
+		self._created[id(connection)] = time.time()
+		self.opened += 1
+		return connection
+
+	def release(self, connection, discard = False):
+		"""
+		Returns a connection to the pool.
+		@param connection: The connection handed out by acquire.
+		@param discard: Whether to close the connection instead of reusing it, e.g. after an error.
+		@type discard: bool
+		"""
+		if not discard and self.reset is not None:
+			try:
+				discard = self.reset(connection) is False
+			except Exception as e:
+				lgr.warning('ConnectionPool reset failed: %s' % e)
+				discard = True
+		if discard:
+			self._close(connection)
+		with self._cond:
+			self._in_use -= 1
+			if discard:
+				self._size -= 1
+			else:
+				self._idle.append((connection, time.time()))
+			self._cond.notify()
+
+	def close_all(self):
+		"""
+		Closes the idle connections.
+		"""
+		with self._cond:
+			while self._idle:
+				connection = self._idle.pop()[0]
+				self._size -= 1
+				self._close(connection)
+
+	def stats(self):
+		"""
+		Retrieves the usage counters of the pool, all read at the same instant.
+		@return: The size, use, utilization and wait time counters of the pool.
+		@rtype: dict
+		"""
+		with self._cond:
+			return {
+				'size': self._size, 'in_use': self._in_use, 'idle': len(self._idle), 'waiting': self._waiting,
+				'max_size': self.max_size, 'utilization': float(self._in_use) / self.max_size if self.max_size else 0.0,
+				'checkouts': self.checkouts, 'waits': self.waits, 'timeouts': self.timeouts,
+				'wait_time_avg': self.wait_time / self.checkouts if self.checkouts else 0.0,
+				'wait_time_max': self.max_wait_time, 'opened': self.opened, 'discarded': self.discarded}
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, create):
+	"""
+	Retrieves the pool of a database alias for the current process, creating it on first use. Pools inherited from a
+	parent process are never reused as the connections in them belong to the parent.
+	@param alias: The database alias.
+	@type alias: str
+	@param create: Callable creating the pool.
+	@return: The pool of the alias.
+	@rtype: ConnectionPool
+	"""
+	key = (os.getpid(), alias)
+	pool = _pools.get(key)
+	if pool is None:
+		with _pools_lock:
+			pool = _pools.get(key)
+			if pool is None:
+				pool = _pools[key] = create()
+	return pool
+
+
+def pool_stats():
+	"""
+	Retrieves the usage counters of the pools of the current process.
+	@return: The stats of each pool keyed by database alias.
+	@rtype: dict
+	"""
+	return dict((alias, pool.stats()) for (pid, alias), pool in list(_pools.items()) if pid == os.getpid())
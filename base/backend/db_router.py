@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Routes the reads to the read replicas and the writes to the primary database.
+A thread that has written, or that is pinned by the ReplicaPinningMiddleware, reads from the primary so that it always
+sees its own writes despite the replication lag.
+"""
+import random
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+
+_state = threading.local()
+
+
+def is_pinned():
+	"""
+	Checks whether the reads of the current thread are pinned to the primary database.
+	@rtype: bool
+	"""
+	return getattr(_state, 'pinned', 0) > 0 or getattr(_state, 'wrote', False)
+
+
+def has_written():
+	"""
+	Checks whether the current thread has written to the primary database since the last reset.
+	@rtype: bool
+	"""
+	return getattr(_state, 'wrote', False)
+
+
+def reset(pinned = False):
+	"""
+	Clears the writes tracked for the current thread, e.g. at the start and end of a request.
+	@param pinned: Whether the reads of the thread should still be pinned to the primary database.
+	@type pinned: bool
+	"""
+	_state.wrote = False
+	_state.pinned = 1 if pinned else 0
+
+
+@contextmanager
+def pin_primary():
+	"""
+	Pins the reads of the current thread to the primary database for the duration of the block.
+	"""
+	_state.pinned = getattr(_state, 'pinned', 0) + 1
+	try:
+		yield
+	finally:
+		_state.pinned -= 1
+
+
+def use_primary(fn):
+	"""
+	Decorator pinning the reads of the decorated function to the primary database, for read-modify-write operations that
+	must not act on lagging replica rows.
+	"""
+	@wraps(fn)
+	def wrapper(*args, **kwargs):
+		with pin_primary():
+			return fn(*args, **kwargs)
+
+	return wrapper
+
+
+class ReplicaRouter(object):
+	"""
+	Sends the reads to one of the DATABASE_REPLICAS and everything else to the primary database.
+	"""
+
+	def db_for_read(self, model, **hints):
+		replicas = getattr(settings, 'DATABASE_REPLICAS', [])
+		instance = hints.get('instance')
+		if instance is not None and instance._state.db:
+			return instance._state.db  # follow the relations of an instance from the database it was read from
+		if not replicas or is_pinned() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+			return DEFAULT_DB_ALIAS
+		return random.choice(replicas)
+
+	def db_for_write(self, model, **hints):
+		_state.wrote = True
+		return DEFAULT_DB_ALIAS
+
+	def allow_relation(self, obj1, obj2, **hints):
+		return True
+
+	def allow_migrate(self, db, app_label, model_name = None, **hints):
+		return db == DEFAULT_DB_ALIAS
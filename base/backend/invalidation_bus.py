@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Cross-process cache invalidation through the CacheGeneration table.
+Every transaction writing to a model increments its row once it commits, and each worker polls the table before the
+first cached read of a request, at most every POLL_INTERVAL seconds, to find the models written to by the other
+workers. The requests that read no cache never poll. It needs nothing but the database, so it works on SQLite and
+Postgres alike.
+"""
+import logging
+import threading
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from base.backend.query_cache import query_cache
+from base.backend.state_registry import state_registry
+from base.models import CacheGeneration, State
+
+lgr = logging.getLogger(__name__)
+
+INSTANCE_LABEL = '_instance'  # the row whose random id tells the database apart from a reset or another database
+
+
+class InvalidationBus(object):
+	"""
+	Publishes "model X is at generation N" events and applies the events published by the other processes.
+	"""
+
+	def __init__(self):
+		super(InvalidationBus, self).__init__()
+		self._seen = None  # label => the last generation this process has seen
+		self._instance = None  # the id of the INSTANCE_LABEL row of the database the generations were seen in
+		self._polled = 0
+		self._lock = threading.Lock()
+		self._local = threading.local()  # whether the request served by the thread is still to be synced
+
+	@property
+	def config(self):
+		return getattr(settings, 'INVALIDATION_BUS', {})
+
+	@property
+	def enabled(self):
+		return self.config.get('ENABLED', False)
+
+	def publishes(self, model):
+		"""
+		Checks whether writes to the model are published to the other processes.
+		@param model: The model class that has been written to.
+		@return: True if the model belongs to one of the configured apps.
+		@rtype: bool
+		"""
+		return model is not CacheGeneration and model._meta.app_label in self.config.get('APPS', ('base', 'core'))
+
+	@staticmethod
+	def _instance_id(using):
+		"""
+		Creates the INSTANCE_LABEL row of a database that has none yet, e.g. after a reset, and retrieves its id.
+		"""
+		generations = CacheGeneration.objects.using(using)
+		try:
+			with transaction.atomic(using = using):
+				return str(generations.create(label = INSTANCE_LABEL).id)
+		except IntegrityError:  # another process has created it concurrently
+			return generations.filter(label = INSTANCE_LABEL).values_list('id', flat = True).first()
+
+	def publish(self, model, using = DEFAULT_DB_ALIAS):
+		"""
+		Moves the model to its next generation in the CacheGeneration table.
+		@param model: The model class that has been written to.
+		@param using: The database alias the write went to.
+		@type using: str
+		@return: True if the event was published, False otherwise.
+		@rtype: bool
+		"""
+		if not (self.enabled and self.publishes(model)):
+			return False
+		label = model._meta.label_lower
+		generations = CacheGeneration.objects.using(using or DEFAULT_DB_ALIAS)
+		for _ in range(2):  # a second pass covers another process having created the row concurrently
+			try:
+				with transaction.atomic(using = using):
+					if generations.filter(label = label).update(
+							generation = F('generation') + 1, date_modified = timezone.now()):
+						generation = generations.filter(label = label).values_list('generation', flat = True).first()
+					else:
+						generation = generations.create(label = label, generation = 1).generation
+				self._saw(label, generation)
+				return True
+			except IntegrityError:
+				continue
+			except Exception as e:
+				lgr.error('InvalidationBus publish exception: %s' % e)
+				break
+		return False
+
+	def _saw(self, label, generation):
+		"""
+		Records a generation this process has published itself, so that its shared generations cover its own writes
+		without waiting for the next poll.
+		"""
+		with self._lock:
+			if self._seen is not None and generation is not None and self._seen.get(label, 0) < generation:
+				self._seen[label] = generation
+
+	def generations(self, *labels):
+		"""
+		Retrieves the shared generations of the given models as of the last poll. Every process that has polled since
+		the same writes agrees on these, so they can version data shared between the processes.
+		@param labels: The labels of the models. e.g. 'core.risktype'
+		@return: The generations in the order of the labels or None if this process has not polled yet.
+		@rtype: tuple | None
+		"""
+		seen = self._seen
+		if not self.enabled or seen is None:
+			return None
+		return tuple(seen.get(label, 0) for label in labels)
+
+	def instance(self):
+		"""
+		Retrieves the identity of the database the generations belong to, so that data versioned with them is not
+		taken for current after the database is reset or by the processes of another database.
+		@return: The id of the instance row as of the last poll or None if this process has not polled yet.
+		@rtype: str | None
+		"""
+		if not self.enabled or self._seen is None:
+			return None
+		return self._instance
+
+	def versions(self, labels):
+		"""
+		Retrieves the shared generations of the given models followed by the identity of the database, which version
+		the entries of a cache shared between the processes, see QueryCache.make_key.
+		@param labels: The labels of the models.
+		@type labels: list
+		@return: The generations and the instance or None if any of the models is not published or this process has not
+		polled yet.
+		@rtype: tuple | None
+		"""
+		if not all(self.publishes(apps.get_model(label)) for label in labels):
+			return None
+		generations, instance = self.generations(*labels), self.instance()
+		if generations is None or instance is None:
+			return None
+		return generations + (instance, )
+
+	def request_started(self):
+		"""
+		Marks the request about to be served by the current thread as not synced yet, see sync.
+		"""
+		self._local.due = True
+
+	def request_finished(self):
+		self._local.due = None
+
+	def sync(self):
+		"""
+		Polls before a cached read. Within a request only the first cached read polls, outside of one, e.g. in the
+		threads of a batch or in a management command, every cached read may.
+		Either way the poll itself is skipped until POLL_INTERVAL seconds have elapsed since the previous one.
+		"""
+		due = getattr(self._local, 'due', None)
+		if not self.enabled or due is False:
+			return
+		if due:
+			self._local.due = False
+		self.poll()
+
+	def poll(self, using = DEFAULT_DB_ALIAS, force = False):
+		"""
+		Applies the writes committed by the other processes since the last poll.
+		The first poll only records the generations as the caches of a fresh process hold nothing stale. If the
+		database has been reset since the previous poll, every model is taken for written to.
+		@param using: The database alias holding the CacheGeneration table.
+		@type using: str
+		@param force: Whether to poll even if the poll interval has not elapsed.
+		@type force: bool
+		@return: The labels of the models that have been written to since the last poll.
+		@rtype: list
+		"""
+		changed = []
+		if not self.enabled:
+			return changed
+		now = time.time()
+		if not force and now - self._polled < self.config.get('POLL_INTERVAL', 1):
+			return changed
+		try:
+			with self._lock:
+				self._polled = now
+				rows = dict((label, (generation, pk)) for label, generation, pk in CacheGeneration.objects.using(
+					using).values_list('label', 'generation', 'id'))
+				instance = rows.pop(INSTANCE_LABEL)[1] if INSTANCE_LABEL in rows else self._instance_id(using)
+				rows = dict((label, generation) for label, (generation, _) in rows.items())
+				if self._seen is not None and instance != self._instance:
+					changed = sorted(set(self._seen) | set(rows))
+				elif self._seen is not None:
+					for label, generation in rows.items():
+						if self._seen.get(label) != generation:
+							changed.append(label)
+				self._seen, self._instance = rows, instance
+			for label in changed:
+				model = apps.get_model(label)
+				query_cache.bump(model)
+				if model is State:
+					state_registry.invalidate()
+		except Exception as e:
+			lgr.error('InvalidationBus poll exception: %s' % e)
+		return changed
+
+
+invalidation_bus = InvalidationBus()
+query_cache.publishers.append(invalidation_bus.publish)
+query_cache.readers.append(invalidation_bus.sync)
+query_cache.versions = invalidation_bus.versions
+state_registry.readers.append(invalidation_bus.sync)
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Keyset (cursor) pagination on (-date_created, id), optionally preceded by a column to sort on, see sorted_page.
+Each page seeks past the last row of the previous one instead of counting an OFFSET, so the cost of a page does not
+depend on how deep it is. The cursors handed to the clients are opaque url safe strings.
+"""
+import base64
+import json
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+
+KEY_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'  # fixed width, so the keys sort like the datetimes they encode
+ORDERING = ('-date_created', 'id')
+
+
+def page_limit(limit = None):
+	"""
+	Resolves the page size requested by a client within the PAGINATION settings.
+	The listings are always paginated, so a client that gives no limit gets the first DEFAULT_LIMIT rows and, if there
+	are more, the next_cursor to fetch them with.
+	@param limit: The requested number of rows. Defaults to the DEFAULT_LIMIT setting.
+	@type limit: str | int | None
+	@return: The number of rows to return, at most the MAX_LIMIT setting.
+	@rtype: int
+	@raise ValueError: If the limit is not a positive integer.
+	"""
+	config = getattr(settings, 'PAGINATION', {})
+	if limit in (None, ''):
+		return config.get('DEFAULT_LIMIT', 100)
+	limit = int(limit)
+	if limit < 1:
+		raise ValueError('limit must be a positive integer')
+	return min(limit, config.get('MAX_LIMIT', 1000))
+
+
+def row_key(date_created, pk):
+	"""
+	Builds the sort key of a row, comparable both ways round as plain strings.
+	@param date_created: The date_created of the row.
+	@type date_created: datetime
+	@param pk: The id of the row.
+	@type pk: str
+	@return: The UTC date_created in a fixed width format and the id.
+	@rtype: tuple
+	"""
+	if timezone.is_aware(date_created):
+		date_created = timezone.make_naive(date_created, timezone.utc)
+	return date_created.strftime(KEY_DATE_FORMAT), str(pk)
+
+
+def encode_cursor(key):
+	"""
+	Turns the key of the last row of a page into the cursor of the next page.
+	@param key: The key as returned by row_key.
+	@type key: tuple
+	@rtype: str
+	"""
+	return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _load_cursor(cursor):
+	padded = cursor + '=' * (-len(cursor) % 4)
+	return json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+
+
+def decode_cursor(cursor):
+	"""
+	Reads the key back from a cursor.
+	@param cursor: The cursor as returned by encode_cursor.
+	@type cursor: str
+	@return: The key of the last row of the previous page.
+	@rtype: tuple
+	@raise ValueError: If the cursor was not issued by encode_cursor.
+	"""
+	try:
+		date_created, pk = _load_cursor(cursor)
+		datetime.strptime(date_created, KEY_DATE_FORMAT)
+		return date_created, str(pk)
+	except Exception:
+		raise ValueError('Invalid cursor')
+
+
+def decode_sorted_cursor(cursor):
+	"""
+	Reads the sort value and the key back from the cursor of a sorted_page.
+	@param cursor: The cursor as returned by sorted_page.
+	@type cursor: str
+	@return: The sort value, the datetimes being read back, and the date_created and id of the last row.
+	@rtype: tuple
+	@raise ValueError: If the cursor was not issued by sorted_page.
+	"""
+	try:
+		value, date_created, pk = _load_cursor(cursor)
+		if isinstance(value, (bool, list, dict)):
+			raise ValueError(value)
+		return key_datetime(value) if isinstance(value, str) else value, key_datetime(date_created), str(pk)
+	except Exception:
+		raise ValueError('Invalid cursor')
+
+
+def key_datetime(value):
+	"""
+	Reads back a datetime formatted by row_key or sort_value.
+	@param value: The formatted datetime.
+	@type value: str
+	@rtype: datetime
+	@raise ValueError: If the value is not formatted as KEY_DATE_FORMAT.
+	"""
+	value = datetime.strptime(value, KEY_DATE_FORMAT)
+	if settings.USE_TZ:
+		value = timezone.make_aware(value, timezone.utc)
+	return value
+
+
+def sort_value(value):
+	"""
+	Turns the value of the sort column of a row into what its cursor holds, the datetimes formatted as in row_key.
+	"""
+	if isinstance(value, datetime):
+		if timezone.is_aware(value):
+			value = timezone.make_naive(value, timezone.utc)
+		return value.strftime(KEY_DATE_FORMAT)
+	return value
+
+
+def keyset_page(queryset, cursor = None, limit = None, key = None):
+	"""
+	Retrieves one page of a queryset ordered by (-date_created, id).
+	@param queryset: The queryset to paginate. Its rows must include date_created and id.
+	@type queryset: QuerySet
+	@param cursor: The next_cursor returned with the previous page, None for the first page.
+	@type cursor: str | None
+	@param limit: The number of rows of the page, see page_limit.
+	@type limit: str | int | None
+	@param key: Callable returning the date_created and id of a row, for the rows of a values_list() queryset.
+	@return: The rows of the page and the cursor of the next page, which is None on the last page.
+	@rtype: tuple
+	"""
+	limit = page_limit(limit)
+	queryset = queryset.order_by(*ORDERING)
+	if cursor:
+		date_created, pk = decode_cursor(cursor)
+		date_created = key_datetime(date_created)
+		queryset = queryset.filter(Q(date_created__lt = date_created) | Q(date_created = date_created, id__gt = pk))
+	rows = list(queryset[:limit + 1])
+	if len(rows) <= limit:
+		return rows, None
+	rows = rows[:limit]
+	last = rows[-1]
+	if key is not None:
+		return rows, encode_cursor(row_key(*key(last)))
+	if isinstance(last, dict):
+		return rows, encode_cursor(row_key(last['date_created'], last['id']))
+	return rows, encode_cursor(row_key(last.date_created, last.id))
+
+
+def sort_ordering(sort):
+	"""
+	Builds the order of the rows sorted on a column, then by (-date_created, id) among the rows that tie on it, the rows
+	whose column is null coming last, see sorted_page.
+	@param sort: The column to sort on, prefixed with - for the descending order. e.g. -risk_count
+	@type sort: str
+	@return: The order_by() arguments.
+	@rtype: tuple
+	"""
+	column = sort.lstrip('-')
+	if sort.startswith('-'):
+		return (F(column).desc(nulls_last = True), ) + ORDERING
+	return (F(column).asc(nulls_last = True), ) + ORDERING
+
+
+def sorted_page(queryset, sort, cursor = None, limit = None, key = None):
+	"""
+	Retrieves one page of a queryset ordered by a column, then by (-date_created, id) among the rows that tie on it.
+	The rows whose column is null come last, whichever way it is sorted.
+	@param queryset: The queryset to paginate. Its rows must include the sort column, date_created and id.
+	@type queryset: QuerySet
+	@param sort: The column to sort on, or an annotation, prefixed with - for the descending order. e.g. -risk_count
+	The column must hold numbers or datetimes.
+	@type sort: str
+	@param cursor: The next_cursor returned with the previous page of the same sort, None for the first page.
+	@type cursor: str | None
+	@param limit: The number of rows of the page, see page_limit.
+	@type limit: str | int | None
+	@param key: Callable returning the sort value, date_created and id of a row, for the rows of a values_list()
+	queryset.
+	@return: The rows of the page and the cursor of the next page, which is None on the last page.
+	@rtype: tuple
+	@raise ValueError: If the cursor was not issued by sorted_page.
+	"""
+	limit = page_limit(limit)
+	column, descending = sort.lstrip('-'), sort.startswith('-')
+	queryset = queryset.order_by(*sort_ordering(sort))
+	if cursor:
+		value, date_created, pk = decode_sorted_cursor(cursor)
+		ties = Q(date_created__lt = date_created) | Q(date_created = date_created, id__gt = pk)
+		nulls = Q(**{'%s__isnull' % column: True})
+		if value is None:
+			queryset = queryset.filter(nulls & ties)
+		else:
+			queryset = queryset.filter(
+				Q(**{'%s__%s' % (column, 'lt' if descending else 'gt'): value}) | Q(**{column: value}) & ties | nulls)
+	rows = list(queryset[:limit + 1])
+	if len(rows) <= limit:
+		return rows, None
+	rows = rows[:limit]
+	last = rows[-1]
+	if key is not None:
+		value, date_created, pk = key(last)
+	elif isinstance(last, dict):
+		value, date_created, pk = last[column], last['date_created'], last['id']
+	else:
+		value, date_created, pk = getattr(last, column), last.date_created, last.id
+	return rows, encode_cursor((sort_value(value), ) + row_key(date_created, pk))
+
+
+def _follows(key, cursor_key):
+	"""
+	Checks whether a row comes after the cursor in (-date_created, id) order.
+	"""
+	return key[0] < cursor_key[0] or (key[0] == cursor_key[0] and key[1] > cursor_key[1])
+
+
+def keyset_slice(rows, keys, cursor = None, limit = None):
+	"""
+	Retrieves one page of rows already held in memory in (-date_created, id) order, with the same cursors as
+	keyset_page so that the clients can switch between both freely.
+	@param rows: The ordered rows.
+	@type rows: list
+	@param keys: The row_key of each row, as lists or tuples.
+	@type keys: list
+	@param cursor: The next_cursor returned with the previous page, None for the first page.
+	@type cursor: str | None
+	@param limit: The number of rows of the page, see page_limit.
+	@type limit: str | int | None
+	@return: The rows of the page and the cursor of the next page, which is None on the last page.
+	@rtype: tuple
+	"""
+	limit = page_limit(limit)
+	start = 0
+	if cursor:
+		after, end = decode_cursor(cursor), len(keys)
+		while start < end:  # binary search for the first row past the cursor
+			middle = (start + end) // 2
+			if _follows(keys[middle], after):
+				end = middle
+			else:
+				start = middle + 1
+	end = start + limit
+	if end >= len(rows):
+		return rows[start:], None
+	return rows[start:end], encode_cursor(keys[end - 1])
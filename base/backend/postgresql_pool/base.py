@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+PostgreSQL backend that takes its connections from a per-process ConnectionPool instead of opening one per request.
+Set the ENGINE of an alias to 'base.backend.postgresql_pool' and tune the pool through its POOL settings, e.g.
+'POOL': {'MAX_SIZE': 10, 'TIMEOUT': 5, 'VALIDATE_AFTER': 30, 'MAX_LIFETIME': 3600}
+With CONN_MAX_AGE = 0, Django closes the connection at the end of each request, which hands it back to the pool.
+"""
+from django.db.backends.postgresql.base import Database, DatabaseWrapper as PostgresDatabaseWrapper
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+
+from base.backend.db_pool import ConnectionPool, PoolTimeout, get_pool
+
+
+def validate(connection):
+	"""
+	Checks that an idle connection still talks to the server.
+	"""
+	if connection.closed:
+		return False
+	with connection.cursor() as cursor:
+		cursor.execute('SELECT 1')
+	return True
+
+
+def reset(connection):
+	"""
+	Rolls back whatever a released connection left open. Connections in an unknown state are discarded.
+	"""
+	if connection.closed:
+		return False
+	status = connection.get_transaction_status()
+	if status == TRANSACTION_STATUS_UNKNOWN:
+		return False
+	if status != TRANSACTION_STATUS_IDLE:
+		connection.rollback()
+	return True
+
+
+class DatabaseWrapper(PostgresDatabaseWrapper):
+	"""
+	PostgreSQL DatabaseWrapper whose connections are checked out of and released to the pool of its alias.
+	"""
+
+	@property
+	def pool(self):
+		conn_params = self.get_connection_params()
+		config = self.settings_dict.get('POOL', {})
+		return get_pool(self.alias, lambda: ConnectionPool(
+			lambda: Database.connect(**conn_params), validate = validate, reset = reset,
+			max_size = config.get('MAX_SIZE', 10), timeout = config.get('TIMEOUT', 5),
+			validate_after = config.get('VALIDATE_AFTER', 30), max_lifetime = config.get('MAX_LIFETIME', 3600),
+			warn_wait = config.get('WARN_WAIT', 0.1)))
+
+	def get_new_connection(self, conn_params):
+		try:
+			connection = self.pool.acquire()
+		except PoolTimeout as e:
+			raise Database.OperationalError(str(e))
+		# same isolation level handling as the stock backend, see PostgresDatabaseWrapper.get_new_connection
+		options = self.settings_dict['OPTIONS']
+		try:
+			self.isolation_level = options['isolation_level']
+		except KeyError:
+			self.isolation_level = connection.isolation_level
+		else:
+			if self.isolation_level != connection.isolation_level:
+				connection.set_session(isolation_level = self.isolation_level)
+		return connection
+
+	def _close(self):
+		if self.connection is not None:
+			with self.wrap_database_errors:
+				self.pool.release(self.connection, discard = self.errors_occurred and not self.is_usable())
@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+"""
+Read-through cache for the queries issued through ServiceBase.
+Results are keyed on the model, the compiled query and a generation counter for every model the query touches.
+Writing a model bumps its generation, so stale entries are simply never looked up again and age out of the backend.
+The entries of a backend shared between processes outlive the generations of any one process, so they are keyed on the
+generations published through the invalidation bus instead and are only cached while it is enabled.
+"""
+import hashlib
+import logging
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import EmptyResultSet
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.db.models import Manager
+from django.db.models.query import QuerySet
+from django.db.models.sql import Query
+from django.utils.module_loading import import_string
+
+from base.backend.db_router import pin_primary
+from base.backend.single_flight import single_flight
+
+lgr = logging.getLogger(__name__)
+
+
+class LocMemLRUBackend(object):
+	"""
+	In-process least recently used store, bounded by the number of entries and by the size of the pickled values.
+	"""
+	shared = False  # whether the entries are seen by the other processes
+
+	def __init__(self, max_entries = 1024, max_bytes = 16 * 1024 * 1024):
+		"""
+		@param max_entries: The maximum number of entries kept before the least recently used are evicted.
+		@type max_entries: int
+		@param max_bytes: The maximum total size of the pickled values kept before the least recently used are evicted.
+		@type max_bytes: int
+		"""
+		super(LocMemLRUBackend, self).__init__()
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self._entries = OrderedDict()
+		self._bytes = 0
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return len(self._entries)
+
+	def get(self, key):
+		"""
+		Retrieves a value from the store.
+		@param key: The cache key.
+		@type key: str
+		@return: A tuple of whether the key was found and the value stored for it.
+		@rtype: tuple
+		"""
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				return False, None
+			expires, data = entry
+			if expires is not None and expires < time.time():
+				self._discard(key)
+				return False, None
+			self._entries.move_to_end(key)
+		return True, pickle.loads(data)
+
+	def set(self, key, value, ttl = None):
+		"""
+		Stores a value, evicting the least recently used entries if the store is full.
+		@param key: The cache key.
+		@type key: str
+		@param value: The value to store. It is pickled so that callers can never mutate the cached copy.
+		@param ttl: The number of seconds the value stays valid. None to keep it until it is evicted.
+		@type ttl: int | None
+		"""
+		data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+		if len(data) > self.max_bytes:
+			return
+		with self._lock:
+			self._discard(key)
+			self._entries[key] = (time.time() + ttl if ttl else None, data)
+			self._bytes += len(data)
+			while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+				self._discard(next(iter(self._entries)))
+
+	def _discard(self, key):
+		entry = self._entries.pop(key, None)
+		if entry is not None:
+			self._bytes -= len(entry[1])
+
+	def clear(self):
+		"""
+		Removes all the entries.
+		"""
+		with self._lock:
+			self._entries.clear()
+			self._bytes = 0
+
+
+class DjangoCacheBackend(object):
+	"""
+	Stores the entries in one of the caches configured in the CACHES setting.
+	"""
+	shared = True
+	_missing = object()
+
+	def __init__(self, alias = 'default'):
+		"""
+		@param alias: The CACHES alias to store the entries in.
+		@type alias: str
+		"""
+		super(DjangoCacheBackend, self).__init__()
+		self.alias = alias
+
+	def __len__(self):
+		return 0
+
+	@property
+	def cache(self):
+		return caches[self.alias]
+
+	def get(self, key):
+		value = self.cache.get(key, self._missing)
+		if value is self._missing:
+			return False, None
+		return True, value
+
+	def set(self, key, value, ttl = None):
+		self.cache.set(key, value, ttl)
+
+	def clear(self):
+		self.cache.clear()
+
+
+class QueryCache(object):
+	"""
+	Holds the cache backend, the per-model generations and the hit/miss counters.
+	"""
+
+	def __init__(self, backend = None):
+		"""
+		@param backend: The store for the cached results. Built from the QUERY_CACHE setting when None.
+		@type backend: LocMemLRUBackend | DjangoCacheBackend | None
+		"""
+		super(QueryCache, self).__init__()
+		self._backend = backend
+		self._generations = {}
+		self._tables = None
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.publishers = []  # callables notified with (model, using) once a write to a model is committed
+		self.readers = []  # callables run before a cached read, e.g. to apply the writes of the other processes
+		self.versions = None  # callable retrieving the generations of labels shared by every process, see make_key
+
+	@property
+	def config(self):
+		return getattr(settings, 'QUERY_CACHE', {})
+
+	@property
+	def enabled(self):
+		return self.config.get('ENABLED', True)
+
+	@property
+	def backend(self):
+		if self._backend is None:
+			backend = self.config.get('BACKEND', 'base.backend.query_cache.LocMemLRUBackend')
+			self._backend = import_string(backend)(**self.config.get('OPTIONS', {}))
+		return self._backend
+
+	def generation(self, model):
+		"""
+		Retrieves the current generation of a model.
+		@param model: The model class.
+		@return: The number of times the model has been written to since the process started.
+		@rtype: int
+		"""
+		return self._generations.get(model._meta.label_lower, 0)
+
+	def bump(self, model):
+		"""
+		Moves the model to its next generation so that every cached query touching it is missed from now on.
+		@param model: The model class that has been written to.
+		"""
+		with self._lock:
+			label = model._meta.label_lower
+			self._generations[label] = self._generations.get(label, 0) + 1
+
+	def invalidate(self, model, using = DEFAULT_DB_ALIAS):
+		"""
+		Bumps the model generation now and again once the current transaction commits, so that a read racing the
+		write cannot cache the pre-commit rows under the new generation. The publishers are told about the write once
+		it is committed, once per transaction however many times it writes to the model.
+		@param model: The model class that has been written to.
+		@param using: The database alias the write went to.
+		@type using: str
+		"""
+		self.bump(model)
+		using = using or DEFAULT_DB_ALIAS
+		label = model._meta.label_lower
+		if any(getattr(pending, 'invalidates', None) == label for _, pending in connections[using].run_on_commit):
+			return
+
+		def committed():
+			self.bump(model)
+			for publish in self.publishers:
+				publish(model, using)
+
+		committed.invalidates = label
+		transaction.on_commit(committed, using = using)
+
+	def prepare(self):
+		"""
+		Runs the readers before a cached read.
+		"""
+		for reader in self.readers:
+			reader()
+
+	def stats(self):
+		"""
+		Retrieves the counters of the cache.
+		@return: The hits, misses and the number of entries currently held.
+		@rtype: dict
+		"""
+		return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.backend)}
+
+	def _model_for_table(self, table):
+		if self._tables is None:
+			self._tables = dict((m._meta.db_table, m) for m in apps.get_models())
+		return self._tables.get(table)
+
+	@staticmethod
+	def _select_related_models(model, select_related):
+		"""
+		Resolves the models joined through the select_related of a queryset, e.g. {'risk_type': {}}
+		"""
+		models = []
+		for name, nested in select_related.items():
+			related = model._meta.get_field(name).related_model
+			models.append(related)
+			if nested:
+				models.extend(QueryCache._select_related_models(related, nested))
+		return models
+
+	@staticmethod
+	def _prefetch_models(model, lookups):
+		"""
+		Resolves the models reached through the prefetch_related lookups of a queryset, including the ones joined by
+		the select_related of the queryset of a Prefetch.
+		"""
+		models = []
+		for lookup in lookups:
+			current = model
+			for part in getattr(lookup, 'prefetch_through', lookup).split('__'):
+				related = None
+				for field in current._meta.get_fields():
+					if field.is_relation and part in (field.name, getattr(field, 'get_accessor_name', lambda: None)()):
+						related = field.related_model
+						break
+				if related is None:
+					break
+				models.append(related)
+				current = related
+			queryset = getattr(lookup, 'queryset', None)
+			if queryset is not None and isinstance(queryset.query.select_related, dict):
+				models.extend(QueryCache._select_related_models(queryset.model, queryset.query.select_related))
+		return models
+
+	def _query_models(self, node, models):
+		"""
+		Collects the models of the tables read by a query, including the ones only read by its subqueries, e.g. through
+		filter(id__in = queryset) or an Exists annotation.
+		@param node: The query or one of the nodes of its where clause and annotations.
+		@param models: The set the models are added to.
+		@type models: set
+		"""
+		if isinstance(node, QuerySet):
+			node = node.query
+		if isinstance(node, Query):
+			for join in node.alias_map.values():
+				model = self._model_for_table(join.table_name)
+				if model is not None:
+					models.add(model)
+			children = [node.where] + list(node.annotations.values()) + list(node.combined_queries)
+		elif isinstance(node, (list, tuple)):
+			children = node
+		elif getattr(node, 'queryset', None) is not None:  # Subquery and Exists
+			children = [node.queryset]
+		else:
+			children = list(getattr(node, 'children', [])) + [getattr(node, 'lhs', None), getattr(node, 'rhs', None)]
+			if hasattr(node, 'get_source_expressions'):
+				children.extend(node.get_source_expressions())
+		for child in children:
+			if child is not None and not isinstance(child, (str, bytes, int, float)):
+				self._query_models(child, models)
+
+	def key_generations(self, models):
+		"""
+		Retrieves the generations the keys of the entries read from some models are built from, i.e. those published
+		through the invalidation bus and the identity of the database for a shared backend, see make_key.
+		@param models: The model classes the entry is read from.
+		@type models: set | list | tuple
+		@return: The generation of each model label, sorted, or None if the entry must not be cached.
+		@rtype: list | None
+		"""
+		labels = sorted(set(m._meta.label_lower for m in models))
+		if not getattr(self.backend, 'shared', False):
+			return [(label, self._generations.get(label, 0)) for label in labels]
+		versions = self.versions(labels) if self.versions is not None else None
+		if versions is None:  # nothing tells the entries of this database and of the current writes apart
+			return None
+		return list(zip(labels, versions[:-1])) + [('instance', versions[-1])]
+
+	def make_key(self, queryset):
+		"""
+		Builds the cache key of a queryset from its model, compiled SQL and the generations of the models it touches.
+		The keys of a shared backend use the generations published through the invalidation bus, along with the
+		identity of the database, as every process agrees on those while its own generations only count the writes it
+		has seen since it started.
+		@param queryset: The queryset about to be evaluated.
+		@type queryset: QuerySet
+		@return: The cache key or None if the queryset must not be cached.
+		@rtype: str | None
+		"""
+		query = queryset.query
+		# locked reads and reads inside a transaction may see rows that are never committed
+		if query.select_for_update or connections[queryset.db].in_atomic_block:
+			return None
+		try:
+			statement, params = query.get_compiler(using = queryset.db).as_sql()
+		except EmptyResultSet:
+			return None
+		models = set([queryset.model] + self._prefetch_models(queryset.model, queryset._prefetch_related_lookups))
+		self._query_models(query, models)
+		for lookup in queryset._prefetch_related_lookups:
+			if getattr(lookup, 'queryset', None) is not None:
+				self._query_models(lookup.queryset.query, models)
+		generations = self.key_generations(models)
+		if generations is None:
+			return None
+		digest = hashlib.sha1(repr((
+			queryset.db, statement, params, queryset._iterable_class.__name__, queryset._fields,
+			[getattr(lookup, 'prefetch_to', lookup) for lookup in queryset._prefetch_related_lookups],
+			generations)).encode('utf-8')).hexdigest()
+		return 'qc:%s:%s' % (queryset.model._meta.label_lower, digest)
+
+	def get(self, key):
+		found, value = self.backend.get(key)
+		if found:
+			self.hits += 1
+		else:
+			self.misses += 1
+		return found, value
+
+	def set(self, key, value, ttl = None):
+		try:
+			self.backend.set(key, value, ttl)
+		except Exception as e:
+			lgr.warning('QueryCache set exception: %s' % e)
+
+
+query_cache = QueryCache()
+
+
+class CachedQuerySet(QuerySet):
+	"""
+	QuerySet that serves its results from the query cache, falling back to the db on a miss.
+	"""
+	cache_ttl = None
+
+	def _clone(self):
+		clone = super(CachedQuerySet, self)._clone()
+		clone.cache_ttl = self.cache_ttl
+		return clone
+
+	def _fetch_all(self):
+		if self._result_cache is None and self.cache_ttl and query_cache.enabled:
+			query_cache.prepare()
+			# the entries are filled from the primary, as a lagging replica would cache rows older than the generations
+			# they are keyed on, and they are shared by the reads of every database alias
+			with pin_primary():
+				key = query_cache.make_key(self)
+				if key is not None:
+					found, results = query_cache.get(key)
+					if not found:
+						# concurrent misses of the same key wait for a single query instead of all hitting the db
+						results = single_flight.do(key, lambda: self._fetch_miss(key))
+					self._result_cache = results
+					self._prefetch_done = True
+					return
+		super(CachedQuerySet, self)._fetch_all()
+
+	def _fetch_miss(self, key):
+		"""
+		Runs the query of a missed key and caches the results, unless another process has cached them while this one
+		was waiting for its turn.
+		"""
+		found, results = query_cache.backend.get(key)
+		if found:
+			return results
+		super(CachedQuerySet, self)._fetch_all()
+		query_cache.set(key, self._result_cache, self.cache_ttl)
+		return self._result_cache
+
+
+def cache_queryset(queryset, ttl):
+	"""
+	Turns a manager or queryset into a CachedQuerySet that reads through the query cache.
+	@param queryset: The manager or queryset to cache.
+	@type queryset: Manager | QuerySet
+	@param ttl: The number of seconds the results stay cached.
+	@type ttl: int
+	@return: The cached copy of the queryset.
+	@rtype: CachedQuerySet
+	"""
+	if isinstance(queryset, Manager):
+		queryset = queryset.all()
+	clone = CachedQuerySet(
+		model = queryset.model, query = queryset.query.chain(), using = queryset._db, hints = queryset._hints)
+	clone._sticky_filter = queryset._sticky_filter
+	clone._for_write = queryset._for_write
+	clone._prefetch_related_lookups = queryset._prefetch_related_lookups[:]
+	clone._known_related_objects = queryset._known_related_objects
+	clone._iterable_class = queryset._iterable_class
+	clone._fields = queryset._fields
+	clone.cache_ttl = ttl
+	return clone
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Single-pass parsing and validation of the request bodies.
+The body is decoded once, bounded by REQUEST_PARSER MAX_BODY_SIZE, and checked against the schema declared for the
+endpoint before any of it reaches the Interface. A schema maps each field to its rules, e.g.
+{'name': {'type': str, 'required': True, 'max_length': 100}, 'fields': {'type': list, 'items': {...}}}
+"""
+import copy
+import json
+import logging
+from datetime import datetime
+
+from django.conf import settings
+from django.core.exceptions import RequestDataTooBig
+
+lgr = logging.getLogger(__name__)
+
+
+class RequestError(Exception):
+	"""
+	Raised when a request body cannot be decoded or does not match the schema of its endpoint.
+	"""
+
+	def __init__(self, message, errors = None, status = 400):
+		"""
+		@param message: The message returned to the client.
+		@type message: str
+		@param errors: The error of each invalid field, keyed by the path of the field. e.g. {'fields.0.caption': '...'}
+		@type errors: dict | None
+		@param status: The HTTP status of the response.
+		@type status: int
+		"""
+		super(RequestError, self).__init__(message)
+		self.message = message
+		self.errors = errors or {}
+		self.status = status
+
+
+def max_body_size():
+	return getattr(settings, 'REQUEST_PARSER', {}).get('MAX_BODY_SIZE', 256 * 1024)
+
+
+def decode_request(request, max_size = None):
+	"""
+	Decodes the data of a request whatever its method and content type, reading the body at most once.
+	@param request: The Django HttpRequest, or the DRF Request wrapping it.
+	@type request: WSGIRequest
+	@param max_size: The maximum number of bytes of the body. Defaults to REQUEST_PARSER MAX_BODY_SIZE.
+	@type max_size: int | None
+	@return: The data of the request.
+	@rtype: dict
+	@raise RequestError: If the body is too large or is not valid JSON.
+	"""
+	max_size = max_body_size() if max_size is None else max_size
+	meta = getattr(request, 'META', {})
+	try:
+		length = int(meta.get('CONTENT_LENGTH') or 0)
+	except ValueError:
+		length = 0
+	if length > max_size:
+		raise RequestError('Request body exceeds %s bytes' % max_size, status = 413)
+	content_type = meta.get('CONTENT_TYPE', '').split(';')[0].strip().lower()
+	try:
+		if content_type in ('multipart/form-data', 'application/x-www-form-urlencoded'):
+			return request.POST.dict()
+		if getattr(request, 'method', None) == 'GET':
+			return request.GET.dict()
+		body = request.body
+	except RequestDataTooBig:
+		raise RequestError('Request body exceeds %s bytes' % settings.DATA_UPLOAD_MAX_MEMORY_SIZE, status = 413)
+	if len(body) > max_size:
+		raise RequestError('Request body exceeds %s bytes' % max_size, status = 413)
+	if not body:
+		return {}
+	try:
+		data = json.loads(body.decode('utf-8'))
+	except (ValueError, UnicodeDecodeError):
+		raise RequestError('Request body is not valid JSON')
+	if not isinstance(data, dict):
+		raise RequestError('Request body must be a JSON object')
+	return data
+
+
+def _check(value, rules, path, errors):
+	"""
+	Checks a value against its rules, recording the error of the value and of everything nested in it.
+	"""
+	expected = rules.get('type')
+	if expected is not None:
+		if expected is int and isinstance(value, bool) or not isinstance(value, expected):
+			names = expected if isinstance(expected, tuple) else (expected, )
+			errors[path] = 'must be of type %s' % ' or '.join(t.__name__ for t in names)
+			return
+	if 'choices' in rules and value not in rules['choices']:
+		errors[path] = 'must be one of %s' % ', '.join(str(choice) for choice in rules['choices'])
+	elif 'max_length' in rules and hasattr(value, '__len__') and len(value) > rules['max_length']:
+		errors[path] = 'must have at most %s items' % rules['max_length'] if isinstance(value, list) else \
+			'must be at most %s characters' % rules['max_length']
+	elif 'format' in rules:
+		try:
+			datetime.strptime(value, rules['format'])
+		except (TypeError, ValueError):
+			errors[path] = 'must match the format %s' % rules['format']
+	if isinstance(value, list) and 'items' in rules:
+		for index, item in enumerate(value):
+			_check(item, rules['items'], '%s.%s' % (path, index), errors)
+	elif isinstance(value, dict) and 'fields' in rules:
+		errors.update(validate(value, rules['fields'], path))
+
+
+def validate(data, schema, prefix = ''):
+	"""
+	Validates data against a schema, keeping only the declared fields.
+	@param data: The decoded data.
+	@type data: dict
+	@param schema: The rules of each field: type, required, default (copied into the data, so that a mutable one is
+	never shared between requests), choices, max_length, format (a strptime format), aliases (other names the field is
+	accepted under), items (the rules of the items of a list) and fields (the schema of a nested dict).
+	@type schema: dict
+	@param prefix: The path of the data within the request, for the error keys.
+	@type prefix: str
+	@return: The errors keyed by the path of the field, empty if the data is valid.
+	@rtype: dict
+	"""
+	errors = {}
+	for field, rules in schema.items():
+		path = '%s.%s' % (prefix, field) if prefix else field
+		value = data.get(field)
+		for alias in rules.get('aliases', ()):
+			if value is None:
+				value = data.pop(alias, None)
+		if value is None or value == '':
+			if rules.get('required'):
+				errors[path] = 'is required'
+			data[field] = copy.deepcopy(rules.get('default'))
+			continue
+		data[field] = value
+		_check(value, rules, path, errors)
+	for field in [field for field in data if field not in schema]:
+		del data[field]
+	return errors
+
+
+def parse_request(request, schema, max_size = None):
+	"""
+	Decodes and validates the data of a request in a single pass.
+	@param request: The Django HttpRequest, or the DRF Request wrapping it.
+	@type request: WSGIRequest
+	@param schema: The schema of the endpoint, see validate.
+	@type schema: dict
+	@param max_size: The maximum number of bytes of the body.
+	@type max_size: int | None
+	@return: The validated data, holding every field of the schema.
+	@rtype: dict
+	@raise RequestError: If the body cannot be decoded or does not match the schema.
+	"""
+	data = decode_request(request, max_size)
+	errors = validate(data, schema)
+	if errors:
+		raise RequestError('Invalid request', errors)
+	return data
@@ -4,6 +4,13 @@ All the CRUD methods in the DB are handled in this file
 """
 import logging
 
+from django.db import connections, router, transaction
+from django.db.models import Case, F, Model, Value, When
+from django.utils import timezone
+
+from base.backend.query_cache import cache_queryset, query_cache
+from base.backend.state_registry import state_registry
+
 lgr = logging.getLogger(__name__)
 
 
@@ -12,6 +19,11 @@ class ServiceBase(object):
 	Handles the processes in reading and writing into the database
 	"""
 	manager = None
+	batch_size = 500  # the number of rows written per statement by the bulk methods
+	# named projections a caller can ask get/filter for, e.g.
+	# {'label': {'select_related': ('risk_type',), 'prefetch_related': (), 'only': ('id', 'risk_type__name')}}
+	profiles = {}
+	cache_ttl = None  # seconds get/filter results are served from the query cache. None to always hit the db
 
 	def __init__(self, lock_for_update = False, *args, **annotations):
 		"""
@@ -37,16 +49,61 @@ class ServiceBase(object):
 		if annotations:
 			self.manager = self.manager.annotate(**annotations)
 
+	def resolve_states(self, kwargs):
+		"""
+		Rewrites state__name lookups into state_id IN (...) lookups using the in-memory State registry.
+		This saves us the join to the State table on every read.
+		@param kwargs: The key=>value lookups as passed to get or filter.
+		@type kwargs: dict
+		@return: The lookups with the state names resolved to ids.
+		@rtype: dict
+		"""
+		if 'state__name' not in kwargs and 'state__name__in' not in kwargs:
+			return kwargs
+		kwargs = dict(kwargs)
+		state_ids = None
+		if 'state__name' in kwargs:
+			state_ids = state_registry.ids(kwargs.pop('state__name'))
+		if 'state__name__in' in kwargs:
+			in_ids = state_registry.ids(*kwargs.pop('state__name__in'))
+			state_ids = in_ids if state_ids is None else tuple(i for i in state_ids if i in in_ids)
+		kwargs['state_id__in'] = state_ids
+		return kwargs
+
+	def profiled(self, profile = None):
+		"""
+		Applies the select_related, prefetch_related and only() column sets declared for the given profile.
+		If the service sets a cache_ttl, the reads go through the query cache.
+		@param profile: The name of the profile as declared in the service profiles. None for the plain manager.
+		@type profile: str | None
+		@return: The manager narrowed down to the columns and joins of the profile.
+		@raise KeyError: If the service does not declare the profile.
+		"""
+		manager = self.manager
+		if self.cache_ttl:
+			manager = cache_queryset(manager, self.cache_ttl)
+		if profile is None:
+			return manager
+		projection = self.profiles[profile]
+		if projection.get('select_related'):
+			manager = manager.select_related(*projection['select_related'])
+		if projection.get('prefetch_related'):
+			manager = manager.prefetch_related(*projection['prefetch_related'])
+		if projection.get('only'):
+			manager = manager.only(*projection['only'])
+		return manager
+
 	def get(self, *args, **kwargs):
 		"""
 		This method gets a single record from the DB using the manager.
 		@param args: Arguments to pass to the get method.
-		@param kwargs: key=>value methods to pass to the get method.
+		@param kwargs: key=>value methods to pass to the get method. A profile key selects one of the service profiles.
 		@return: Manager object instance or None on error.
 		"""
 		try:
 			if self.manager is not None:
-				return self.manager.get(*args, **kwargs)
+				profile = kwargs.pop('profile', None)
+				return self.profiled(profile).get(*args, **self.resolve_states(kwargs))
 		except self.manager.model.DoesNotExist:
 			pass
 		except Exception as e:
@@ -57,13 +114,15 @@ class ServiceBase(object):
 		"""
 		This method returns a queryset of the objects as from the manager.
 		@param args: Arguments to pass to the filter method.
-		@param kwargs: key=>value methods to pass to the filter method.
+		@param kwargs: key=>value methods to pass to the filter method. A profile key selects one of the service
+		profiles.
 		@return: Queryset or None on error
 		@rtype: Queryset | None
 		"""
 		try:
 			if self.manager is not None:
-				return self.manager.filter(*args, **kwargs)
+				profile = kwargs.pop('profile', None)
+				return self.profiled(profile).filter(*args, **self.resolve_states(kwargs))
 		except self.manager.model.DoesNotExist:
 			pass
 		except Exception as e:
@@ -91,7 +150,8 @@ class ServiceBase(object):
 		:return: The updated record or None on error.
 		"""
 		try:
-			record = self.get(id=pk)
+			# never update from a cached or replica copy of the record
+			record = self.manager.using(router.db_for_write(self.manager.model)).filter(id = pk).first()
 			if record is not None:
 				for k, v in kwargs.items():
 					setattr(record, k, v)
@@ -101,3 +161,304 @@ class ServiceBase(object):
 		except Exception as e:
 			lgr.error('%sService update exception: %s' % (self.manager.model.__name__, e))
 		return None
+
+	@staticmethod
+	def _supports_returning(connection):
+		"""
+		Checks whether the database can hand back the written row in the same statement via UPDATE ... RETURNING.
+		@param connection: The database connection the statement will run on.
+		@return: True if RETURNING is supported, False otherwise.
+		@rtype: bool
+		"""
+		if connection.vendor == 'postgresql':
+			return True
+		if connection.vendor == 'sqlite':
+			return connection.Database.sqlite_version_info >= (3, 35, 0)
+		return False
+
+	def update_columns(self, pk, expected_modified = None, **kwargs):
+		"""
+		Updates only the given columns of the record in one UPDATE ... WHERE id = %s [AND date_modified = %s] statement.
+		Where the database supports RETURNING, the new row comes back from the same statement, so there is no refetch.
+		Elsewhere the row is read back from the database written to, never from the query cache or a replica.
+		@param pk: The id for the record to update.
+		@param expected_modified: The date_modified of the record as last read by the caller. If provided and the record
+		has been modified since, nothing is written and the conflict is reported.
+		@type expected_modified: datetime | None
+		@param kwargs: The params to update the record with, plain values keyed by field name or attname.
+		@return: The updated record, False if the record changed since expected_modified or None on error.
+		@rtype: Model | bool | None
+		"""
+		try:
+			if self.manager is not None:
+				model = self.manager.model
+				using = router.db_for_write(model)
+				connection = connections[using]
+				quote = connection.ops.quote_name
+				for field in model._meta.concrete_fields:
+					if getattr(field, 'auto_now', False) and field.name not in kwargs and field.attname not in kwargs:
+						kwargs[field.name] = timezone.now()
+				columns, params = [], []
+				for name, value in kwargs.items():
+					field = model._meta.get_field(name)
+					if field.is_relation and isinstance(value, Model):
+						value = value.pk
+					columns.append('%s = %%s' % quote(field.column))
+					params.append(field.get_db_prep_save(value, connection))
+				where = ['%s = %%s' % quote(model._meta.pk.column)]
+				params.append(model._meta.pk.get_db_prep_value(model._meta.pk.to_python(pk), connection))
+				if expected_modified is not None:
+					date_modified = model._meta.get_field('date_modified')
+					where.append('%s = %%s' % quote(date_modified.column))
+					params.append(date_modified.get_db_prep_value(expected_modified, connection))
+				statement = 'UPDATE %s SET %s WHERE %s' % (
+					quote(model._meta.db_table), ', '.join(columns), ' AND '.join(where))
+				record = None
+				if self._supports_returning(connection):
+					fields = model._meta.concrete_fields
+					statement += ' RETURNING %s' % ', '.join(quote(field.column) for field in fields)
+					with connection.cursor() as cursor:
+						cursor.execute(statement, params)
+						row = cursor.fetchone()
+					if row is not None:
+						values = []
+						for value, field in zip(row, fields):
+							column = field.get_col(model._meta.db_table)
+							for converter in connection.ops.get_db_converters(column) + column.get_db_converters(
+									connection):
+								value = converter(value, column, connection)
+							values.append(value)
+						record = model.from_db(using, [field.attname for field in fields], values)
+				else:
+					with connection.cursor() as cursor:
+						cursor.execute(statement, params)
+						updated = cursor.rowcount
+					if updated:
+						record = self.manager.using(using).filter(pk = pk).first()
+				query_cache.invalidate(model, using)
+				if record is not None:
+					return record
+				if expected_modified is not None and self.manager.using(using).filter(pk = pk).exists():
+					lgr.warning('%sService update_columns conflict on %s' % (model.__name__, pk))
+					return False
+		except Exception as e:
+			lgr.error('%sService update_columns exception: %s' % (self.manager.model.__name__, e))
+		return None
+
+	def _batches(self, rows, batch_size = None):
+		"""
+		Splits the rows into chunks of batch_size, keeping the position of each row in the original list.
+		@param rows: The rows to split.
+		@type rows: list
+		@param batch_size: The number of rows per chunk. Defaults to the service batch_size.
+		@type batch_size: int | None
+		@return: A generator of lists of (index, row) tuples.
+		"""
+		batch_size = batch_size or self.batch_size
+		indexed = list(enumerate(rows))
+		for start in range(0, len(indexed), batch_size):
+			yield indexed[start:start + batch_size]
+
+	def _update_values(self, row):
+		"""
+		Splits a bulk_update row into its primary key and the column => value pairs to write.
+		@param row: The key=>value pairs for the record. Must contain the id of the record.
+		@type row: dict
+		@return: A tuple of the primary key and the values keyed by column attname.
+		@rtype: tuple
+		"""
+		row = dict(row)
+		pk = row.pop('id', None)
+		if pk is None:
+			raise ValueError('id is required to update a record')
+		values = {}
+		for name, value in row.items():
+			field = self.manager.model._meta.get_field(name)
+			if field.is_relation and isinstance(value, Model):
+				value = value.pk
+			values[field.attname] = value
+		return str(pk), values
+
+	def _create_batch(self, indexed_rows, errors):
+		"""
+		Inserts a chunk of rows in a single statement and transaction.
+		If the statement fails, the rows are retried one by one so that only the offending rows are reported.
+		@param indexed_rows: The (index, row) tuples to insert.
+		@type indexed_rows: list
+		@param errors: The index => error message map to record the failed rows into.
+		@type errors: dict
+		@return: The (index, object) tuples for the rows that were inserted.
+		@rtype: list
+		"""
+		objects = []
+		for index, row in indexed_rows:
+			try:
+				objects.append((index, self.manager.model(**row)))
+			except Exception as e:
+				errors[index] = str(e)
+		if not objects:
+			return objects
+		try:
+			with transaction.atomic():
+				self.manager.bulk_create([obj for _, obj in objects])
+			return objects
+		except Exception as e:
+			lgr.warning('%sService bulk insert failed, retrying row by row: %s' % (self.manager.model.__name__, e))
+		created = []
+		for index, obj in objects:
+			try:
+				with transaction.atomic():
+					obj.save(force_insert = True)
+				created.append((index, obj))
+			except Exception as e:
+				errors[index] = str(e)
+		return created
+
+	def _update_batch(self, indexed_rows, errors):
+		"""
+		Updates a chunk of rows in a single UPDATE ... SET col = CASE id WHEN ... statement and transaction.
+		If the statement fails, the rows are retried one by one so that only the offending rows are reported.
+		@param indexed_rows: The (index, row) tuples to update. Each row must contain the id of the record.
+		@type indexed_rows: list
+		@param errors: The index => error message map to record the failed rows into.
+		@type errors: dict
+		@return: The (index, pk) tuples for the rows that were updated.
+		@rtype: list
+		"""
+		updates = []
+		for index, row in indexed_rows:
+			try:
+				updates.append((index,) + self._update_values(row))
+			except Exception as e:
+				errors[index] = str(e)
+		if not updates:
+			return []
+		meta = self.manager.model._meta
+		stamp = dict(
+			(f.attname, timezone.now()) for f in meta.concrete_fields if getattr(f, 'auto_now', False))
+		try:
+			with transaction.atomic():
+				existing = set(self.manager.filter(pk__in = [pk for _, pk, _ in updates]).values_list('pk', flat = True))
+				for index, pk, _ in updates:
+					if pk not in existing:
+						errors[index] = '%s matching query does not exist.' % self.manager.model.__name__
+				updates = [u for u in updates if u[1] in existing]
+				columns = set()
+				for _, _, values in updates:
+					columns.update(values)
+				cases = dict(stamp)
+				for column in columns:
+					field = meta.get_field(column)
+					cases[column] = Case(*[
+						When(pk = pk, then = Value(values[column], output_field = field))
+						for _, pk, values in updates if column in values], default = F(column), output_field = field)
+				if updates and cases:
+					self.manager.filter(pk__in = [pk for _, pk, _ in updates]).update(**cases)
+				return [(index, pk) for index, pk, _ in updates]
+		except Exception as e:
+			lgr.warning('%sService bulk update failed, retrying row by row: %s' % (self.manager.model.__name__, e))
+		updated = []
+		for index, pk, values in updates:
+			try:
+				with transaction.atomic():
+					values.update(stamp)
+					if not self.manager.filter(pk = pk).update(**values):
+						raise self.manager.model.DoesNotExist(
+							'%s matching query does not exist.' % self.manager.model.__name__)
+				updated.append((index, pk))
+			except Exception as e:
+				errors[index] = str(e)
+		return updated
+
+	def bulk_create(self, rows, batch_size = None):
+		"""
+		Creates several entries with one INSERT per batch, each batch in its own transaction.
+		@param rows: The key=>value pairs for each entry, as they would be passed to create().
+		@type rows: list[dict]
+		@param batch_size: The number of rows per INSERT. Defaults to the service batch_size.
+		@type batch_size: int | None
+		@return: A tuple of the created objects, aligned with rows (None for the failed rows), and an index => error
+		message map of the failed rows. None on error.
+		@rtype: tuple | None
+		"""
+		try:
+			if self.manager is not None:
+				rows = list(rows)
+				results, errors = [None] * len(rows), {}
+				for batch in self._batches(rows, batch_size):
+					for index, obj in self._create_batch(batch, errors):
+						results[index] = obj
+				if errors:
+					lgr.warning('%sService bulk_create row errors: %s' % (self.manager.model.__name__, errors))
+				query_cache.invalidate(self.manager.model, router.db_for_write(self.manager.model))
+				return results, errors
+		except Exception as e:
+			lgr.error('%sService bulk_create exception: %s' % (self.manager.model.__name__, e))
+		return None
+
+	def bulk_update(self, rows, batch_size = None):
+		"""
+		Updates several records with one UPDATE per batch, each batch in its own transaction.
+		@param rows: The key=>value pairs to update for each record. Each row must contain the id of the record.
+		@type rows: list[dict]
+		@param batch_size: The number of rows per UPDATE. Defaults to the service batch_size.
+		@type batch_size: int | None
+		@return: A tuple of the updated ids, aligned with rows (None for the failed rows), and an index => error
+		message map of the failed rows. None on error.
+		@rtype: tuple | None
+		"""
+		try:
+			if self.manager is not None:
+				rows = list(rows)
+				results, errors = [None] * len(rows), {}
+				for batch in self._batches(rows, batch_size):
+					for index, pk in self._update_batch(batch, errors):
+						results[index] = pk
+				if errors:
+					lgr.warning('%sService bulk_update row errors: %s' % (self.manager.model.__name__, errors))
+				query_cache.invalidate(self.manager.model, router.db_for_write(self.manager.model))
+				return results, errors
+		except Exception as e:
+			lgr.error('%sService bulk_update exception: %s' % (self.manager.model.__name__, e))
+		return None
+
+	def bulk_upsert(self, rows, unique_field, batch_size = None):
+		"""
+		Creates or updates several records keyed on a unique column, e.g. Customer.phone_number.
+		Each batch costs one lookup, one INSERT and one UPDATE, all in a single transaction.
+		@param rows: The key=>value pairs for each record. Each row must contain the unique_field.
+		@type rows: list[dict]
+		@param unique_field: The unique column used to match the rows to the existing records.
+		@type unique_field: str
+		@param batch_size: The number of rows per batch. Defaults to the service batch_size.
+		@type batch_size: int | None
+		@return: A tuple of the created or updated ids, aligned with rows (None for the failed rows), and an
+		index => error message map of the failed rows. None on error.
+		@rtype: tuple | None
+		"""
+		try:
+			if self.manager is not None:
+				rows = list(rows)
+				results, errors = [None] * len(rows), {}
+				for batch in self._batches(rows, batch_size):
+					with transaction.atomic():
+						existing = dict(self.manager.filter(**{
+							'%s__in' % unique_field: [row.get(unique_field) for _, row in batch]}).values_list(
+							unique_field, 'pk'))
+						creates, updates = [], []
+						for index, row in batch:
+							if row.get(unique_field) in existing:
+								updates.append((index, dict(row, id = existing[row.get(unique_field)])))
+							else:
+								creates.append((index, row))
+						for index, obj in self._create_batch(creates, errors):
+							results[index] = str(obj.pk)
+						for index, pk in self._update_batch(updates, errors):
+							results[index] = pk
+				if errors:
+					lgr.warning('%sService bulk_upsert row errors: %s' % (self.manager.model.__name__, errors))
+				query_cache.invalidate(self.manager.model, router.db_for_write(self.manager.model))
+				return results, errors
+		except Exception as e:
+			lgr.error('%sService bulk_upsert exception: %s' % (self.manager.model.__name__, e))
+		return None
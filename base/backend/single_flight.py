@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Single-flight coalescing of expensive recomputations.
+While a key is being computed, every other caller asking for the same key waits for that computation and receives its
+result instead of running the same queries again. Within a process the callers are coalesced on a thread event. Across
+processes the computations of a key are serialized on a Postgres advisory lock (or a file lock on SQLite), so that the
+callers queued behind the first find its result in the shared cache.
+"""
+import copy
+import hashlib
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+
+try:
+	import fcntl
+except ImportError:  # pragma: no cover - no file locks on this platform, SQLite processes are not coalesced
+	fcntl = None
+
+lgr = logging.getLogger(__name__)
+
+
+class _Flight(object):
+	"""
+	A computation in progress that the callers of the same key wait on.
+	"""
+
+	def __init__(self):
+		super(_Flight, self).__init__()
+		self.done = threading.Event()
+		self.result = None
+		self.error = None
+
+
+class SingleFlight(object):
+	"""
+	Runs at most one computation per key at a time and hands its result to every caller that asked for the key meanwhile.
+	"""
+
+	def __init__(self):
+		super(SingleFlight, self).__init__()
+		self._flights = {}
+		self._lock = threading.Lock()
+
+	@property
+	def config(self):
+		return getattr(settings, 'SINGLE_FLIGHT', {})
+
+	@staticmethod
+	def _lock_id(key):
+		"""
+		Hashes the key into the signed 64 bit integer space of the Postgres advisory locks.
+		"""
+		return struct.unpack('<q', hashlib.sha1(key.encode('utf-8')).digest()[:8])[0]
+
+	@contextmanager
+	def process_lock(self, key, timeout, using = DEFAULT_DB_ALIAS):
+		"""
+		Holds a lock on the key shared by all the worker processes. The lock is given up on after the timeout, in which
+		case the caller computes the key without it.
+		@param key: The key to lock.
+		@type key: str
+		@param timeout: The number of seconds to wait for the lock.
+		@type timeout: float
+		@param using: The database alias whose advisory locks are used.
+		@type using: str
+		"""
+		connection = connections[using]
+		lock_id = self._lock_id(key)
+		deadline = time.time() + timeout
+		if connection.vendor == 'postgresql':
+			acquired = False
+			with connection.cursor() as cursor:
+				while not acquired:
+					cursor.execute('SELECT pg_try_advisory_lock(%s)', [lock_id])
+					acquired = cursor.fetchone()[0]
+					if acquired or time.time() > deadline:
+						break
+					time.sleep(0.01)
+			try:
+				yield acquired
+			finally:
+				if acquired:
+					with connection.cursor() as cursor:
+						cursor.execute('SELECT pg_advisory_unlock(%s)', [lock_id])
+		elif connection.vendor == 'sqlite' and fcntl is not None:
+			path = self.config.get('LOCK_PATH') or os.path.join(tempfile.gettempdir(), 'single_flight.lock')
+			offset = lock_id % (2 ** 31)  # one byte per key in a single lock file
+			with open(path, 'a') as lock:
+				acquired = False
+				while not acquired:
+					try:
+						fcntl.lockf(lock, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+						acquired = True
+					except (IOError, OSError):
+						if time.time() > deadline:
+							break
+						time.sleep(0.01)
+				try:
+					yield acquired
+				finally:
+					if acquired:
+						fcntl.lockf(lock, fcntl.LOCK_UN, 1, offset)
+		else:
+			yield False
+
+	def do(self, key, fn, cross_process = None, timeout = None):
+		"""
+		Computes the key with fn, unless it is already being computed, in which case the result of that computation is
+		returned once it finishes.
+		@param key: Identifies the computation. Callers with equal keys are coalesced.
+		@type key: str
+		@param fn: The callable computing the result. It is called without arguments.
+		@param cross_process: Whether to serialize the computation with the other processes as well. Defaults to the
+		SINGLE_FLIGHT CROSS_PROCESS setting.
+		@type cross_process: bool | None
+		@param timeout: The number of seconds a caller waits for another computation before running its own.
+		@type timeout: float | None
+		@return: The result of fn. The callers that waited get their own copy of it.
+		"""
+		if cross_process is None:
+			cross_process = self.config.get('CROSS_PROCESS', False)
+		if timeout is None:
+			timeout = self.config.get('TIMEOUT', 5)
+		with self._lock:
+			flight = self._flights.get(key)
+			leader = flight is None
+			if leader:
+				flight = self._flights[key] = _Flight()
+		if not leader:
+			if not flight.done.wait(timeout):
+				lgr.warning('SingleFlight timed out waiting for %s' % key)
+				return fn()
+			if flight.error is not None:
+				raise flight.error
+			return copy.deepcopy(flight.result)
+		try:
+			if cross_process:
+				with self.process_lock(key, timeout):
+					flight.result = fn()
+			else:
+				flight.result = fn()
+			return flight.result
+		except Exception as e:
+			flight.error = e
+			raise
+		finally:
+			with self._lock:
+				self._flights.pop(key, None)
+			flight.done.set()
+
+
+single_flight = SingleFlight()
+
+
+def coalesce(key = None, cross_process = None, timeout = None):
+	"""
+	Decorator coalescing the concurrent calls of a function that share the same key.
+	@param key: Callable building the key from the arguments of the decorated function. Defaults to the function name
+	and the repr of its arguments, leaving out self for methods.
+	@param cross_process: Whether to serialize the calls with the other processes as well.
+	@type cross_process: bool | None
+	@param timeout: The number of seconds a caller waits for another call before running its own.
+	@type timeout: float | None
+	@return: The decorator.
+	"""
+	def decorator(fn):
+		@wraps(fn)
+		def wrapper(*args, **kwargs):
+			if key is not None:
+				flight_key = key(*args, **kwargs)
+			else:
+				arguments = args[1:] if args and hasattr(args[0], fn.__name__) else args
+				flight_key = '%s.%s:%r:%r' % (fn.__module__, fn.__name__, arguments, sorted(kwargs.items()))
+			return single_flight.do(flight_key, lambda: fn(*args, **kwargs), cross_process, timeout)
+
+		return wrapper
+
+	return decorator
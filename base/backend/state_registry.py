@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Process-wide registry of the State rows.
+States are looked up by name on nearly every request, so we load them once and resolve names to ids in memory.
+"""
+import logging
+import threading
+
+from base.models import State
+
+lgr = logging.getLogger(__name__)
+
+
+class StateRegistry(object):
+	"""
+	Keeps a name => ids map of the State model in memory.
+	The map is loaded lazily on first use and dropped whenever a State row is saved or deleted (see base.signals).
+	"""
+
+	def __init__(self):
+		super(StateRegistry, self).__init__()
+		self._lock = threading.RLock()
+		self._names = None
+		self._ids = None
+		self.readers = []  # callables run before a lookup, e.g. to apply the writes of the other processes
+
+	def _load(self):
+		"""
+		Loads the State rows from the db if they are not loaded already.
+		@return: A tuple of the name => ids map and the id => name map.
+		@rtype: tuple
+		"""
+		for reader in self.readers:
+			reader()
+		with self._lock:
+			names, ids = self._names, self._ids
+			if names is None or ids is None:
+				names, ids = {}, {}
+				try:
+					for state_id, name in State.objects.order_by('date_created').values_list('id', 'name'):
+						names.setdefault(name, []).append(state_id)
+						ids[state_id] = name
+					names = dict((k, tuple(v)) for k, v in names.items())
+					self._names, self._ids = names, ids
+				except Exception as e:
+					lgr.error('StateRegistry load exception: %s' % e)
+			return names, ids
+
+	def invalidate(self):
+		"""
+		Drops the loaded states so that the next lookup reloads them from the db.
+		"""
+		with self._lock:
+			self._names = None
+			self._ids = None
+
+	def ids(self, *names):
+		"""
+		Retrieves the ids of all the states bearing any of the given names.
+		@param names: The State names to resolve. e.g. 'Active', 'Deleted'
+		@return: The ids of the matching states, empty if none matches.
+		@rtype: tuple
+		"""
+		state_names = self._load()[0]
+		state_ids = ()
+		for name in names:
+			state_ids += state_names.get(name, ())
+		return state_ids
+
+	def get_id(self, name):
+		"""
+		Retrieves the id of the state with the given name. If several states share the name, the oldest one is returned.
+		@param name: The State name to resolve.
+		@type name: str
+		@return: The id of the State or None if there is no State with that name.
+		@rtype: str | None
+		"""
+		state_ids = self.ids(name)
+		return state_ids[0] if state_ids else None
+
+	def name(self, state_id):
+		"""
+		Retrieves the name of the state with the given id.
+		@param state_id: The id of the State.
+		@type state_id: str
+		@return: The name of the State or None if it does not exist.
+		@rtype: str | None
+		"""
+		return self._load()[1].get(state_id)
+
+
+state_registry = StateRegistry()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Middleware defined in the base module
+"""
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+from base.backend import db_router
+from base.backend.compression import compressor
+from base.backend.invalidation_bus import invalidation_bus
+
+
+class CompressionMiddleware(object):
+	"""
+	Compresses the textual responses above COMPRESSION MIN_SIZE with the best encoding the client accepts.
+	Views flag the responses whose body comes from a cache with compression_cacheable, so that their compressed
+	bytes are cached as well.
+	"""
+
+	def __init__(self, get_response):
+		self.get_response = get_response
+
+	def __call__(self, request):
+		response = self.get_response(request)
+		if not compressor.config.get('ENABLED', True) or not compressor.compressible(response):
+			return response
+		patch_vary_headers(response, ('Accept-Encoding', ))
+		encoding = compressor.negotiate(request.META.get('HTTP_ACCEPT_ENCODING', ''), response.streaming)
+		if encoding is None:
+			return response
+		if response.streaming:
+			response.streaming_content = compressor.compress_stream(response.streaming_content)
+			if response.has_header('Content-Length'):
+				del response['Content-Length']
+		else:
+			content = compressor.compress(
+				response.content, encoding, getattr(response, 'compression_cacheable', False))
+			if len(content) >= len(response.content):
+				return response
+			response.content = content
+			response['Content-Length'] = str(len(content))
+		etag = response.get('ETag')
+		if etag and etag.startswith('"'):
+			response['ETag'] = 'W/' + etag  # the compressed bytes differ from the ones the strong ETag stood for
+		response['Content-Encoding'] = encoding
+		return response
+
+
+class InvalidationBusMiddleware(object):
+	"""
+	Has the cache invalidations published by the other worker processes applied before the first cached read of the
+	request, see InvalidationBus.sync. The requests that read no cache never poll.
+	"""
+
+	def __init__(self, get_response):
+		self.get_response = get_response
+
+	def __call__(self, request):
+		invalidation_bus.request_started()
+		try:
+			return self.get_response(request)
+		finally:
+			invalidation_bus.request_finished()
+
+
+class ReplicaPinningMiddleware(object):
+	"""
+	Pins the reads of a client to the primary database for REPLICA_PIN_SECONDS after it writes, so that it reads its
+	own writes even while the replicas lag behind.
+	"""
+	cookie_name = 'primary_pin'
+
+	def __init__(self, get_response):
+		self.get_response = get_response
+
+	def __call__(self, request):
+		db_router.reset(pinned = self.cookie_name in request.COOKIES)
+		try:
+			response = self.get_response(request)
+			if db_router.has_written() and getattr(settings, 'DATABASE_REPLICAS', []):
+				response.set_cookie(
+					self.cookie_name, '1', max_age = getattr(settings, 'REPLICA_PIN_SECONDS', 5), httponly = True)
+			return response
+		finally:
+			db_router.reset()
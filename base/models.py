@@ -36,3 +36,15 @@ class State(GenericBaseModel):
 	"""
 	def __str__(self):
 		return self.name
+
+
+class CacheGeneration(BaseModel):
+	"""
+	Holds the number of committed writes per model so that every worker process can tell when its cached reads of that
+	model went stale. e.g. core.risktype - 42
+	"""
+	label = models.CharField(max_length = 100, unique = True)
+	generation = models.BigIntegerField(default = 0)
+
+	def __str__(self):
+		return '%s - %s' % (self.label, self.generation)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+Signal receivers for the models in the base module
+"""
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from base.backend.invalidation_bus import invalidation_bus  # noqa: F401 registers the bus as a query_cache publisher
+from base.backend.query_cache import query_cache
+from base.backend.state_registry import state_registry
+from base.models import State
+
+
+@receiver([post_save, post_delete], sender = State)
+def refresh_state_registry(sender, **kwargs):
+	"""
+	Drops the in-memory states whenever a State is written so that the registry reloads them on the next lookup.
+	"""
+	state_registry.invalidate()
+
+
+@receiver([post_save, post_delete])
+def invalidate_query_cache(sender, using = None, **kwargs):
+	"""
+	Moves the written model to its next generation so that cached queries touching it are no longer served.
+	"""
+	query_cache.invalidate(sender, using)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the response compression
+"""
+import gzip
+import json
+
+from django.http import JsonResponse, StreamingHttpResponse
+from django.test import RequestFactory
+
+from base.backend.compression import compressor
+from base.middleware import CompressionMiddleware
+
+
+def middleware(response):
+	"""
+	Wraps a view returning the given response into the CompressionMiddleware
+	"""
+	return CompressionMiddleware(lambda request: response)
+
+
+class TestCompression(object):
+	"""
+	Tests for the Compressor and the CompressionMiddleware
+	"""
+	def test_negotiate(self):
+		"""
+		Test that the encoding is picked by the q-values of the client among the ones we produce
+		"""
+		assert compressor.negotiate('gzip, deflate') == 'gzip', 'Should pick gzip'
+		assert compressor.negotiate('deflate') is None, 'Should not encode what the client cannot decode'
+		assert compressor.negotiate('gzip;q=0, *;q=0') is None, 'Should honour q=0'
+		assert compressor.negotiate('br;q=1.0, gzip;q=0.5', streaming = True) == 'gzip', 'Should only stream gzip'
+
+	def test_middleware(self):
+		"""
+		Test that large responses are compressed and small ones left alone
+		"""
+		data = {'data': [{'name': 'Customer %s' % i} for i in range(200)]}
+		request = RequestFactory().get('/api/customers/', HTTP_ACCEPT_ENCODING = 'gzip')
+		response = JsonResponse(data)
+		response['ETag'] = '"abc"'
+		response = middleware(response)(request)
+		assert response['Content-Encoding'] == 'gzip', 'Should gzip the response'
+		assert json.loads(gzip.decompress(response.content).decode('utf-8')) == data, 'Should keep the body'
+		assert response['ETag'] == 'W/"abc"' and 'Accept-Encoding' in response['Vary'], 'Should weaken the ETag'
+
+		response = middleware(JsonResponse({'status': 'success'}))(request)
+		assert not response.has_header('Content-Encoding'), 'Should not compress small responses'
+
+	def test_cached_bodies(self):
+		"""
+		Test that the compressed bytes of the cacheable bodies are reused
+		"""
+		request = RequestFactory().get('/api/get_risk_type/', HTTP_ACCEPT_ENCODING = 'gzip')
+		hits = compressor.hits
+		for _ in range(2):
+			response = JsonResponse({'data': ['field'] * 500})
+			response.compression_cacheable = True
+			response = middleware(response)(request)
+		assert compressor.hits == hits + 1, 'Should compress the cacheable body once'
+		assert gzip.decompress(response.content).startswith(b'{"data"'), 'Should send the cached bytes'
+
+	def test_streaming(self):
+		"""
+		Test that streamed responses are gzipped chunk by chunk
+		"""
+		request = RequestFactory().get('/api/customers/', HTTP_ACCEPT_ENCODING = 'br, gzip')
+		response = StreamingHttpResponse(iter(['{"data":[', '1,' * 1000, '1]}']), content_type = 'application/json')
+		response = middleware(response)(request)
+		assert response['Content-Encoding'] == 'gzip', 'Should gzip the stream'
+		content = gzip.decompress(b''.join(response.streaming_content))
+		assert len(json.loads(content.decode('utf-8'))['data']) == 1001, 'Should keep the body'
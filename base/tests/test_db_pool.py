@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the per-process database connection pool
+"""
+import threading
+
+import pytest
+
+from base.backend.db_pool import ConnectionPool, PoolTimeout, get_pool, pool_stats
+
+
+class FakeConnection(object):
+	"""
+	Stands in for a DB-API connection
+	"""
+	def __init__(self):
+		self.closed = False
+		self.healthy = True
+
+	def close(self):
+		self.closed = True
+
+
+class TestConnectionPool(object):
+	"""
+	Tests for the ConnectionPool
+	"""
+	def test_reuse(self):
+		"""
+		Test that released connections are handed out again instead of opening new ones
+		"""
+		pool = ConnectionPool(FakeConnection, max_size = 2)
+		connection = pool.acquire()
+		pool.release(connection)
+		assert pool.acquire() is connection, 'Should reuse the released connection'
+		assert pool.stats()['opened'] == 1, 'Should have opened a single connection'
+		assert pool.stats()['in_use'] == 1, 'Should count the connection in use'
+
+	def test_timeout(self):
+		"""
+		Test that acquiring from an exhausted pool waits for a release or times out
+		"""
+		pool = ConnectionPool(FakeConnection, max_size = 1, timeout = 0.05)
+		connection = pool.acquire()
+		with pytest.raises(PoolTimeout):
+			pool.acquire()
+		assert pool.stats()['timeouts'] == 1, 'Should count the timeout'
+		pool.timeout = 2
+		waiting = []
+
+		def release():
+			waiting.append(pool.stats()['waiting'])
+			pool.release(connection)
+
+		threading.Timer(0.05, release).start()
+		assert pool.acquire() is connection, 'Should hand out the connection released while waiting'
+		stats = pool.stats()
+		assert waiting == [1] and stats['waiting'] == 0, 'Should count the callers waiting for a connection'
+		assert stats['waits'] == 1 and stats['wait_time_max'] > 0, 'Should track the wait'
+		assert stats['utilization'] == 1.0, 'Should report the pool as fully used'
+
+	def test_validation(self):
+		"""
+		Test that broken or reset failed connections are discarded
+		"""
+		pool = ConnectionPool(
+			FakeConnection, validate = lambda c: c.healthy, reset = lambda c: not c.closed, validate_after = 0)
+		connection = pool.acquire()
+		pool.release(connection)
+		connection.healthy = False
+		replacement = pool.acquire()
+		assert replacement is not connection and connection.closed, 'Should discard the broken connection'
+		replacement.closed = True
+		pool.release(replacement)
+		stats = pool.stats()
+		assert stats['discarded'] == 2 and stats['size'] == 0, 'Should discard the connection failing its reset'
+		assert pool.acquire() is not replacement, 'Should open a new connection'
+
+	def test_max_lifetime(self):
+		"""
+		Test that connections past their lifetime are replaced
+		"""
+		pool = ConnectionPool(FakeConnection, max_lifetime = -1)
+		connection = pool.acquire()
+		pool.release(connection)
+		assert pool.acquire() is not connection, 'Should replace the expired connection'
+
+	def test_get_pool(self):
+		"""
+		Test that pools are created once per alias
+		"""
+		pool = get_pool('test_pool', lambda: ConnectionPool(FakeConnection))
+		assert get_pool('test_pool', lambda: None) is pool, 'Should return the existing pool'
+		assert 'test_pool' in pool_stats(), 'Should report the stats of the pool'
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the read replica router
+"""
+import pytest
+from django.http import HttpResponse
+from django.test import RequestFactory
+from mixer.backend.django import mixer
+
+from api.backend.streaming import streaming_json_response
+from base.backend import db_router
+from base.backend.query_cache import query_cache
+from base.middleware import ReplicaPinningMiddleware
+from core.backend.services import RiskTypeService
+from core.models import RiskType
+
+
+@pytest.fixture
+def replicas(settings):
+	settings.DATABASE_REPLICAS = ['replica']
+	db_router.reset()
+	yield settings.DATABASE_REPLICAS
+	db_router.reset()
+
+
+class TestReplicaRouter(object):
+	"""
+	Tests for the ReplicaRouter
+	"""
+	def test_routing(self, replicas):
+		"""
+		Test that reads go to the replicas until the thread writes or is pinned
+		"""
+		router = db_router.ReplicaRouter()
+		assert router.db_for_read(RiskType) == 'replica', 'Should read from the replica'
+		with db_router.pin_primary():
+			assert router.db_for_read(RiskType) == 'default', 'Should read from the primary while pinned'
+		assert router.db_for_read(RiskType) == 'replica', 'Should read from the replica once unpinned'
+		assert router.db_for_write(RiskType) == 'default', 'Should write to the primary'
+		assert router.db_for_read(RiskType) == 'default', 'Should read its own writes from the primary'
+
+	@pytest.mark.django_db
+	def test_atomic(self, replicas):
+		"""
+		Test that reads inside a transaction stay on the primary
+		"""
+		assert db_router.ReplicaRouter().db_for_read(RiskType) == 'default'
+
+	def test_middleware(self, replicas):
+		"""
+		Test that a client is pinned to the primary after it writes
+		"""
+		def write(request):
+			db_router.ReplicaRouter().db_for_write(RiskType)
+			return HttpResponse()
+
+		def read(request):
+			request.routed = db_router.ReplicaRouter().db_for_read(RiskType)
+			return HttpResponse()
+
+		response = ReplicaPinningMiddleware(write)(RequestFactory().post('api/add_risk_type/'))
+		assert ReplicaPinningMiddleware.cookie_name in response.cookies, 'Should pin the client after the write'
+
+		request = RequestFactory().get('api/risk_types/')
+		request.COOKIES[ReplicaPinningMiddleware.cookie_name] = '1'
+		ReplicaPinningMiddleware(read)(request)
+		assert request.routed == 'default', 'Should read from the primary while the client is pinned'
+
+		request = RequestFactory().get('api/risk_types/')
+		ReplicaPinningMiddleware(read)(request)
+		assert request.routed == 'replica', 'Should read from the replica once the pin expires'
+
+	@pytest.mark.django_db(transaction = True)
+	def test_cache_refill(self, replicas):
+		"""
+		Test that the query cache is filled from the primary, which the replica alias, unknown to DATABASES, stands in
+		for a lagging replica
+		"""
+		query_cache.backend.clear()
+		mixer.blend('core.RiskType', name = 'AutoMobile Cover', state = mixer.blend('base.State', name = 'Active'))
+		db_router.reset()
+		assert len(RiskTypeService().filter(name = 'AutoMobile Cover')) == 1, 'Should read a miss from the primary'
+		assert not db_router.is_pinned(), 'Should only pin the reads of the refill'
+
+	def test_streamed_pin(self, replicas):
+		"""
+		Test that a stream keeps the pin of its request while it is sent, after the middleware has reset it
+		"""
+		def rows(routes):
+			routes.append(db_router.ReplicaRouter().db_for_read(RiskType))
+			yield {}
+
+		def stream(request):
+			request.routes = []
+			return streaming_json_response(rows(request.routes), 'ok')
+
+		request = RequestFactory().get('api/risk_types/')
+		request.COOKIES[ReplicaPinningMiddleware.cookie_name] = '1'
+		response = ReplicaPinningMiddleware(stream)(request)
+		b''.join(response.streaming_content)
+		assert request.routes == ['default'], 'Should stream a pinned request from the primary'
+		assert not db_router.is_pinned(), 'Should unpin the thread once the stream is sent'
+
+		request = RequestFactory().get('api/risk_types/')
+		b''.join(ReplicaPinningMiddleware(stream)(request).streaming_content)
+		assert request.routes == ['replica'], 'Should stream an unpinned request from the replica'
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the cross-process cache invalidation bus
+"""
+import pytest
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from mixer.backend.django import mixer
+
+from base.backend.invalidation_bus import InvalidationBus
+from base.backend.query_cache import query_cache
+from base.models import CacheGeneration
+from core.models import RiskType
+
+# the events are published once the writes commit
+pytestmark = pytest.mark.django_db(transaction = True)
+
+
+class TestInvalidationBus(object):
+	"""
+	Tests for the InvalidationBus
+	"""
+	def test_publish(self):
+		"""
+		Test that committed writes are published to the CacheGeneration table
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		mixer.cycle(2).blend('core.RiskType', state = state)
+		assert CacheGeneration.objects.get(label = 'core.risktype').generation == 2, 'Should publish every write'
+		assert not CacheGeneration.objects.filter(label = 'base.cachegeneration').exists(), 'Should not publish itself'
+
+	def test_publish_once_per_transaction(self):
+		"""
+		Test that a transaction writing several times to a model publishes it once
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		with transaction.atomic():
+			mixer.cycle(3).blend('core.RiskType', state = state)
+		assert CacheGeneration.objects.get(label = 'core.risktype').generation == 1, 'Should publish the commit once'
+
+	def test_poll(self, settings):
+		"""
+		Test that a worker applies the writes published by the other workers
+		"""
+		settings.INVALIDATION_BUS = dict(settings.INVALIDATION_BUS, POLL_INTERVAL = 0)
+		worker = InvalidationBus()
+		assert worker.poll() == [], 'Should only record the generations on the first poll'
+
+		mixer.blend('base.State', name = 'Active')
+		generation = query_cache.generation(RiskType)
+		InvalidationBus().publish(RiskType)
+		assert sorted(worker.poll()) == ['base.state', 'core.risktype'], 'Should pick up the published writes'
+		assert query_cache.generation(RiskType) > generation, 'Should move the cached RiskType reads to a new generation'
+		assert worker.poll() == [], 'Should not apply the same writes twice'
+
+		instance = worker.instance()
+		CacheGeneration.objects.all().delete()  # as the database is flushed
+		assert 'core.risktype' in worker.poll(), 'Should take every model for written to once the database is reset'
+		assert worker.instance() != instance, 'Should tell the reset database apart'
+
+	def test_sync(self, settings, client):
+		"""
+		Test that a request polls before its first cached read only, and not at all if it reads no cache
+		"""
+		settings.INVALIDATION_BUS = dict(settings.INVALIDATION_BUS, POLL_INTERVAL = 0)
+		worker = InvalidationBus()
+		worker.poll()
+		worker.request_started()
+		with CaptureQueriesContext(connection) as queries:
+			worker.sync()
+			worker.sync()
+		worker.request_finished()
+		assert len(queries) == 1, 'Should poll before the first cached read of the request only'
+
+		settings.INVALIDATION_BUS = dict(settings.INVALIDATION_BUS, POLL_INTERVAL = 60)
+		worker.request_started()
+		with CaptureQueriesContext(connection) as queries:
+			worker.sync()
+		worker.request_finished()
+		assert len(queries) == 0, 'Should not poll again within POLL_INTERVAL seconds'
+
+		settings.INVALIDATION_BUS = dict(settings.INVALIDATION_BUS, POLL_INTERVAL = 0)
+		with CaptureQueriesContext(connection) as queries:
+			client.get('/static/missing.css')
+		assert not [q for q in queries if 'cachegeneration' in q['sql']], \
+			'Should not poll for a request reading no cache'
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the keyset pagination helpers
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from django.db.models.functions import Length
+from django.utils import timezone
+from mixer.backend.django import mixer
+
+from base.backend.pagination import (
+	decode_cursor, encode_cursor, keyset_page, keyset_slice, page_limit, row_key, sorted_page)
+from base.models import State
+
+pytestmark = pytest.mark.django_db
+
+
+class TestPagination(object):
+	"""
+	Tests for the keyset pagination helpers
+	"""
+	def test_cursor(self):
+		"""
+		Test that the cursors round trip and reject anything else
+		"""
+		key = row_key(timezone.now(), 'abc')
+		assert decode_cursor(encode_cursor(key)) == key, 'Should decode the key the cursor was built from'
+		with pytest.raises(ValueError):
+			decode_cursor('not-a-cursor')
+		with pytest.raises(ValueError):
+			page_limit('0')
+		assert page_limit(10 ** 6) == 1000, 'Should cap the limit at MAX_LIMIT'
+
+	def test_keyset_page(self):
+		"""
+		Test that walking the pages returns every row once in (-date_created, id) order
+		"""
+		now = timezone.now()
+		for i in range(7):
+			mixer.blend('base.State', date_created = now - timedelta(minutes = i // 2))
+		expected = list(State.objects.order_by('-date_created', 'id').values_list('id', flat = True))
+		seen, cursor = [], None
+		while True:
+			rows, cursor = keyset_page(State.objects.values('id', 'date_created'), cursor, 3)
+			seen.extend(row['id'] for row in rows)
+			if cursor is None:
+				break
+		assert seen == expected, 'Should return the rows in order without gaps or repeats'
+
+	def test_sorted_page(self):
+		"""
+		Test that walking the sorted pages returns every row once, the ties and nulls included
+		"""
+		now = timezone.now()
+		for i, description in enumerate(('aa', 'a', 'aa', None, 'a', None, 'aaa', 'aa')):
+			mixer.blend('base.State', description = description, date_created = now - timedelta(minutes = i // 3))
+		states = State.objects.annotate(rank = Length('description')).values('id', 'rank', 'date_created')
+		for sort in ('rank', '-rank'):
+			expected = sorted(states, key = lambda row: row['id'])
+			expected.sort(key = lambda row: row['date_created'], reverse = True)
+			expected.sort(key = lambda row: (row['rank'] is None, (row['rank'] or 0) * (-1 if sort[0] == '-' else 1)))
+			seen, cursor = [], None
+			while True:
+				rows, cursor = sorted_page(states, sort, cursor, 3)
+				seen.extend(rows)
+				if cursor is None:
+					break
+			assert seen == expected, 'Should return the rows in %s order without gaps or repeats' % sort
+		with pytest.raises(ValueError):
+			sorted_page(states, 'rank', encode_cursor(row_key(now, 'abc')))
+
+	def test_keyset_slice(self):
+		"""
+		Test that in-memory pages match the database pages
+		"""
+		dates = [datetime(2019, 1, 2), datetime(2019, 1, 2), datetime(2019, 1, 1)]
+		rows = [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}]
+		keys = [row_key(date, row['id']) for date, row in zip(dates, rows)]
+		page, cursor = keyset_slice(rows, keys, limit = 1)
+		assert page == rows[:1] and cursor == encode_cursor(keys[0]), 'Should return the first page'
+		page, cursor = keyset_slice(rows, keys, cursor, 5)
+		assert page == rows[1:] and cursor is None, 'Should return the rest after the cursor'
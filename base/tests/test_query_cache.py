@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the read-through query cache
+"""
+import time
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from mixer.backend.django import mixer
+
+from base.backend.invalidation_bus import InvalidationBus
+from base.backend.query_cache import DjangoCacheBackend, LocMemLRUBackend, QueryCache, query_cache
+from core.backend.services import CustomerService, RiskTypeService, RiskFieldService
+from core.models import Risk, RiskType
+
+# the cache is bypassed inside transactions, so these tests need to commit their writes
+pytestmark = pytest.mark.django_db(transaction = True)
+
+
+class TestLocMemLRUBackend(object):
+	"""
+	Tests for the LocMemLRUBackend
+	"""
+	def test_eviction(self):
+		"""
+		Test that the least recently used entries are evicted once the backend is full
+		"""
+		backend = LocMemLRUBackend(max_entries = 2)
+		backend.set('a', [1])
+		backend.set('b', [2])
+		backend.get('a')
+		backend.set('c', [3])
+		assert backend.get('b') == (False, None), 'Should evict the least recently used entry'
+		assert backend.get('a') == (True, [1]) and backend.get('c') == (True, [3]), 'Should keep the recent entries'
+
+	def test_ttl(self):
+		"""
+		Test that expired entries are not served
+		"""
+		backend = LocMemLRUBackend()
+		backend.set('a', [1], ttl = 0.01)
+		time.sleep(0.02)
+		assert backend.get('a') == (False, None), 'Should not serve an expired entry'
+
+
+class TestQueryCache(object):
+	"""
+	Tests for the query cache used by ServiceBase
+	"""
+	def test_read_through(self):
+		"""
+		Test that a repeated read is served from the cache and a write invalidates it
+		"""
+		query_cache.backend.clear()
+		state = mixer.blend('base.State', name = 'Active')
+		risk_type = mixer.blend('core.RiskType', name = 'AutoMobile Cover', state = state)
+		assert len(RiskTypeService().filter(name = 'AutoMobile Cover')) == 1
+
+		hits = query_cache.hits
+		with CaptureQueriesContext(connection) as queries:
+			assert len(RiskTypeService().filter(name = 'AutoMobile Cover')) == 1
+		assert len(queries) == 0 and query_cache.hits == hits + 1, 'Should serve the RiskTypes from the cache'
+
+		mixer.blend('core.RiskType', name = 'AutoMobile Cover', state = state)
+		assert len(RiskTypeService().filter(name = 'AutoMobile Cover')) == 2, 'Should miss once a RiskType is saved'
+
+		mixer.blend('core.RiskField', risk_type = risk_type, state = state)
+		fields = RiskFieldService().filter(risk_type__name = 'AutoMobile Cover')
+		assert len(fields) == 1
+		RiskTypeService().update_columns(risk_type.id, name = 'House Cover')
+		fields = RiskFieldService().filter(risk_type__name = 'AutoMobile Cover')
+		assert len(fields) == 0, 'Should miss once a joined model is updated'
+
+	def test_prefetch_select_related(self):
+		"""
+		Test that a cached read is invalidated by the models joined within its Prefetch querysets
+		"""
+		query_cache.backend.clear()
+		state = mixer.blend('base.State', name = 'Active')
+		customer = mixer.blend('core.Customer', state = state)
+		risk_type = mixer.blend('core.RiskType', name = 'AutoMobile Cover', state = state)
+		mixer.blend('core.Risk', customer = customer, risk_type = risk_type, state = state)
+		customer = CustomerService().get(id = customer.id, profile = 'portfolio')
+		assert customer.risk_set.all()[0].risk_type.name == 'AutoMobile Cover'
+		RiskTypeService().update_columns(risk_type.id, name = 'House Cover')
+		customer = CustomerService().get(id = customer.id, profile = 'portfolio')
+		assert customer.risk_set.all()[0].risk_type.name == 'House Cover', 'Should miss once a joined model is updated'
+
+	def test_subquery(self):
+		"""
+		Test that a cached read is invalidated by the models only read within its subqueries
+		"""
+		query_cache.backend.clear()
+		state = mixer.blend('base.State', name = 'Active')
+		customer = mixer.blend('core.Customer', state = state)
+		risk_type = mixer.blend('core.RiskType', name = 'AutoMobile Cover', state = state)
+		holders = lambda: CustomerService().filter(
+			id__in = Risk.objects.filter(risk_type__name = 'AutoMobile Cover').values('customer_id'))
+		assert len(holders()) == 0
+		mixer.blend('core.Risk', customer = customer, risk_type = risk_type, state = state)
+		assert len(holders()) == 1, 'Should miss once a model of the subquery is saved'
+		RiskTypeService().update_columns(risk_type.id, name = 'House Cover')
+		assert len(holders()) == 0, 'Should miss once a model joined within the subquery is updated'
+
+	def test_shared_backend(self, settings):
+		"""
+		Test that the entries of a shared backend are keyed on the generations every process agrees on
+		"""
+		settings.INVALIDATION_BUS = dict(settings.INVALIDATION_BUS, POLL_INTERVAL = 0)
+		state = mixer.blend('base.State', name = 'Active')
+		mixer.blend('core.RiskType', name = 'AutoMobile Cover', state = state)
+		buses, workers = [InvalidationBus(), InvalidationBus()], [QueryCache(DjangoCacheBackend()) for _ in range(2)]
+		for bus, worker in zip(buses, workers):
+			worker.versions = bus.versions
+		queryset = RiskTypeService().filter(name = 'AutoMobile Cover')
+		assert workers[0].make_key(queryset) is None, 'Should not cache before the generations are polled'
+
+		for bus in buses:
+			bus.poll()
+		workers[1].bump(RiskType)
+		assert workers[0].make_key(queryset) == workers[1].make_key(queryset), \
+			'Should key the entries alike in every process whatever writes it has seen locally'
+		key = workers[0].make_key(queryset)
+		buses[0].publish(RiskType)
+		assert workers[0].make_key(queryset) != key, 'Should move to the next generation on its own writes'
+		assert workers[1].make_key(queryset) == key, 'Should keep the previous generation until it polls'
+		buses[1].poll()
+		assert workers[1].make_key(queryset) == workers[0].make_key(queryset), 'Should agree once it has polled'
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the request body decoding and validation
+"""
+import json
+
+import pytest
+from django.test import RequestFactory
+
+from base.backend.request_parser import RequestError, decode_request, parse_request, validate
+
+SCHEMA = {
+	'id': {'type': str, 'required': True, 'aliases': ('risk_type_id', )},
+	'fields': {'type': list, 'items': {'type': dict, 'fields': {
+		'caption': {'type': str, 'required': True, 'max_length': 5},
+		'field_type': {'type': str, 'choices': ('text', 'number')}}}},
+	'date_of_birth': {'type': str, 'format': '%Y-%m-%d'},
+	'atomic': {'type': bool, 'default': False},
+	'where': {'type': list, 'default': []},
+}
+
+
+class TestRequestParser(object):
+	"""
+	Tests for the decoding and validation of the request bodies
+	"""
+	def test_decode_request(self):
+		"""
+		Test that the data is decoded whatever the method and content type
+		"""
+		factory = RequestFactory()
+		request = factory.post('/', json.dumps({'id': 'a'}), content_type = 'application/json')
+		assert decode_request(request) == {'id': 'a'}, 'Should decode a JSON body'
+		assert decode_request(factory.post('/', {'id': 'a'})) == {'id': 'a'}, 'Should decode a multipart body'
+		assert decode_request(factory.get('/', {'id': 'a'})) == {'id': 'a'}, 'Should decode the query string'
+		with pytest.raises(RequestError) as error:
+			decode_request(factory.post('/', '{"id":', content_type = 'application/json'))
+		assert error.value.status == 400, 'Should reject a body that is not JSON'
+		with pytest.raises(RequestError) as error:
+			decode_request(factory.post('/', json.dumps({'id': 'a' * 100}), content_type = 'application/json'), 50)
+		assert error.value.status == 413, 'Should reject a body larger than the maximum size'
+
+	def test_validate(self):
+		"""
+		Test that the data is checked against the schema, recording the error of each field
+		"""
+		data = {'risk_type_id': 'a', 'fields': [{'caption': 'Name', 'field_type': 'text'}], 'other': 1}
+		assert validate(data, SCHEMA) == {}, 'Should accept data matching the schema'
+		assert data == {
+			'id': 'a', 'fields': [{'caption': 'Name', 'field_type': 'text'}], 'date_of_birth': None, 'atomic': False,
+			'where': []}, 'Should resolve the aliases, fill in the defaults and drop the undeclared fields'
+		data['where'].append({'field': 'Year'})
+		other = {'id': 'b'}
+		validate(other, SCHEMA)
+		assert other['where'] == [] and SCHEMA['where']['default'] == [], \
+			'Should not share the defaults between requests'
+		errors = validate({
+			'fields': [{'caption': 'Too long', 'field_type': 'file'}, 'x'], 'date_of_birth': '1/1/1990',
+			'atomic': 'yes'}, SCHEMA)
+		assert errors == {
+			'id': 'is required', 'fields.0.caption': 'must be at most 5 characters',
+			'fields.0.field_type': 'must be one of text, number', 'fields.1': 'must be of type dict',
+			'date_of_birth': 'must match the format %Y-%m-%d', 'atomic': 'must be of type bool'}, \
+			'Should report every invalid field by its path'
+
+	def test_parse_request(self):
+		"""
+		Test that an invalid request raises with the errors of its fields
+		"""
+		request = RequestFactory().post('/', json.dumps({'fields': 'x'}), content_type = 'application/json')
+		with pytest.raises(RequestError) as error:
+			parse_request(request, SCHEMA)
+		assert error.value.errors == {'id': 'is required', 'fields': 'must be of type list'}, \
+			'Should raise with the errors of the request'
@@ -45,3 +45,26 @@ class TestStateService(object):
 		state = mixer.blend('base.State', name = 'Active')
 		new_state = StateService().update(state.id, name = 'In Transit')
 		assert new_state is not None, 'Should update the State object with a new name'
+
+	def test_bulk_create(self):
+		"""
+		Test for the StateService bulk_create(rows, batch_size) method
+		"""
+		states, errors = StateService().bulk_create(
+			[{'name': 'Active'}, {'name': 'Deleted'}, {'name': 'Active', 'colour': 'red'}], batch_size = 2)
+		assert len(states) == 3 and states[2] is None, 'Should create the valid rows and skip the invalid one'
+		assert list(errors.keys()) == [2], 'Should report the error for the invalid row only'
+		assert StateService().filter(name__in = ['Active', 'Deleted']).count() == 2, 'Should persist 2 States'
+
+	def test_bulk_update(self):
+		"""
+		Test for the StateService bulk_update(rows, batch_size) method
+		"""
+		active, deleted = mixer.cycle(2).blend('base.State', name = 'Active')
+		ids, errors = StateService().bulk_update([
+			{'id': active.id, 'name': 'In Transit'}, {'id': deleted.id, 'name': 'Deleted', 'description': 'gone'},
+			{'id': 'missing', 'name': 'Active'}])
+		assert ids[:2] == [str(active.id), str(deleted.id)] and ids[2] is None, 'Should update the existing rows'
+		assert list(errors.keys()) == [2], 'Should report the missing row'
+		assert StateService().get(id = deleted.id).description == 'gone', 'Should persist the new values'
+		assert StateService().get(id = active.id).name == 'In Transit', 'Should persist the new values'
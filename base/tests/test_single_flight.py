@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the single-flight request coalescing
+"""
+import threading
+import time
+
+import pytest
+
+from base.backend.single_flight import SingleFlight, coalesce
+
+
+class TestSingleFlight(object):
+	"""
+	Tests for the SingleFlight
+	"""
+	def test_do(self):
+		"""
+		Test that concurrent callers of the same key share a single computation
+		"""
+		flights, calls, results = SingleFlight(), [], []
+
+		def compute():
+			calls.append(1)
+			time.sleep(0.1)
+			return {'fields': [1, 2, 3]}
+
+		threads = [
+			threading.Thread(target = lambda: results.append(flights.do('form', compute))) for _ in range(5)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		assert len(calls) == 1, 'Should compute the key once'
+		assert results == [{'fields': [1, 2, 3]}] * 5, 'Should hand the result to every caller'
+		assert len(set(id(result) for result in results)) == 5, 'Should give every caller its own copy'
+
+	def test_error(self):
+		"""
+		Test that the error of the computation is raised to the callers and the key is released
+		"""
+		flights = SingleFlight()
+
+		def compute():
+			raise ValueError('failed')
+
+		with pytest.raises(ValueError):
+			flights.do('form', compute)
+		assert flights.do('form', lambda: 'ok') == 'ok', 'Should compute the key again once the failed call is done'
+
+	def test_coalesce(self):
+		"""
+		Test the coalesce decorator on a method
+		"""
+		calls = []
+
+		class Forms(object):
+			@coalesce(timeout = 1)
+			def form(self, name):
+				calls.append(name)
+				time.sleep(0.1)
+				return name
+
+		threads = [threading.Thread(target = Forms().form, args = ('House Cover',)) for _ in range(3)]
+		threads.append(threading.Thread(target = Forms().form, args = ('AutoMobile Cover',)))
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		assert sorted(calls) == ['AutoMobile Cover', 'House Cover'], 'Should compute each key once'
+
+	def test_process_lock(self, settings, tmpdir):
+		"""
+		Test that the cross-process lock of a key is acquired and released
+		"""
+		settings.SINGLE_FLIGHT = {'LOCK_PATH': str(tmpdir.join('single_flight.lock'))}
+		flights = SingleFlight()
+		with flights.process_lock('form', 1) as acquired:
+			assert acquired, 'Should acquire the lock on the key'
+		assert flights.do('form', lambda: 'ok', cross_process = True) == 'ok', 'Should compute under the lock'
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the in-memory State registry
+"""
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from mixer.backend.django import mixer
+
+from base.backend.state_registry import state_registry
+
+pytestmark = pytest.mark.django_db
+
+
+class TestStateRegistry(object):
+	"""
+	Tests for the StateRegistry
+	"""
+	def test_ids(self):
+		"""
+		Test for the StateRegistry ids(*names) and get_id(name) methods
+		"""
+		active = mixer.blend('base.State', name = 'Active')
+		deleted = mixer.blend('base.State', name = 'Deleted')
+		assert state_registry.ids('Active', 'Deleted') == (str(active.id), str(deleted.id)), 'Should resolve both names'
+		assert state_registry.get_id('Active') == str(active.id), 'Should resolve the Active state id'
+		assert state_registry.get_id('Inactive') is None, 'Should return None for an unknown State'
+		assert state_registry.name(str(deleted.id)) == 'Deleted', 'Should resolve the State name from its id'
+
+	def test_load_once(self):
+		"""
+		Test that the states are loaded once and reloaded after a State is saved
+		"""
+		mixer.blend('base.State', name = 'Active')
+		state_registry.ids('Active')
+		with CaptureQueriesContext(connection) as queries:
+			state_registry.get_id('Active')
+			state_registry.ids('Deleted')
+		assert len(queries) == 0, 'Should resolve the states without querying the db'
+
+		deleted = mixer.blend('base.State', name = 'Deleted')
+		assert state_registry.get_id('Deleted') == str(deleted.id), 'Should reload the states after a State is saved'
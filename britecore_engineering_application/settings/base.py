@@ -11,6 +11,8 @@ https://docs.djangoproject.com/en/1.11/ref/settings/
 """
 
 import os
+import tempfile
+
 import django_heroku
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -47,6 +49,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+	'base.middleware.CompressionMiddleware',
+	'base.middleware.ReplicaPinningMiddleware',
+	'base.middleware.InvalidationBusMiddleware',
 	'corsheaders.middleware.CorsMiddleware',
 	'django.middleware.security.SecurityMiddleware',
 	'django.contrib.sessions.middleware.SessionMiddleware',
@@ -97,6 +102,80 @@ AUTH_PASSWORD_VALIDATORS = [
 
 CORS_ORIGIN_ALLOW_ALL = True
 
+# Reads go to one of the DATABASE_REPLICAS aliases, writes and transactions to default.
+# A client that writes keeps reading from default for REPLICA_PIN_SECONDS
+DATABASE_ROUTERS = ['base.backend.db_router.ReplicaRouter']
+DATABASE_REPLICAS = []
+REPLICA_PIN_SECONDS = 5
+
+# Read-through cache for the services that set a cache_ttl (see base.backend.query_cache)
+# Use 'base.backend.query_cache.DjangoCacheBackend' with OPTIONS {'alias': ...} to store entries in CACHES instead,
+# which are shared by the workers and so only cached while the INVALIDATION_BUS is enabled
+QUERY_CACHE = {
+	'ENABLED': True,
+	'BACKEND': 'base.backend.query_cache.LocMemLRUBackend',
+	'OPTIONS': {
+		'max_entries': 1024,
+		'max_bytes': 16 * 1024 * 1024,
+	},
+}
+
+# Publishes committed writes of the models in APPS through the CacheGeneration table so that every worker process
+# drops its stale cached reads. A worker polls the table before the first cached read of a request, at most every
+# POLL_INTERVAL seconds, so the other workers serve a write after POLL_INTERVAL seconds at worst
+INVALIDATION_BUS = {
+	'ENABLED': True,
+	'POLL_INTERVAL': 1,
+	'APPS': ('base', 'core'),
+}
+
+# Coalesces concurrent recomputations of the same key (see base.backend.single_flight). With CROSS_PROCESS the workers
+# also queue behind each other, which only pays off when the cache they fill is shared, e.g. a DjangoCacheBackend
+SINGLE_FLIGHT = {
+	'CROSS_PROCESS': False,
+	'TIMEOUT': 5,
+	'LOCK_PATH': os.path.join(BASE_DIR, '..', 'single_flight.lock'),
+}
+
+# page sizes of the listings paginated with a cursor, see base.backend.pagination. A listing requested without a
+# limit returns DEFAULT_LIMIT rows and the next_cursor of the rest, ?stream=1 returns all the rows at once
+PAGINATION = {
+	'DEFAULT_LIMIT': 100,
+	'MAX_LIMIT': 1000,
+}
+
+# operations run by a single request to the batch endpoint, the read-only ones on up to MAX_WORKERS threads
+BATCH = {
+	'MAX_OPERATIONS': 20,
+	'MAX_WORKERS': 4,
+}
+
+# Parsing of the request bodies, larger bodies are rejected with a 413 before they are decoded
+REQUEST_PARSER = {
+	'MAX_BODY_SIZE': 256 * 1024,
+}
+
+# Compression of the textual responses, with brotli when the brotli package is installed. The compressed bytes of
+# the responses served from a cache are kept in an LRU of CACHE_OPTIONS
+COMPRESSION = {
+	'ENABLED': True,
+	'MIN_SIZE': 1024,
+	'LEVEL': 6,
+	'BROTLI': True,
+	'BROTLI_QUALITY': 5,
+	'CACHE_OPTIONS': {'max_entries': 512, 'max_bytes': 8 * 1024 * 1024},
+}
+
+# Directory of the files the worker processes share at runtime, outside of the repository
+RUNTIME_DIR = os.environ.get('RUNTIME_DIR', os.path.join(tempfile.gettempdir(), 'britecore_engineering_application'))
+
+# Memory-mapped snapshot of the State, RiskType and RiskField catalog shared by the worker processes.
+# It is versioned with the INVALIDATION_BUS generations, so it is only served while the bus is enabled
+CATALOG_SNAPSHOT = {
+	'ENABLED': True,
+	'PATH': os.path.join(RUNTIME_DIR, 'catalog.snapshot'),
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.11/topics/i18n/
 
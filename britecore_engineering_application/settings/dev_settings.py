@@ -14,5 +14,13 @@ DATABASES = {
 	'default': {
 		'ENGINE': 'django.db.backends.sqlite3',
 		'NAME': os.path.join(BASE_DIR, '../db.sqlite3'),
-	}
+	},
+	# a second alias on the same file stands in for a read replica locally
+	'replica': {
+		'ENGINE': 'django.db.backends.sqlite3',
+		'NAME': os.path.join(BASE_DIR, '../db.sqlite3'),
+		'TEST': {'MIRROR': 'default'},
+	},
 }
+
+DATABASE_REPLICAS = ['replica']
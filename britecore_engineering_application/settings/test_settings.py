@@ -13,3 +13,6 @@ DATABASES = {
 }
 
 EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+
+# the tests of the snapshot build it under a tmpdir of their own
+CATALOG_SNAPSHOT = {'ENABLED': False}
@@ -3,7 +3,7 @@ from __future__ import unicode_literals
 
 from django.contrib import admin
 
-from core.models import Customer, RiskType, RiskField, Risk, RiskData
+from core.models import Customer, CustomerSummary, RiskType, RiskField, Risk, RiskData, RiskProjection
 
 
 @admin.register(Customer)
@@ -48,6 +48,7 @@ class RiskAdmin(admin.ModelAdmin):
 	"""
 	list_filter = ('date_created',)
 	list_display = ('customer', 'risk_type', 'state', 'date_modified', 'date_created')
+	list_select_related = ('customer', 'risk_type', 'state')  # the columns and __str__ follow these FKs on every row
 	search_fields = (
 		'customer__first_name', 'customer__last_name', 'customer__identity_number', 'customer__other_name',
 		'risk_type__name', 'state__name')
@@ -60,6 +61,29 @@ class RiskDataAdmin(admin.ModelAdmin):
 	"""
 	list_filter = ('date_created',)
 	list_display = ('risk', 'risk_field', 'value', 'state', 'date_modified', 'date_created')
+	list_select_related = ('risk__customer', 'risk__risk_type', 'risk_field__risk_type', 'state')
 	search_fields = (
 		'risk__customer__first_name', 'risk__customer__last_name', 'risk__customer__identity_number',
 		'risk__risk_type__name', 'state__name')
+
+
+@admin.register(RiskProjection)
+class RiskProjectionAdmin(admin.ModelAdmin):
+	"""
+	Admin class for the RiskProjection model. defines which fields to display and which are searchable
+	"""
+	list_filter = ('date_created',)
+	list_display = ('risk_type', 'db_table', 'form_digest', 'rows', 'next_table', 'date_modified', 'date_created')
+	search_fields = ('risk_type__name', 'db_table')
+
+
+@admin.register(CustomerSummary)
+class CustomerSummaryAdmin(admin.ModelAdmin):
+	"""
+	Admin class for the CustomerSummary model. defines which fields to display and which are searchable
+	"""
+	list_filter = ('last_risk_date',)
+	list_display = (
+		'customer', 'risk_count', 'risk_type_count', 'risk_types', 'last_risk_date', 'last_activity', 'date_modified')
+	list_select_related = ('customer', )
+	search_fields = ('customer__first_name', 'customer__last_name', 'customer__phone_number', 'risk_types')
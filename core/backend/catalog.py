@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+Catalog snapshot shared by all the worker processes.
+The State, RiskType and RiskField catalog is serialized into a memory-mapped file that one process builds and every
+worker maps, so the pages are held once by the OS instead of once per worker. The snapshot is versioned with the
+shared generations of the InvalidationBus and the identity of the database they belong to, and rebuilt in the
+background by the first worker that finds it stale, the requests reading the db until it is swapped in.
+Every form and every listed RiskType is a blob of its own, located by the index, so a request decodes only the form or
+the page it serves.
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, connections
+from django.db.models import Q
+
+from base.backend.db_router import use_primary
+from base.backend.invalidation_bus import invalidation_bus
+from base.backend.pagination import ORDERING, decode_cursor, keyset_slice, page_limit, row_key
+from base.backend.state_registry import state_registry
+from core.backend.form_cache import build_forms, form_digest
+from core.backend.services import RiskTypeService
+
+try:
+	import fcntl
+except ImportError:  # pragma: no cover - no advisory locks on this platform, concurrent builds simply race
+	fcntl = None
+
+lgr = logging.getLogger(__name__)
+
+MAGIC = b'BCCAT004'
+HEADER = struct.Struct('<8sQ')  # magic, length of the json index that follows
+CATALOG_MODELS = ('base.state', 'core.risktype', 'core.riskfield')
+RISK_TYPE_FIELDS = ('name', 'description', 'state_id', 'id', 'has_form', 'date_created')
+
+
+class SnapshotRows(object):
+	"""
+	The rows of the snapshot listed in the index, each decoded out of the mapped file only once it is sliced into a
+	page, see keyset_slice.
+	"""
+
+	def __init__(self, read, entries):
+		"""
+		@param read: Decodes the blob of an entry.
+		@type read: callable
+		@param entries: The offset and length of the blob of each row.
+		@type entries: list
+		"""
+		super(SnapshotRows, self).__init__()
+		self.read = read
+		self.entries = entries
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self.read(entry) for entry in self.entries[index]]
+		return self.read(self.entries[index])
+
+
+class CatalogSnapshot(object):
+	"""
+	Reads the catalog from the memory-mapped snapshot file, building it first if it is missing or stale.
+	"""
+
+	def __init__(self):
+		super(CatalogSnapshot, self).__init__()
+		self._lock = threading.Lock()
+		self._map = None
+		self._index = None
+		self._inode = None
+		self._builder = None  # the thread building the snapshot, if any
+
+	@property
+	def config(self):
+		return getattr(settings, 'CATALOG_SNAPSHOT', {})
+
+	@property
+	def path(self):
+		return self.config.get('PATH')
+
+	@use_primary
+	def build(self, version, instance):
+		"""
+		Serializes the catalog into a new snapshot file and atomically swaps it in place of the current one.
+		Workers that still map the previous file keep reading it until they remap. The catalog is read from the primary,
+		as the rows of a lagging replica would be stamped with generations they do not include until the next write.
+		@param version: The shared generations of the catalog models the snapshot is built from.
+		@type version: tuple
+		@param instance: The identity of the database the snapshot is built from, see InvalidationBus.instance.
+		@type instance: str
+		"""
+		encoder = DjangoJSONEncoder(separators = (',', ':'))
+		blobs, forms = [], {}
+		offset = [0]
+
+		def add(payload):
+			blob = encoder.encode(payload).encode('utf-8')
+			blobs.append(blob)
+			offset[0] += len(blob)
+			return [offset[0] - len(blob), len(blob)]
+
+		all_risk_types = list(RiskTypeService().filter().order_by('date_created').values('id', 'name'))
+		built, digests = build_forms(all_risk_types, all_risk_types = True), {}
+		for risk_type in all_risk_types:
+			form = built[risk_type['id']]
+			digests[risk_type['id']] = form_digest(form)
+			entry = add(form)
+			forms[risk_type['id']] = entry
+			forms[risk_type['name']] = entry  # ordered by date_created, so the most recent RiskType keeps the name
+		risk_types = list(RiskTypeService().filter(~Q(state_id__in = state_registry.ids('Deleted'))).order_by(
+			*ORDERING).values(*RISK_TYPE_FIELDS))
+		entries, keys = [], []  # the pagination keys, kept apart as the json dates of the rows are cut to milliseconds
+		for risk_type in risk_types:
+			risk_type['state__name'] = state_registry.name(risk_type.pop('state_id'))
+			risk_type['form_digest'] = digests[risk_type['id']]
+			entries.append(add(risk_type))
+			keys.append(row_key(risk_type['date_created'], risk_type['id']))
+		index = encoder.encode({
+			'version': list(version), 'instance': instance, 'forms': forms, 'risk_types': entries,
+			'risk_type_keys': keys}).encode('utf-8')
+
+		temp_path = '%s.%s.tmp' % (self.path, os.getpid())
+		with open(temp_path, 'wb') as snapshot:
+			snapshot.write(HEADER.pack(MAGIC, len(index)))
+			snapshot.write(index)
+			for blob in blobs:
+				snapshot.write(blob)
+		os.replace(temp_path, self.path)
+
+	def _open(self):
+		"""
+		Maps the current snapshot file if it is not the one mapped already.
+		"""
+		inode = os.stat(self.path).st_ino
+		if inode == self._inode and self._map is not None:
+			return
+		with open(self.path, 'rb') as snapshot:
+			mapped = mmap.mmap(snapshot.fileno(), 0, access = mmap.ACCESS_READ)
+		magic, length = HEADER.unpack_from(mapped)
+		if magic != MAGIC:
+			mapped.close()
+			raise ValueError('%s is not a catalog snapshot' % self.path)
+		start = HEADER.size + length
+		index = json.loads(mapped[HEADER.size:start].decode('utf-8'))
+		index['start'] = start
+		if self._map is not None:
+			self._map.close()
+		self._map, self._index, self._inode = mapped, index, inode
+
+	def _build_locked(self, version, instance):
+		"""
+		Builds the snapshot unless another process is building it or has built it already. Returns whether this process
+		built it.
+		"""
+		os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok = True)
+		with open('%s.lock' % self.path, 'a') as lock:
+			if fcntl is not None:
+				try:
+					fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+				except (IOError, OSError):
+					return False  # someone else is building it, we read from the db in the meantime
+			try:
+				with self._lock:
+					self._open_if_exists()
+					fresh = self._fresh(version, instance)
+				if not fresh:
+					self.build(version, instance)
+				return not fresh
+			finally:
+				if fcntl is not None:
+					fcntl.flock(lock, fcntl.LOCK_UN)
+
+	def _build_in_background(self, version, instance):
+		"""
+		Builds the snapshot on a thread of its own, unless one is building it already, so that no request waits for it.
+		The thread's connections are closed afterwards as nothing else closes them.
+		"""
+		if self._builder is not None and self._builder.is_alive():
+			return
+
+		def run():
+			try:
+				self._build_locked(version, instance)
+			except Exception as e:
+				lgr.exception('CatalogSnapshot build exception: %s', e)
+			finally:
+				connections.close_all()
+
+		self._builder = threading.Thread(target = run, name = 'catalog-snapshot', daemon = True)
+		self._builder.start()
+
+	def wait(self, timeout = None):
+		"""
+		Waits for the snapshot being built in the background, if any, e.g. to warm it up.
+		@param timeout: The number of seconds to wait at most, None to wait for as long as the build takes.
+		@type timeout: float | None
+		"""
+		builder = self._builder
+		if builder is not None:
+			builder.join(timeout)
+
+	def _open_if_exists(self):
+		if os.path.exists(self.path):
+			try:
+				self._open()
+			except ValueError as e:  # e.g. a snapshot written by an older layout, it is rebuilt as if missing
+				lgr.warning('CatalogSnapshot open exception: %s' % e)
+
+	def _fresh(self, version, instance):
+		"""
+		Checks whether the mapped snapshot was built from exactly the given generations of the given database.
+		"""
+		return self._index is not None and self._index.get('instance') == instance and \
+			self._index['version'] == list(version)
+
+	def _ahead(self, version, instance):
+		"""
+		Checks whether the mapped snapshot was built by a process that has polled more recent writes than this one.
+		"""
+		return self._index is not None and self._index.get('instance') == instance and any(
+			built > wanted for built, wanted in zip(self._index['version'], version))
+
+	def _current(self):
+		"""
+		Retrieves the index of an up to date snapshot, starting to build the snapshot in the background if it is missing
+		or stale.
+		@return: The index of the snapshot or None if the db has to be read instead.
+		@rtype: dict | None
+		"""
+		if not (self.config.get('ENABLED', False) and self.path) or connection.in_atomic_block:
+			return None
+		invalidation_bus.sync()
+		version, instance = invalidation_bus.generations(*CATALOG_MODELS), invalidation_bus.instance()
+		if version is None or instance is None:
+			return None
+		self._open_if_exists()  # picks up a newer file swapped in by another process
+		if self._ahead(version, instance):
+			# catch up with the writes the snapshot was built from rather than building it again from older ones
+			invalidation_bus.poll(force = True)
+			version, instance = invalidation_bus.generations(*CATALOG_MODELS), invalidation_bus.instance()
+		if not self._fresh(version, instance):
+			self._build_in_background(version, instance)
+			return None
+		return self._index
+
+	def _read(self, entry):
+		start = self._index['start'] + entry[0]
+		return json.loads(self._map[start:start + entry[1]].decode('utf-8'))
+
+	def form(self, risk_type_id):
+		"""
+		Retrieves the form of a RiskType from the snapshot.
+		@param risk_type_id: The id or name of the RiskType.
+		@type risk_type_id: str
+		@return: The RiskType and its active fields as returned by Interface.get_risk_type, or None if the RiskType is
+		not in the snapshot or the snapshot is not available.
+		@rtype: dict | None
+		"""
+		try:
+			with self._lock:
+				index = self._current()
+				if index is not None and risk_type_id in index['forms']:
+					return self._read(index['forms'][risk_type_id])
+		except Exception as e:
+			lgr.exception('CatalogSnapshot form exception: %s', e)
+		return None
+
+	def risk_types(self, cursor = None, limit = None):
+		"""
+		Retrieves a page of the RiskTypes that are not Deleted, most recent first, as returned by Interface.risk_types.
+		@param cursor: The next_cursor returned with the previous page, None for the first page.
+		@type cursor: str | None
+		@param limit: The number of RiskTypes of the page.
+		@type limit: str | int | None
+		@return: The RiskTypes and the cursor of the next page, or None if the snapshot is not available.
+		@rtype: tuple | None
+		@raise ValueError: If the cursor or the limit is invalid.
+		"""
+		page_limit(limit)
+		if cursor:
+			decode_cursor(cursor)
+		try:
+			with self._lock:
+				index = self._current()
+				if index is not None:  # only the rows of the page are decoded, while the file stays mapped
+					return keyset_slice(
+						SnapshotRows(self._read, index['risk_types']), index['risk_type_keys'], cursor, limit)
+		except Exception as e:
+			lgr.exception('CatalogSnapshot risk_types exception: %s', e)
+		return None
+
+
+catalog_snapshot = CatalogSnapshot()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+The summary of the Risks of each Customer, denormalized into CustomerSummary.
+Every write of a Risk or RiskData summarizes the Risks of its Customer again, within the same transaction and under
+a lock on the summary row, so concurrent writes for the same Customer cannot leave it behind. A write made within a
+transaction is rolled back along with a summary that fails. The writes that bypass the signals, e.g. queryset updates,
+and the summaries failing after an autocommitted write are caught up by the reconcile_customer_summaries command.
+"""
+import logging
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, Max
+
+from base.backend.state_registry import state_registry
+from core.backend.services import CustomerSummaryService
+from core.models import Customer, Risk
+
+lgr = logging.getLogger(__name__)
+
+SUMMARY_COLUMNS = ('risk_count', 'risk_type_count', 'risk_types', 'last_risk_date', 'last_activity')
+
+
+def latest(*dates):
+	"""
+	Returns the latest of the dates that are set, None if none is.
+	"""
+	dates = [value for value in dates if value is not None]
+	return max(dates) if dates else None
+
+
+def summarize(customer_ids):
+	"""
+	Summarizes the Risks of several Customers, those not Deleted, in a single query grouped by Customer and RiskType.
+	@param customer_ids: The ids of the Customers.
+	@type customer_ids: list
+	@return: The values of the SUMMARY_COLUMNS keyed by Customer id, zeros for the Customers without Risks.
+	@rtype: dict
+	"""
+	summaries = dict(
+		(str(pk), {'risk_count': 0, 'risk_type_count': 0, 'risk_types': '', 'last_risk_date': None,
+			'last_activity': None}) for pk in customer_ids)
+	groups = Risk.objects.filter(customer_id__in = list(summaries)).exclude(
+		state_id__in = state_registry.ids('Deleted')).values(
+		'customer_id', 'risk_type_id', 'risk_type__name').annotate(
+		risks = Count('id', distinct = True), last_created = Max('date_created'), last_modified = Max('date_modified'),
+		last_answered = Max('riskdata__date_modified')).order_by()
+	names = defaultdict(set)
+	for group in groups:
+		customer_id = str(group['customer_id'])
+		summary = summaries[customer_id]
+		summary['risk_count'] += group['risks']
+		summary['risk_type_count'] += 1
+		summary['last_risk_date'] = latest(summary['last_risk_date'], group['last_created'])
+		summary['last_activity'] = latest(
+			summary['last_activity'], group['last_modified'], group['last_answered'])
+		names[customer_id].add(group['risk_type__name'])
+	for customer_id, risk_types in names.items():
+		summaries[customer_id]['risk_types'] = ', '.join(sorted(risk_types))
+	return summaries
+
+
+def refresh_summary(customer_id, create = True):
+	"""
+	Summarizes the Risks of a Customer again after one of them, or of their RiskData, is written.
+	Within the transaction of the write, e.g. Interface.submit_risk, it runs without a savepoint of its own, so that a
+	failure rolls the write back too. An autocommitted write is committed already, so a failure then leaves the summary
+	behind until the reconcile_customer_summaries command catches it up.
+	@param customer_id: The id of the Customer.
+	@type customer_id: str
+	@param create: Whether to create the summary if the Customer has none yet. The deletes cascading from the Customer
+	must not, as the summary is deleted along with it.
+	@type create: bool
+	@return: The summary, None if there is none and create is False.
+	@rtype: CustomerSummary | None
+	@raise ValueError: If the summary cannot be written.
+	"""
+	with transaction.atomic(savepoint = False):
+		summary = CustomerSummaryService().filter(customer_id = customer_id).select_for_update().first()
+		if summary is None and not create:
+			return None
+		values = summarize([customer_id])[str(customer_id)]
+		if summary is None:
+			summary = CustomerSummaryService().create(customer_id = customer_id, **values)
+		elif any(getattr(summary, column) != values[column] for column in SUMMARY_COLUMNS):
+			summary = CustomerSummaryService().update(summary.id, **values)
+		if summary is None:
+			raise ValueError('Failed to write the CustomerSummary of Customer %s' % customer_id)
+		return summary
+
+
+def reconcile_summaries(batch_size = 500):
+	"""
+	Summarizes the Risks of all the Customers again, creating the missing summaries and fixing the stale ones.
+	The Customers are walked by id a batch at a time, each batch locked, summarized and written in one transaction.
+	@param batch_size: The number of Customers per batch.
+	@type batch_size: int
+	@return: The number of summaries created and the number updated.
+	@rtype: tuple
+	"""
+	created, updated, last = 0, 0, None
+	while True:
+		customers = Customer.objects.order_by('id')
+		if last is not None:
+			customers = customers.filter(id__gt = last)
+		customer_ids = [str(pk) for pk in customers.values_list('id', flat = True)[:batch_size]]
+		if not customer_ids:
+			return created, updated
+		last = customer_ids[-1]
+		with transaction.atomic():
+			existing = dict(
+				(str(row['customer_id']), row) for row in CustomerSummaryService().filter(
+					customer_id__in = customer_ids).select_for_update().values('id', 'customer_id', *SUMMARY_COLUMNS))
+			summaries = summarize(customer_ids)
+			creates = [
+				dict(values, customer_id = customer_id) for customer_id, values in summaries.items()
+				if customer_id not in existing]
+			updates = [
+				dict(values, id = existing[customer_id]['id']) for customer_id, values in summaries.items()
+				if customer_id in existing and any(
+					existing[customer_id][column] != values[column] for column in SUMMARY_COLUMNS)]
+			if creates:
+				result = CustomerSummaryService().bulk_create(creates, batch_size)
+				if result is None:
+					lgr.error('reconcile_summaries failed to create %s CustomerSummaries', len(creates))
+				else:
+					created += len([summary for summary in result[0] if summary is not None])
+			if updates:
+				result = CustomerSummaryService().bulk_update(updates, batch_size)
+				if result is None:
+					lgr.error('reconcile_summaries failed to update %s CustomerSummaries', len(updates))
+				else:
+					updated += len([pk for pk in result[0] if pk is not None])
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of the rendered RiskType forms.
+Every form is cached together with its digest, a hash of the RiskType and its active RiskFields that serves as the
+strong ETag of the form. The entries are keyed with the generations of the catalog models, the ones published through
+the InvalidationBus for a shared backend, so any write to a State, RiskType or RiskField, in this process or polled
+from the InvalidationBus, stops them from being served.
+"""
+import hashlib
+import logging
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+
+from base.backend.query_cache import query_cache
+from base.backend.state_registry import state_registry
+from base.models import State
+from core.backend.services import RiskFieldService
+from core.models import RiskField, RiskType
+
+lgr = logging.getLogger(__name__)
+
+FORM_MODELS = (State, RiskType, RiskField)
+FORM_FIELDS = (
+	'caption', 'field_type', 'order', 'min_length', 'max_length', 'max_digits', 'decimal_places', 'nullable',
+	'default_value', 'id')
+FORM_FIELDS_ORDER = ('order', 'id')  # the id breaks the ties, so that equal forms always hash to equal digests
+
+
+def build_forms(risk_types, all_risk_types = False):
+	"""
+	Builds the forms of several RiskTypes with a single RiskField query.
+	@param risk_types: The RiskTypes, as dicts holding at least their id and name.
+	@type risk_types: list
+	@param all_risk_types: Whether the RiskTypes are all the RiskTypes, so the RiskFields need not be filtered by them.
+	@type all_risk_types: bool
+	@return: The form of each RiskType, as returned by Interface.get_risk_type, keyed by the RiskType id.
+	@rtype: dict
+	"""
+	fields = {}
+	risk_fields = RiskFieldService().filter(state_id__in = state_registry.ids('Active'))
+	if not all_risk_types:
+		risk_fields = risk_fields.filter(risk_type_id__in = [risk_type['id'] for risk_type in risk_types])
+	for risk_field in risk_fields.order_by('risk_type_id', *FORM_FIELDS_ORDER).values('risk_type_id', *FORM_FIELDS):
+		fields.setdefault(risk_field.pop('risk_type_id'), []).append(risk_field)
+	return dict((risk_type['id'], {
+		'risk_type': {'name': risk_type['name'], 'id': risk_type['id']},
+		'risk_fields': fields.get(risk_type['id'], [])}) for risk_type in risk_types)
+
+
+def form_digest(form):
+	"""
+	Hashes a form into the digest clients validate their copy against.
+	@param form: The form as returned by Interface.get_risk_type, i.e. the RiskType and its active RiskFields.
+	@type form: dict
+	@return: The hex digest of the canonical JSON of the form.
+	@rtype: str
+	"""
+	encoded = DjangoJSONEncoder(sort_keys = True, separators = (',', ':')).encode(form)
+	return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+
+class FormCache(object):
+	"""
+	Stores the forms in the query cache backend, next to the query results.
+	"""
+
+	def __init__(self, ttl = 3600):
+		"""
+		@param ttl: The number of seconds a form stays cached. The generations in the key invalidate it before that.
+		@type ttl: int
+		"""
+		super(FormCache, self).__init__()
+		self.ttl = ttl
+
+	@staticmethod
+	def make_key(risk_type_id):
+		"""
+		Builds the key of a form from the id or name it was requested by and the catalog generations, polling the
+		InvalidationBus first like any cached read so that the writes of the other processes are seen.
+		@param risk_type_id: The id or name of the RiskType.
+		@type risk_type_id: str
+		@return: The cache key or None if the form must not be cached, i.e. inside a transaction or in a shared backend
+		before the generations are polled.
+		@rtype: str | None
+		"""
+		if not query_cache.enabled or connection.in_atomic_block:
+			return None
+		query_cache.prepare()
+		generations = query_cache.key_generations(FORM_MODELS)
+		if generations is None:
+			return None
+		return 'form:%s' % hashlib.sha1(repr((str(risk_type_id), generations)).encode('utf-8')).hexdigest()
+
+	def get(self, key):
+		"""
+		Retrieves a cached form.
+		@param key: The key as returned by make_key.
+		@type key: str | None
+		@return: The form and its digest, or None on a miss.
+		@rtype: tuple | None
+		"""
+		if key is None:
+			return None
+		found, value = query_cache.get(key)
+		return value if found else None
+
+	def set(self, key, form):
+		"""
+		Caches a form. The key must have been built before the form was read, so that a write committed in between
+		leaves the form under the generations it was read at.
+		@param key: The key as returned by make_key.
+		@type key: str | None
+		@param form: The RiskType and its active RiskFields.
+		@type form: dict
+		@return: The form and its digest.
+		@rtype: tuple
+		"""
+		entry = (form, form_digest(form))
+		if key is not None:
+			query_cache.set(key, entry, self.ttl)
+		return entry
+
+
+form_cache = FormCache()
@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+"""
+Wide tables projecting the Risks of a RiskType, one row per Risk and one column per active RiskField.
+Listing the Risks off the RiskData means pivoting a row per field per Risk, so a RiskType can have its Risks projected
+into a table of their own with the build_risk_projections command. The table is then kept up to date as the Risks and
+RiskData are written, and read instead of the RiskData for as long as the form it was built for is current.
+The tables are not part of the migrations: their models are built at runtime, from the form, in a registry of their own.
+Every write to a table happens under a lock on the RiskProjection row of its RiskType, taken by the writes of the Risks
+and by the builds alike, so that a table being built sees the writes made while it is filled and is only swapped in,
+and the previous one dropped, between two writes.
+Like every other listing, the tables leave out the Deleted Risks and RiskData, a Risk being removed from them once it is
+Deleted.
+"""
+import hashlib
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+
+from django.apps.registry import Apps
+from django.db import connections, models, router, transaction
+
+from base.backend.state_registry import state_registry
+from core.backend.catalog import catalog_snapshot
+from core.backend.form_cache import build_forms, form_digest
+from core.backend.risk_query import TYPED_COLUMNS, compile_predicates, display_value, to_date, to_number
+from core.backend.services import RiskDataService, RiskProjectionService, RiskService, RiskTypeService
+from core.models import RiskProjection
+
+lgr = logging.getLogger(__name__)
+
+TABLE_PREFIX = 'core_riskwide_'
+BASE_COLUMNS = ('id', 'customer_id', 'date_created')
+
+
+def column_name(risk_field_id):
+	"""
+	Names the column of a RiskField, the ids being too long and free form to be column names themselves.
+	"""
+	return 'f_%s' % hashlib.sha1(str(risk_field_id).encode('utf-8')).hexdigest()[:16]
+
+
+def projected_value(field_type, value):
+	"""
+	Converts the text value of a RiskData into what the column of its RiskField stores, None if it does not convert.
+	"""
+	if value in (None, ''):
+		return None
+	try:
+		if field_type == 'number':
+			return to_number(value)
+		if field_type == 'date':
+			return to_date(value)
+	except (ValueError, ArithmeticError):
+		return None
+	return value
+
+
+def current_form(risk_type_id):
+	"""
+	Retrieves the current form of a RiskType and its digest, from the catalog snapshot when it is available.
+	@param risk_type_id: The id or name of the RiskType.
+	@type risk_type_id: str
+	@return: The form and its digest, or None if there is no such RiskType.
+	@rtype: tuple | None
+	"""
+	form = catalog_snapshot.form(risk_type_id)
+	if form is None:
+		risk_type = RiskTypeService().filter(
+			models.Q(id = risk_type_id) | models.Q(name = risk_type_id)).order_by('-date_created').values(
+			'id', 'name').first()
+		if risk_type is None:
+			return None
+		form = build_forms([risk_type])[risk_type['id']]
+	return form, form_digest(form)
+
+
+class WideTables(object):
+	"""
+	Builds, maintains and reads the wide tables of the RiskTypes.
+	"""
+
+	def __init__(self, max_models = 256):
+		"""
+		@param max_models: The maximum number of table models kept, the least recently used being rebuilt on demand.
+		@type max_models: int
+		"""
+		super(WideTables, self).__init__()
+		self.max_models = max_models
+		self._models = OrderedDict()
+		self._lock = threading.Lock()
+
+	def model(self, db_table, form):
+		"""
+		Builds the model of a wide table. A table never changes columns, a new form getting a new table, so its model
+		is built once.
+		@param db_table: The name of the table.
+		@type db_table: str
+		@param form: The form the table projects.
+		@type form: dict
+		@return: The model of the table.
+		@rtype: type
+		"""
+		with self._lock:
+			model = self._models.get(db_table)
+			if model is not None:
+				self._models.move_to_end(db_table)
+				return model
+		label = hashlib.sha1(db_table.encode('utf-8')).hexdigest()[:8]
+		attrs = {
+			'__module__': __name__,
+			'id': models.CharField(max_length = 100, primary_key = True),
+			'customer_id': models.CharField(max_length = 100, db_index = True),
+			'date_created': models.DateTimeField(),
+			'Meta': type('Meta', (object, ), {
+				'db_table': db_table, 'app_label': 'core', 'apps': Apps(installed_apps = []),
+				'indexes': [models.Index(fields = ['-date_created', 'id'], name = 'rw_%s_page' % label)]}),
+		}
+		for risk_field in form['risk_fields']:
+			if risk_field['field_type'] == 'number':
+				field = models.DecimalField(max_digits = 30, decimal_places = 10, null = True, db_index = True)
+			elif risk_field['field_type'] == 'date':
+				field = models.DateField(null = True, db_index = True)
+			else:
+				field = models.CharField(max_length = 255, null = True, db_index = True)
+			attrs[column_name(risk_field['id'])] = field
+		# each model gets a registry of its own, so that the models of successive tables never clash
+		model = type(str('RiskWide_%s' % label), (models.Model, ), attrs)
+		with self._lock:
+			self._models[db_table] = model
+			while len(self._models) > self.max_models:
+				self._models.popitem(last = False)
+		return model
+
+	@staticmethod
+	def lock(risk_type_id):
+		"""
+		Locks the RiskProjection of a RiskType until the end of the current transaction. The lock is taken through the
+		manager, as the RiskProjectionService reads through the query cache, which never serves locked reads.
+		@param risk_type_id: The id of the RiskType.
+		@type risk_type_id: str
+		@return: The RiskProjection, None if the RiskType has none.
+		@rtype: RiskProjection | None
+		"""
+		return RiskProjection.objects.select_for_update().filter(risk_type_id = risk_type_id).first()
+
+	def targets(self, form, digest):
+		"""
+		Locks the RiskProjection of a RiskType and retrieves the models of the tables a write of one of its Risks goes
+		to, i.e. its table and the one being built to replace it, each if it projects the current form. The lock is
+		held until the end of the current transaction, so that neither table is swapped or dropped under the write.
+		@param form: The current form of the RiskType.
+		@type form: dict
+		@param digest: The digest of the form.
+		@type digest: str
+		@return: The models of the tables.
+		@rtype: list
+		"""
+		return self.tables(self.lock(form['risk_type']['id']), form, digest)
+
+	def tables(self, projection, form, digest):
+		"""
+		Retrieves the models of the tables of a RiskProjection that project the given form, see targets.
+		"""
+		if projection is None:
+			return []
+		return [
+			self.model(db_table, form) for db_table, table_digest in (
+				(projection.db_table, projection.form_digest), (projection.next_table, projection.next_digest))
+			if db_table and table_digest == digest]
+
+	def current(self, form, digest):
+		"""
+		Retrieves the model of the wide table of a RiskType if it projects the current form.
+		@param form: The current form of the RiskType.
+		@type form: dict
+		@param digest: The digest of the form.
+		@type digest: str
+		@return: The model of the table, or None if the RiskType has no table or its table projects an older form.
+		@rtype: type | None
+		"""
+		projection = RiskProjectionService().get(risk_type_id = form['risk_type']['id'])
+		if projection is None or projection.form_digest != digest:
+			return None
+		return self.model(projection.db_table, form)
+
+	@staticmethod
+	def row(form, risk, values):
+		"""
+		Builds the row of a Risk.
+		@param form: The form the table projects.
+		@type form: dict
+		@param risk: The id, customer_id and date_created of the Risk.
+		@type risk: dict
+		@param values: The text value of each RiskField, keyed by the id of the RiskField.
+		@type values: dict
+		@return: The column => value pairs of the row.
+		@rtype: dict
+		"""
+		row = dict((column, risk[column]) for column in BASE_COLUMNS)
+		for risk_field in form['risk_fields']:
+			row[column_name(risk_field['id'])] = projected_value(
+				risk_field['field_type'], values.get(str(risk_field['id'])))
+		return row
+
+	def insert(self, model, form, risk, values):
+		"""
+		Adds a new Risk to a wide table, within the transaction writing the Risk.
+		@param model: The model of the table, as returned by current.
+		@type model: type
+		@param form: The form the table projects.
+		@type form: dict
+		@param risk: The Risk.
+		@type risk: Risk
+		@param values: The text value of each RiskField, keyed by the id of the RiskField.
+		@type values: dict
+		"""
+		model(**self.row(form, {
+			'id': risk.id, 'customer_id': risk.customer_id, 'date_created': risk.date_created}, values)).save(
+			force_insert = True)
+
+	def refresh_risk(self, risk_id):
+		"""
+		Projects a Risk again from its RiskData, e.g. after one of them is edited, or removes it from the wide tables
+		once it is Deleted.
+		@param risk_id: The id of the Risk.
+		@type risk_id: str
+		@return: Whether the Risk has a row in a current wide table.
+		@rtype: bool
+		"""
+		risk = RiskService().filter(id = risk_id).values(
+			'id', 'risk_type_id', 'customer_id', 'date_created', 'state_id').first()
+		if risk is None:
+			return False
+		deleted = state_registry.ids('Deleted')
+		if risk.pop('state_id') in deleted:
+			self.remove_risk(risk_id, risk['risk_type_id'])
+			return False
+		with transaction.atomic(router.db_for_write(RiskProjection)):
+			projection = self.lock(risk['risk_type_id'])
+			form = current_form(risk['risk_type_id']) if projection is not None else None
+			tables = self.tables(projection, *form) if form is not None else []
+			if tables:
+				values = dict(
+					(str(field_id), value) for field_id, value in
+					RiskDataService().filter(risk_id = risk_id).exclude(state_id__in = deleted).values_list(
+						'risk_field_id', 'value'))
+				for model in tables:
+					model(**self.row(form[0], risk, values)).save()
+		return bool(tables)
+
+	def remove_risk(self, risk_id, risk_type_id):
+		"""
+		Removes a Risk deleted, or Deleted, from the wide tables of its RiskType.
+		"""
+		with transaction.atomic(router.db_for_write(RiskProjection)):
+			projection = self.lock(risk_type_id)
+			if projection is not None:
+				for db_table in (projection.db_table, projection.next_table):
+					if db_table:
+						self.drop_rows(db_table, [risk_id])
+
+	@staticmethod
+	def drop_rows(db_table, risk_ids):
+		connection = connections[router.db_for_write(RiskProjection)]
+		with connection.cursor() as cursor:
+			cursor.execute('DELETE FROM %s WHERE id IN (%s)' % (
+				connection.ops.quote_name(db_table), ', '.join(['%s'] * len(risk_ids))), [str(i) for i in risk_ids])
+
+	@staticmethod
+	def drop_table(db_table):
+		"""
+		Drops a wide table. Works within a transaction too, unlike the schema editor of some databases.
+		"""
+		if not db_table:
+			return
+		connection = connections[router.db_for_write(RiskProjection)]
+		with connection.cursor() as cursor:
+			cursor.execute('DROP TABLE IF EXISTS %s' % connection.ops.quote_name(db_table))
+
+	def _fill(self, model, form, batch_size):
+		"""
+		Projects the Risks of a RiskType into the wide table being built, a batch of Risks and a query for their
+		RiskData at a time. Each batch is read and written under the lock of the RiskProjection, so it projects the
+		committed values of its Risks and replaces the rows the writes made in the meantime have projected already.
+		The Deleted Risks and RiskData are left out, and so are the rows of the Risks Deleted in the meantime.
+		"""
+		risk_type_id = form['risk_type']['id']
+		deleted = state_registry.ids('Deleted')
+		last = None
+		while True:
+			with transaction.atomic(router.db_for_write(model)):
+				self.lock(risk_type_id)
+				page = RiskService().filter(risk_type_id = risk_type_id)
+				page = page.filter(id__gt = last) if last is not None else page
+				page = list(page.order_by('id').values(*(BASE_COLUMNS + ('state_id', )))[:batch_size])
+				if not page:
+					return
+				last = page[-1]['id']
+				model.objects.filter(id__in = [risk['id'] for risk in page]).delete()
+				page = [risk for risk in page if risk.pop('state_id') not in deleted]
+				values = {}
+				for risk_id, field_id, value in RiskDataService().filter(
+						risk_id__in = [risk['id'] for risk in page]).exclude(state_id__in = deleted).values_list(
+						'risk_id', 'risk_field_id', 'value'):
+					values.setdefault(risk_id, {})[str(field_id)] = value
+				model.objects.bulk_create([model(**self.row(form, risk, values.get(risk['id'], {}))) for risk in page])
+
+	def build(self, risk_type_id, batch_size = 1000):
+		"""
+		Builds the wide table of a RiskType from its Risks and RiskData, replacing its previous table if any.
+		The new table is recorded as the next table of the RiskProjection before it is filled, so that the writes of the
+		Risks made while it is filled go to it as well, then it is swapped in under the lock of the RiskProjection. The
+		RiskType is listed off the previous table or the RiskData until then.
+		@param risk_type_id: The id or name of the RiskType.
+		@type risk_type_id: str
+		@param batch_size: The number of Risks projected per statement.
+		@type batch_size: int
+		@return: The RiskProjection recording the table.
+		@rtype: RiskProjection
+		@raise ValueError: If there is no such RiskType, or another build of its table has superseded this one.
+		"""
+		form = current_form(risk_type_id)
+		if form is None:
+			raise ValueError('selected RiskType does not exist')
+		form, digest = form
+		risk_type_id = form['risk_type']['id']
+		db_table = '%s%s_%s' % (
+			TABLE_PREFIX, hashlib.sha1(str(risk_type_id).encode('utf-8')).hexdigest()[:12], uuid.uuid4().hex[:8])
+		model = self.model(db_table, form)
+		using = router.db_for_write(model)
+		with connections[using].schema_editor() as editor:
+			editor.create_model(model)
+		try:
+			with transaction.atomic(using):
+				# a RiskType projected for the first time gets a RiskProjection without a table, for the writes to lock
+				projection = self.lock(risk_type_id) or RiskProjection(
+					risk_type_id = risk_type_id, db_table = '', form_digest = '')
+				projection.next_table, projection.next_digest = db_table, digest
+				projection.save()
+			self._fill(model, form, batch_size)
+			with transaction.atomic(using):
+				projection = self.lock(risk_type_id)
+				if projection is None or projection.next_table != db_table:
+					raise ValueError('the table of RiskType %s is being built by another build' % risk_type_id)
+				previous = projection.db_table
+				projection.db_table, projection.form_digest, projection.rows = db_table, digest, model.objects.count()
+				projection.next_table = projection.next_digest = None
+				projection.save()
+		except Exception:
+			with transaction.atomic(using):
+				projection = self.lock(risk_type_id)
+				if projection is not None and projection.next_table == db_table:
+					if projection.db_table:
+						projection.next_table = projection.next_digest = None
+						projection.save()
+					else:
+						projection.delete()
+			self.drop_table(db_table)
+			raise
+		# no write can still be using the previous table, as they resolve the tables under the lock
+		if previous != db_table:
+			self.drop_table(previous)
+		return projection
+
+	def drop(self, risk_type_id):
+		"""
+		Drops the wide table of a RiskType, whose Risks are then listed off the RiskData.
+		@return: Whether the RiskType had a wide table.
+		@rtype: bool
+		"""
+		with transaction.atomic(router.db_for_write(RiskProjection)):
+			projection = self.lock(risk_type_id)
+			if projection is None:
+				return False
+			projection.delete()  # the table goes with it, see core.signals
+		return True
+
+	@staticmethod
+	def filter(model, form, predicates):
+		"""
+		Filters the rows of a wide table on predicates, see core.backend.risk_query.compile_predicate.
+		The numbers and dates are compared on the indexed columns of the table. The text is compared through the
+		case folded values of the RiskData that are not Deleted, the table keeping the text as it was entered.
+		@return: The rows matching all the predicates, and the column of each RiskField keyed by the id of the RiskField
+		@rtype: tuple
+		@raise ValueError: If a predicate does not fit the form.
+		"""
+		queryset = model.objects.all()
+		for lookups in compile_predicates(form, predicates):
+			field_id = lookups.pop('risk_field_id')
+			(lookup, value), = lookups.items()
+			typed, operator = lookup.split('__', 1)
+			if typed == TYPED_COLUMNS['text']:
+				queryset = queryset.filter(id__in = RiskDataService().filter(
+					risk_field_id = field_id, **lookups).exclude(state_id__in = state_registry.ids('Deleted')).values(
+					'risk_id'))
+			else:
+				queryset = queryset.filter(**{'%s__%s' % (column_name(field_id), operator): value})
+		columns = OrderedDict(
+			(column_name(risk_field['id']), str(risk_field['id'])) for risk_field in form['risk_fields'])
+		return queryset, columns
+
+	@staticmethod
+	def values(row, columns):
+		"""
+		Reads the values of the RiskFields out of a values() row of a wide table.
+		@return: The value of each RiskField that has one, keyed by the id of the RiskField.
+		@rtype: dict
+		"""
+		return dict(
+			(field_id, display_value(row[column])) for column, field_id in columns.items()
+			if row[column] is not None)
+
+
+wide_tables = WideTables()
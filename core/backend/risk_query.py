@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Typed storage and queries of the RiskData values.
+Next to its text value every RiskData holds the value typed after the field_type of its RiskField, in value_number,
+value_date or value_text. The predicates of a query, e.g. {'field': 'Year', 'op': 'gt', 'value': 2015}, are compiled
+into lookups on the typed column of their RiskField, which the (risk_field, typed value) indexes of RiskData serve.
+"""
+import logging
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+
+from base.backend.state_registry import state_registry
+from core.backend.services import RiskDataService
+from core.models import Risk, RiskData
+
+lgr = logging.getLogger(__name__)
+
+DATE_FORMAT = '%Y-%m-%d'
+# the typed column of each field_type
+TYPED_COLUMNS = {
+	'number': 'value_number', 'date': 'value_date', 'text': 'value_text', 'email': 'value_text', 'file': 'value_text'}
+# predicate operator => (lookup, how many values it takes: 1, 2 or any)
+OPERATORS = {
+	'eq': ('exact', 1), 'lt': ('lt', 1), 'lte': ('lte', 1), 'gt': ('gt', 1), 'gte': ('gte', 1), 'in': ('in', None),
+	'range': ('range', 2), 'startswith': ('startswith', 1),
+}
+NUMBER_PLACES = Decimal('1e-10')  # the decimal_places of RiskData.value_number
+NUMBER_LIMIT = Decimal(10) ** 20  # and the integer digits it leaves
+TEXT_LENGTH = RiskData._meta.get_field('value_text').max_length
+
+
+def normalize_text(value):
+	"""
+	Normalizes a textual value for comparisons, collapsing the white space and folding the case.
+	Case folding can lengthen a value, e.g. 'ß' folds to 'ss', so the result is cut to the size of value_text, both
+	when it is stored and when it is compared with, and the values differing only past it compare equal.
+	"""
+	return ' '.join(str(value).split()).casefold()[:TEXT_LENGTH]
+
+
+def to_number(value):
+	"""
+	Converts a value to what value_number stores.
+	@raise ValueError: If the value is not a number value_number can hold.
+	"""
+	try:
+		number = Decimal(str(value).strip())
+	except (InvalidOperation, ValueError):
+		raise ValueError('%s is not a number' % value)
+	if not number.is_finite() or abs(number) >= NUMBER_LIMIT:
+		raise ValueError('%s is out of range' % value)
+	return number.quantize(NUMBER_PLACES)
+
+
+def to_date(value):
+	"""
+	Converts a value to what value_date stores.
+	@raise ValueError: If the value is not a date formatted as DATE_FORMAT.
+	"""
+	if isinstance(value, datetime):
+		return value.date()
+	if isinstance(value, date):
+		return value
+	return datetime.strptime(str(value).strip(), DATE_FORMAT).date()
+
+
+CONVERTERS = {'value_number': to_number, 'value_date': to_date, 'value_text': normalize_text}
+
+
+def typed_columns(field_type, value):
+	"""
+	Types a value after the field_type of its RiskField.
+	@param field_type: The field_type of the RiskField.
+	@type field_type: str
+	@param value: The text value of the RiskData.
+	@type value: str
+	@return: The typed columns of the RiskData, all None but the one of the field_type. It is None too if the value
+	cannot be typed, in which case only the text value is stored.
+	@rtype: dict
+	"""
+	columns = dict.fromkeys(CONVERTERS)
+	column = TYPED_COLUMNS.get(field_type)
+	if column is not None and value not in (None, ''):
+		try:
+			columns[column] = CONVERTERS[column](value)
+		except (ValueError, ArithmeticError):
+			pass
+	return columns
+
+
+def form_fields(form):
+	"""
+	Indexes the RiskFields of a form by id and by case folded caption, the two ways a predicate can name a field.
+	@param form: The form as returned by Interface.get_risk_type.
+	@type form: dict
+	@return: The (id, field_type) of each RiskField, None for the captions shared by several RiskFields.
+	@rtype: dict
+	"""
+	fields = {}
+	for risk_field in form['risk_fields']:
+		field = (str(risk_field['id']), risk_field['field_type'])
+		caption = normalize_text(risk_field['caption'])
+		fields[caption] = None if caption in fields else field
+		fields[field[0]] = field
+	return fields
+
+
+def compile_predicate(fields, predicate):
+	"""
+	Compiles a predicate into the lookups of the RiskData matching it.
+	@param fields: The RiskFields of the form, as returned by form_fields.
+	@type fields: dict
+	@param predicate: The field, by id or caption, the op from OPERATORS and the value(s) to compare with.
+	e.g. {'field': 'Year', 'op': 'gte', 'value': 2015} or {'field': 'Year', 'op': 'range', 'value': [2015, 2019]}
+	@type predicate: dict
+	@return: The keyword lookups on RiskData.
+	@rtype: dict
+	@raise ValueError: If the field, op or value does not fit the form.
+	"""
+	name = predicate.get('field')
+	field = fields.get(str(name)) or fields.get(normalize_text(name or ''))
+	if field is None:
+		raise ValueError('Unknown or ambiguous field: %s' % name)
+	field_id, field_type = field
+	op = predicate.get('op', 'eq')
+	if op not in OPERATORS:
+		raise ValueError('Unknown op: %s, choose from %s' % (op, ', '.join(sorted(OPERATORS))))
+	lookup, arity = OPERATORS[op]
+	column = TYPED_COLUMNS.get(field_type)
+	if column is None or (op == 'startswith' and column != 'value_text'):
+		raise ValueError('%s cannot be compared with %s' % (name, op))
+	value = predicate.get('value')
+	if arity == 1 and isinstance(value, (list, tuple)):
+		raise ValueError('%s takes a single value' % op)
+	if arity != 1 and (not isinstance(value, (list, tuple)) or not value or (arity and len(value) != arity)):
+		raise ValueError('%s takes a list of %s values' % (op, arity or 'one or more'))
+	try:
+		value = CONVERTERS[column](value) if arity == 1 else [CONVERTERS[column](item) for item in value]
+	except (ValueError, ArithmeticError):
+		raise ValueError('Invalid value for %s: %s' % (name, predicate.get('value')))
+	return {'risk_field_id': field_id, '%s__%s' % (column, lookup): value}
+
+
+def compile_predicates(form, predicates):
+	"""
+	Compiles the predicates of a query on the Risks of a form, see compile_predicate.
+	@param form: The form of the RiskType, as returned by Interface.get_risk_type.
+	@type form: dict
+	@param predicates: The predicates.
+	@type predicates: list | None
+	@return: The RiskData lookups of each predicate.
+	@rtype: list
+	@raise ValueError: If a predicate does not fit the form.
+	"""
+	fields = form_fields(form)
+	compiled = []
+	for predicate in predicates or []:
+		if not isinstance(predicate, dict):
+			raise ValueError('Predicates must be objects')
+		compiled.append(compile_predicate(fields, predicate))
+	return compiled
+
+
+def filter_risks(form, predicates, queryset = None):
+	"""
+	Filters the Risks of a RiskType down to the ones whose RiskData match all the predicates.
+	Each predicate is one subquery on RiskData seeking its (risk_field, typed value) index. The Deleted Risks, and the
+	Deleted RiskData, are left out like in every other listing.
+	@param form: The form of the RiskType, as returned by Interface.get_risk_type.
+	@type form: dict
+	@param predicates: The predicates, see compile_predicate.
+	@type predicates: list
+	@param queryset: The Risks to filter. Defaults to all of them.
+	@type queryset: QuerySet | None
+	@return: The Risks of the RiskType matching the predicates.
+	@rtype: QuerySet
+	@raise ValueError: If a predicate does not fit the form.
+	"""
+	deleted = state_registry.ids('Deleted')
+	queryset = (Risk.objects.all() if queryset is None else queryset).filter(
+		risk_type_id = form['risk_type']['id']).exclude(state_id__in = deleted)
+	for lookups in compile_predicates(form, predicates):
+		queryset = queryset.filter(
+			id__in = RiskData.objects.filter(**lookups).exclude(state_id__in = deleted).values('risk_id'))
+	return queryset
+
+
+def answer(value, value_number = None, value_date = None):
+	"""
+	Renders the value of a RiskData the way the Risks are listed, from its typed value when it has one.
+	"""
+	typed = value_number if value_number is not None else value_date
+	return display_value(typed) if typed is not None else value
+
+
+def display_value(value):
+	"""
+	Renders a stored value the way the Risks are listed, the typed values in their canonical text form.
+	e.g. Decimal('2015.0000000000') => '2015', date(2019, 1, 12) => '2019-01-12'
+	"""
+	if isinstance(value, Decimal):
+		return format(value.normalize(), 'f')
+	if isinstance(value, date):
+		return value.isoformat()
+	return value
+
+
+def backfill_typed_values(batch_size = 500):
+	"""
+	Types the values of the RiskData stored before the typed columns, or with all of them still empty, see the
+	backfill_typed_values command. The RiskData are walked by id a batch at a time, so no cursor stays open over the
+	rows being updated.
+	@param batch_size: The number of RiskData read and updated per statement.
+	@type batch_size: int
+	@return: The number of RiskData typed.
+	@rtype: int
+	"""
+	untyped = RiskData.objects.filter(
+		value_number__isnull = True, value_date__isnull = True, value_text__isnull = True).exclude(value = '')
+	typed, last = 0, None
+	while True:
+		batch = untyped.filter(id__gt = last) if last is not None else untyped
+		batch = list(batch.order_by('id').values_list('id', 'value', 'risk_field__field_type')[:batch_size])
+		if not batch:
+			return typed
+		last = batch[-1][0]
+		rows = [dict(typed_columns(field_type, value), id = pk) for pk, value, field_type in batch]
+		rows = [row for row in rows if any(row[column] is not None for column in CONVERTERS)]
+		if rows:
+			result = RiskDataService().bulk_update(rows, batch_size)
+			if result is None:
+				lgr.error('backfill_typed_values failed to update %s RiskData', len(rows))
+			else:
+				typed += len([pk for pk in result[0] if pk is not None])
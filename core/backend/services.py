@@ -2,8 +2,10 @@
 """
 data access layer for our models in the base module
 """
+from django.db.models import Prefetch
+
 from base.backend.service_base import ServiceBase
-from core.models import Customer, Risk, RiskData, RiskField, RiskType
+from core.models import Customer, CustomerSummary, Risk, RiskData, RiskField, RiskProjection, RiskType
 
 
 class CustomerService(ServiceBase):
@@ -12,6 +14,22 @@ class CustomerService(ServiceBase):
 	All database transactions involving Customer model will have to use this class
 	"""
 	manager = Customer.objects
+	cache_ttl = 30
+	profiles = {
+		# the Customer, their Risks and every answer in three queries
+		'portfolio': {'prefetch_related': (
+			Prefetch('risk_set', queryset = Risk.objects.select_related('risk_type').order_by('-date_created', 'id')),
+			Prefetch('risk_set__riskdata_set', queryset = RiskData.objects.select_related('risk_field').order_by(
+				'risk_field__order', 'risk_field_id')))},
+	}
+
+
+class CustomerSummaryService(ServiceBase):
+	"""
+	CRUD operations for the CustomerSummary model
+	All database transactions involving CustomerSummary model will have to use this class
+	"""
+	manager = CustomerSummary.objects
 
 
 class RiskService(ServiceBase):
@@ -36,6 +54,7 @@ class RiskFieldService(ServiceBase):
 	All database transactions involving RiskField model will have to use this class
 	"""
 	manager = RiskField.objects
+	cache_ttl = 300
 
 
 class RiskTypeService(ServiceBase):
@@ -44,3 +63,17 @@ class RiskTypeService(ServiceBase):
 	All database transactions involving RiskType model will have to use this class
 	"""
 	manager = RiskType.objects
+	cache_ttl = 300
+	profiles = {
+		'form': {'only': ('id', 'name')},
+		'write': {'only': ('id', 'state', 'has_form', 'date_modified')},
+	}
+
+
+class RiskProjectionService(ServiceBase):
+	"""
+	CRUD operations for the RiskProjection model
+	All database transactions involving RiskProjection model will have to use this class
+	"""
+	manager = RiskProjection.objects
+	cache_ttl = 300  # read on every write and read of the Risks, invalidated whenever a projection is (re)built
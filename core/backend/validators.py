@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Validators of the values submitted for the RiskFields of a form.
+A form is compiled once into a check per RiskField and the compiled form is kept by the digest of the form, so the
+RiskField constraints are not interpreted again on every submission. A change to the form changes its digest, which
+compiles the new version on its next submission.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+
+lgr = logging.getLogger(__name__)
+
+VALUE_MAX_LENGTH = 255  # the size of RiskData.value, which bounds every value whatever its RiskField allows
+DATE_FORMAT = '%Y-%m-%d'
+
+
+def _check_length(min_length, max_length):
+	"""
+	Builds the check of the length of a textual value.
+	"""
+	max_length = min(max_length or VALUE_MAX_LENGTH, VALUE_MAX_LENGTH)
+	min_length = min_length or 0
+
+	def check(value):
+		if len(value) < min_length:
+			return 'must be at least %s characters' % min_length
+		if len(value) > max_length:
+			return 'must be at most %s characters' % max_length
+		return None
+
+	return check
+
+
+def _check_number(max_digits, decimal_places):
+	"""
+	Builds the check of a numeric value against the digits of the DecimalField it would be stored in.
+	"""
+
+	def check(value):
+		try:
+			number = Decimal(value)
+		except (InvalidOperation, TypeError, ValueError):
+			return 'must be a number'
+		if not number.is_finite():
+			return 'must be a number'
+		_, digits, exponent = number.as_tuple()
+		places, whole = max(-exponent, 0), max(len(digits) + exponent, 0)
+		if decimal_places is not None and places > decimal_places:
+			return 'must have at most %s decimal places' % decimal_places
+		if max_digits is not None and whole + (decimal_places or 0) > max_digits:
+			return 'must have at most %s digits' % max_digits
+		return None
+
+	return check
+
+
+def _check_date(value):
+	try:
+		datetime.strptime(value, DATE_FORMAT)
+	except ValueError:
+		return 'must be a date formatted as %s' % DATE_FORMAT
+	return None
+
+
+def _check_email(value):
+	try:
+		validate_email(value)
+	except ValidationError:
+		return 'must be a valid email address'
+	return None
+
+
+class CompiledForm(object):
+	"""
+	The checks of the RiskFields of one version of a form.
+	"""
+
+	def __init__(self, form):
+		"""
+		@param form: The form as returned by Interface.get_risk_type, i.e. the RiskType and its active RiskFields.
+		@type form: dict
+		"""
+		super(CompiledForm, self).__init__()
+		self.fields = []
+		for risk_field in form.get('risk_fields', []):
+			checks = [_check_length(risk_field.get('min_length'), risk_field.get('max_length'))]
+			field_type = risk_field.get('field_type')
+			if field_type == 'number':
+				checks.append(_check_number(risk_field.get('max_digits'), risk_field.get('decimal_places')))
+			elif field_type == 'date':
+				checks.append(_check_date)
+			elif field_type == 'email':
+				checks.append(_check_email)
+			default = risk_field.get('default_value')
+			self.fields.append((
+				str(risk_field['id']), default if default not in (None, '') else None,
+				bool(risk_field.get('nullable')), tuple(checks)))
+		self.field_ids = frozenset(field_id for field_id, _, _, _ in self.fields)
+		self.field_types = dict((str(risk_field['id']), risk_field.get('field_type')) for risk_field in form.get(
+			'risk_fields', []))
+
+	def validate(self, values):
+		"""
+		Validates the values submitted for the form.
+		@param values: The value of each RiskField, keyed by the id of the RiskField.
+		@type values: dict
+		@return: The values to store keyed by the id of their RiskField, and the error of each invalid RiskField.
+		@rtype: tuple
+		"""
+		cleaned, errors = {}, {}
+		for field_id in values:
+			if str(field_id) not in self.field_ids:
+				errors[str(field_id)] = 'is not a field of the form'
+		for field_id, default, nullable, checks in self.fields:
+			value = values.get(field_id)
+			if isinstance(value, bool) or not isinstance(value, (str, int, float, type(None))):
+				errors[field_id] = 'must be a string or a number'
+				continue
+			value = '' if value is None else str(value).strip()
+			if not value:
+				if default is not None:
+					value = default
+				elif nullable:
+					continue
+				else:
+					errors[field_id] = 'is required'
+					continue
+			for check in checks:
+				error = check(value)
+				if error is not None:
+					errors[field_id] = error
+					break
+			else:
+				cleaned[field_id] = value
+		return cleaned, errors
+
+
+class FormValidators(object):
+	"""
+	Keeps the compiled forms of this process by the digest of their form, evicting the least recently used.
+	The compiled forms hold the checks as closures, so they are kept as they are rather than pickled like the cached
+	query results.
+	"""
+
+	def __init__(self, max_entries = 512):
+		"""
+		@param max_entries: The maximum number of compiled forms kept.
+		@type max_entries: int
+		"""
+		super(FormValidators, self).__init__()
+		self.max_entries = max_entries
+		self.compiled = 0
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, form, digest):
+		"""
+		Retrieves the compiled version of a form, compiling it on its first use.
+		@param form: The form as returned by Interface.get_risk_type.
+		@type form: dict
+		@param digest: The digest of the form, which identifies its version.
+		@type digest: str
+		@rtype: CompiledForm
+		"""
+		with self._lock:
+			compiled = self._entries.get(digest)
+			if compiled is not None:
+				self._entries.move_to_end(digest)
+				return compiled
+		compiled = CompiledForm(form)
+		with self._lock:
+			self.compiled += 1
+			self._entries[digest] = compiled
+			while len(self._entries) > self.max_entries:
+				self._entries.popitem(last = False)
+		return compiled
+
+	def clear(self):
+		"""
+		Removes all the compiled forms.
+		"""
+		with self._lock:
+			self._entries.clear()
+
+
+form_validators = FormValidators()
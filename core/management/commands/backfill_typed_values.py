@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""
+Types the values of the RiskData stored before the typed columns, see core.backend.risk_query
+e.g. python manage.py backfill_typed_values --batch-size 1000
+"""
+from django.core.management.base import BaseCommand
+
+from core.backend.risk_query import backfill_typed_values
+
+
+class Command(BaseCommand):
+	help = 'Fills the typed columns of the RiskData stored untyped, so that the typed predicates match them'
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			'--batch-size', type = int, default = 500, help = 'the number of RiskData read and updated per statement')
+
+	def handle(self, *args, **options):
+		typed = backfill_typed_values(options['batch_size'])
+		self.stdout.write('Typed %s RiskData' % typed)
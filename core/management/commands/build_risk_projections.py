@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Builds, or drops, the wide tables projecting the Risks of the RiskTypes, see core.backend.projections
+e.g. python manage.py build_risk_projections "AutoMobile Cover"
+     python manage.py build_risk_projections --all
+     python manage.py build_risk_projections --drop "AutoMobile Cover"
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from base.backend.state_registry import state_registry
+from core.backend.projections import wide_tables
+from core.models import RiskProjection, RiskType
+
+
+class Command(BaseCommand):
+	help = 'Builds the wide tables projecting the Risks of the RiskTypes, one row per Risk and column per RiskField'
+
+	def add_arguments(self, parser):
+		parser.add_argument('risk_types', nargs = '*', help = 'the ids or names of the RiskTypes')
+		parser.add_argument(
+			'--all', action = 'store_true', help = 'rebuild the tables of all the RiskTypes that have one')
+		parser.add_argument('--drop', action = 'store_true', help = 'drop the tables instead of building them')
+		parser.add_argument('--batch-size', type = int, default = 1000, help = 'the number of Risks per statement')
+
+	def handle(self, *args, **options):
+		if options['all']:
+			risk_type_ids = list(RiskProjection.objects.values_list('risk_type_id', flat = True))
+		elif options['risk_types']:
+			risk_type_ids = []
+			for risk_type in options['risk_types']:
+				risk_type_id = RiskType.objects.filter(
+					Q(id = risk_type) | Q(name = risk_type)).exclude(
+					state_id__in = state_registry.ids('Deleted')).order_by('-date_created').values_list(
+					'id', flat = True).first()
+				if risk_type_id is None:
+					raise CommandError('RiskType %s does not exist' % risk_type)
+				risk_type_ids.append(risk_type_id)
+		else:
+			raise CommandError('Select the RiskTypes, or --all of the projected ones')
+
+		for risk_type_id in risk_type_ids:
+			if options['drop']:
+				dropped = wide_tables.drop(risk_type_id)
+				self.stdout.write('%s %s' % ('Dropped' if dropped else 'No table for', risk_type_id))
+			else:
+				projection = wide_tables.build(risk_type_id, options['batch_size'])
+				self.stdout.write('Built %s with %s Risks for %s' % (
+					projection.db_table, projection.rows, risk_type_id))
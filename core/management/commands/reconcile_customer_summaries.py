@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""
+Summarizes the Risks of every Customer again into their CustomerSummary, see core.backend.customer_summaries
+e.g. python manage.py reconcile_customer_summaries --batch-size 1000
+"""
+from django.core.management.base import BaseCommand
+
+from core.backend.customer_summaries import reconcile_summaries
+
+
+class Command(BaseCommand):
+	help = 'Creates the missing CustomerSummaries and fixes the ones that drifted from the Risks of their Customer'
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			'--batch-size', type = int, default = 500, help = 'the number of Customers summarized per transaction')
+
+	def handle(self, *args, **options):
+		created, updated = reconcile_summaries(options['batch_size'])
+		self.stdout.write('Created %s and updated %s CustomerSummaries' % (created, updated))
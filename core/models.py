@@ -50,6 +50,9 @@ class Customer(BaseModel):
 	email = models.CharField(max_length = 50)
 	state = models.ForeignKey(State, on_delete = models.CASCADE)
 
+	class Meta(object):
+		indexes = [models.Index(fields = ['-date_created', 'id'])]  # backs the keyset pagination of the listings
+
 	def __str__(self):
 		return '%s %s %s' % (self.salutation, self.first_name, self.last_name)
 
@@ -61,6 +64,9 @@ class RiskType(GenericBaseModel):
 	state = models.ForeignKey(State, on_delete = models.CASCADE)
 	has_form = models.BooleanField(default = False)  # indicates whether there is a form defined for this RiskType
 
+	class Meta(object):
+		indexes = [models.Index(fields = ['-date_created', 'id'])]  # backs the keyset pagination of the listings
+
 	def __str__(self):
 		return self.name
 
@@ -94,6 +100,9 @@ class Risk(BaseModel):
 	risk_type = models.ForeignKey(RiskType, on_delete = models.CASCADE)  # the RiskType they have subscribed to
 	state = models.ForeignKey(State, on_delete = models.CASCADE)
 
+	class Meta(object):
+		indexes = [models.Index(fields = ['risk_type', '-date_created', 'id'])]  # backs the pages of search_risks
+
 	def __str__(self):
 		return '%s - %s %s' % (self.risk_type.name, self.customer.first_name, self.customer.last_name)
 
@@ -106,9 +115,60 @@ class RiskData(BaseModel):
 	risk = models.ForeignKey(Risk, on_delete = models.CASCADE)
 	risk_field = models.ForeignKey(RiskField, on_delete = models.CASCADE)
 	value = models.CharField(max_length = 255)
+	# the value typed after the field_type of its RiskField, so that it can be compared in SQL through an index
+	value_number = models.DecimalField(max_digits = 30, decimal_places = 10, null = True, blank = True)
+	value_date = models.DateField(null = True, blank = True)
+	value_text = models.CharField(max_length = 255, null = True, blank = True)  # stripped and case folded
 	state = models.ForeignKey(State, on_delete = models.CASCADE)
 
+	class Meta(object):
+		indexes = [
+			models.Index(fields = ['risk_field', 'value_number']),
+			models.Index(fields = ['risk_field', 'value_date']),
+			models.Index(fields = ['risk_field', 'value_text']),
+		]
+
 	def __str__(self):
 		return '%s - %s %s - %s : %s' % (
 			self.risk.risk_type.name, self.risk.customer.first_name, self.risk.customer.last_name,
 			self.risk_field.caption, self.value)
+
+
+class CustomerSummary(BaseModel):
+	"""
+	Summarizes the Risks of a Customer, those not Deleted, so that the Customers can be listed, sorted and filtered on
+	them without aggregating the Risks of every row. Kept up to date as the Risks and RiskData are written.
+	"""
+	customer = models.OneToOneField(Customer, on_delete = models.CASCADE, related_name = 'summary')
+	risk_count = models.IntegerField(default = 0)
+	risk_type_count = models.IntegerField(default = 0)
+	risk_types = models.TextField(default = '', blank = True)  # the names of the RiskTypes held, comma separated
+	last_risk_date = models.DateTimeField(null = True, blank = True)  # when the latest Risk was taken
+	last_activity = models.DateTimeField(null = True, blank = True)  # when a Risk or one of its RiskData was written
+
+	class Meta(object):
+		indexes = [  # back the listings of the Customers sorted or filtered on the summary
+			models.Index(fields = ['risk_count']),
+			models.Index(fields = ['last_risk_date']),
+			models.Index(fields = ['last_activity']),
+		]
+
+	def __str__(self):
+		return '%s %s - %s Risks' % (self.customer.first_name, self.customer.last_name, self.risk_count)
+
+
+class RiskProjection(BaseModel):
+	"""
+	Records the wide table projecting the Risks of a RiskType, one row per Risk and one column per active RiskField.
+	The table is only read while the form it was built for, as told by its digest, is the current form of the RiskType.
+	"""
+	risk_type = models.OneToOneField(RiskType, on_delete = models.CASCADE)
+	db_table = models.CharField(max_length = 63)
+	form_digest = models.CharField(max_length = 40)
+	rows = models.IntegerField(default = 0)  # the number of Risks in the table when it was built
+	# the table being built to replace db_table and the digest of its form, written to along with db_table until then
+	next_table = models.CharField(max_length = 63, null = True, blank = True)
+	next_digest = models.CharField(max_length = 40, null = True, blank = True)
+
+	def __str__(self):
+		return '%s - %s' % (self.risk_type.name, self.db_table)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Signal receivers for the models in the core module
+"""
+import logging
+
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from core.backend.customer_summaries import refresh_summary
+from core.backend.projections import wide_tables
+from core.backend.risk_query import typed_columns
+from core.models import Customer, CustomerSummary, Risk, RiskData, RiskProjection
+
+lgr = logging.getLogger(__name__)
+
+
+@receiver(pre_save, sender = RiskData)
+def type_risk_data(sender, instance, raw = False, **kwargs):
+	"""
+	Types the value of a RiskData saved one at a time after the field_type of its RiskField.
+	"""
+	if not raw:
+		for column, value in typed_columns(instance.risk_field.field_type, instance.value).items():
+			setattr(instance, column, value)
+
+
+@receiver([post_save, post_delete], sender = RiskData)
+def project_risk_data(sender, instance, raw = False, **kwargs):
+	"""
+	Projects the Risk of a RiskData written one at a time, e.g. from the admin, again into its wide table.
+	The RiskData of a submission are bulk inserted, which Interface.submit_risk projects itself.
+	"""
+	if raw:
+		return
+	try:
+		wide_tables.refresh_risk(instance.risk_id)
+	except Exception as e:
+		lgr.exception('project_risk_data exception: %s', e)
+
+
+@receiver(post_save, sender = Risk)
+def project_risk(sender, instance, created = False, raw = False, **kwargs):
+	"""
+	Projects a Risk saved again into its wide table, e.g. removing it once it is Deleted.
+	A new Risk has no RiskData yet, its submission projecting it along with them, see Interface.submit_risk.
+	"""
+	if created or raw:
+		return
+	try:
+		wide_tables.refresh_risk(instance.id)
+	except Exception as e:
+		lgr.exception('project_risk exception: %s', e)
+
+
+@receiver(post_delete, sender = Risk)
+def unproject_risk(sender, instance, **kwargs):
+	"""
+	Removes a deleted Risk from the wide table of its RiskType.
+	"""
+	try:
+		wide_tables.remove_risk(instance.id, instance.risk_type_id)
+	except Exception as e:
+		lgr.exception('unproject_risk exception: %s', e)
+
+
+@receiver(post_delete, sender = RiskProjection)
+def drop_wide_table(sender, instance, **kwargs):
+	"""
+	Drops the wide table of a RiskProjection along with it, and the one being built if any.
+	"""
+	wide_tables.drop_table(instance.db_table)
+	wide_tables.drop_table(instance.next_table)
+
+
+@receiver(post_save, sender = Customer)
+def create_customer_summary(sender, instance, created = False, raw = False, **kwargs):
+	"""
+	Starts the summary of a new Customer, with no Risks yet.
+	"""
+	if created and not raw:
+		CustomerSummary.objects.create(customer = instance)
+
+
+@receiver([post_save, post_delete], sender = Risk)
+def summarize_risk(sender, instance, raw = False, signal = None, **kwargs):
+	"""
+	Summarizes the Risks of the Customer of a Risk written or deleted, in the transaction of the write, which fails
+	along with the summary.
+	"""
+	if not raw:
+		refresh_summary(instance.customer_id, create = signal is post_save)
+
+
+@receiver([post_save, post_delete], sender = RiskData)
+def summarize_risk_data(sender, instance, raw = False, signal = None, **kwargs):
+	"""
+	Summarizes the Risks of the Customer of a RiskData written or deleted one at a time, e.g. from the admin.
+	"""
+	if raw:
+		return
+	customer_id = Risk.objects.filter(id = instance.risk_id).values_list('customer_id', flat = True).first()
+	if customer_id is not None:
+		refresh_summary(customer_id, create = signal is post_save)
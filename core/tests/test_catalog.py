@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the catalog snapshot shared by the worker processes
+"""
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from mixer.backend.django import mixer
+
+from api.backend.interfaces import Interface
+from base.backend.invalidation_bus import invalidation_bus
+from core.backend.catalog import CATALOG_MODELS, catalog_snapshot
+
+# the snapshot is never built from inside a transaction, so these tests need to commit their writes
+pytestmark = pytest.mark.django_db(transaction = True)
+
+
+@pytest.fixture
+def snapshot_path(settings, tmpdir):
+	settings.CATALOG_SNAPSHOT = {'ENABLED': True, 'PATH': str(tmpdir.join('catalog.snapshot'))}
+	return settings.CATALOG_SNAPSHOT['PATH']
+
+
+class TestCatalogSnapshot(object):
+	"""
+	Tests for the CatalogSnapshot
+	"""
+	def test_form(self, snapshot_path):
+		"""
+		Test that the forms are served from the snapshot and that it is rebuilt once the catalog changes
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		risk_type = mixer.blend('core.RiskType', name = 'AutoMobile Cover', state = state)
+		mixer.cycle(3).blend('core.RiskField', risk_type = risk_type, state = state)
+		invalidation_bus.poll(force = True)
+
+		assert catalog_snapshot.form(str(risk_type.id)) is None, 'Should build the snapshot in the background'
+		catalog_snapshot.wait()
+		expected = Interface().get_risk_type(risk_type.id)
+		with CaptureQueriesContext(connection) as queries:
+			response = Interface().get_risk_type(risk_type.id)
+			by_name = Interface().get_risk_type('AutoMobile Cover')
+			risk_types = Interface().risk_types({})
+		assert len(queries) == 0, 'Should serve the catalog from the snapshot'
+		assert response == by_name == expected and len(response['data']['risk_fields']) == 3
+		assert risk_types['data'][0]['state__name'] == 'Active', 'Should resolve the state names in the snapshot'
+
+		mixer.blend('core.RiskField', risk_type = risk_type, state = state)
+		invalidation_bus.poll(force = True)
+		response = Interface().get_risk_type(risk_type.id)
+		assert len(response['data']['risk_fields']) == 4, 'Should read the db while the snapshot is stale'
+		catalog_snapshot.wait()
+		assert len(catalog_snapshot.form(str(risk_type.id))['risk_fields']) == 4, \
+			'Should rebuild the snapshot once a RiskField is added'
+
+	def test_stale_snapshot(self, snapshot_path):
+		"""
+		Test that a snapshot built from other generations or from another database is built again rather than served
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		risk_type = mixer.blend('core.RiskType', name = 'AutoMobile Cover', state = state)
+		invalidation_bus.poll(force = True)
+		version, instance = invalidation_bus.generations(*CATALOG_MODELS), invalidation_bus.instance()
+		for built_from in ((version, 'another database'), (tuple(v + 1 for v in version), instance)):
+			catalog_snapshot.build(*built_from)
+			assert catalog_snapshot.form('AutoMobile Cover') is None, 'Should not serve the stale snapshot'
+			catalog_snapshot.wait()
+			assert catalog_snapshot.form('AutoMobile Cover')['risk_type']['id'] == str(risk_type.id)
+			assert (catalog_snapshot._index['version'], catalog_snapshot._index['instance']) == (
+				list(version), instance), 'Should build the snapshot again from the current generations of the db'
+
+	def test_risk_types_pages(self, snapshot_path, monkeypatch):
+		"""
+		Test that the snapshot pages the RiskTypes with the same cursors as the db, decoding only the page served
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		mixer.cycle(5).blend('core.RiskType', state = state)
+		invalidation_bus.poll(force = True)
+		first = Interface().risk_types({'limit': 2})
+		catalog_snapshot.wait()
+		read, decoded = catalog_snapshot._read, []
+		monkeypatch.setattr(catalog_snapshot, '_read', lambda entry: decoded.append(entry) or read(entry))
+		with CaptureQueriesContext(connection) as queries:
+			second = Interface().risk_types({'limit': 2, 'cursor': first['next_cursor']})
+		assert len(queries) == 0, 'Should serve the page from the snapshot'
+		assert len(decoded) == 2, 'Should decode the RiskTypes of the page alone'
+		invalidation_bus._seen = None  # reads the db as in a process that has not polled yet
+		from_db = Interface().risk_types({'limit': 2, 'cursor': first['next_cursor']})
+		assert [r['id'] for r in second['data']] == [r['id'] for r in from_db['data']], 'Should match the db page'
+		assert second['next_cursor'] == from_db['next_cursor'], 'Should issue the same cursor as the db'
+
+	def test_form_digests(self, snapshot_path):
+		"""
+		Test that the snapshot lists the same form digests as the forms it serves
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		risk_type = mixer.blend('core.RiskType', name = 'AutoMobile Cover', state = state)
+		mixer.cycle(3).blend('core.RiskField', risk_type = risk_type, state = state)
+		invalidation_bus.poll(force = True)
+		listed = Interface().risk_types({})['data'][0]['form_digest']
+		assert listed == Interface().get_risk_type(risk_type.id)['digest'], 'Should list the digest of the form'
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the CustomerSummary of the Customers
+"""
+from io import StringIO
+
+import pytest
+from django.core.management import call_command
+from django.db import transaction
+from mixer.backend.django import mixer
+
+from core.backend import customer_summaries
+from core.backend.services import RiskService
+from core.models import Customer, CustomerSummary
+
+pytestmark = pytest.mark.django_db
+
+
+class TestCustomerSummaries(object):
+	"""
+	Tests for the CustomerSummary of the Customers
+	"""
+	def test_refresh(self):
+		"""
+		Test that the writes of the Risks and RiskData summarize the Risks of their Customer again
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		deleted = mixer.blend('base.State', name = 'Deleted')
+		customer = mixer.blend('core.Customer', state = state)
+		assert customer.summary.risk_count == 0, 'Should start the summary of a new Customer'
+		auto = mixer.blend('core.RiskType', name = 'AutoMobile Cover', state = state)
+		house = mixer.blend('core.RiskType', name = 'House Cover', state = state)
+		risks = [
+			mixer.blend('core.Risk', customer = customer, risk_type = risk_type, state = state)
+			for risk_type in (house, auto, auto)]
+		summary = CustomerSummary.objects.get(customer = customer)
+		assert (summary.risk_count, summary.risk_type_count, summary.risk_types) == (
+			3, 2, 'AutoMobile Cover, House Cover'), 'Should count the Risks and RiskTypes held'
+		assert summary.last_risk_date == max(risk.date_created for risk in risks), 'Should hold the latest Risk'
+
+		risk_data = mixer.blend(
+			'core.RiskData', risk = risks[0], risk_field__risk_type = house, risk_field__state = state, state = state)
+		assert CustomerSummary.objects.get(customer = customer).last_activity == risk_data.date_modified, \
+			'Should record the RiskData written'
+		RiskService().update(risks[1].id, state = deleted)
+		risks[0].delete()
+		summary = CustomerSummary.objects.get(customer = customer)
+		assert (summary.risk_count, summary.risk_types) == (1, 'AutoMobile Cover'), 'Should leave out the Risks gone'
+		customer.delete()
+		assert not CustomerSummary.objects.exists(), 'Should delete the summary along with the Customer'
+
+	def test_refresh_failure(self, monkeypatch):
+		"""
+		Test that a summary which fails rolls back the write of the Risk along with it
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		customer = mixer.blend('core.Customer', state = state)
+		risk_type = mixer.blend('core.RiskType', state = state)
+
+		def fail(customer_ids):
+			raise ValueError('summarize failed')
+
+		monkeypatch.setattr(customer_summaries, 'summarize', fail)
+		with pytest.raises(ValueError):
+			with transaction.atomic():
+				mixer.blend('core.Risk', customer = customer, risk_type = risk_type, state = state)
+		assert not customer.risk_set.exists(), 'Should roll the Risk back along with its summary'
+
+	def test_reconcile(self):
+		"""
+		Test that the command creates the missing summaries and fixes the stale ones
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		customers = mixer.cycle(3).blend('core.Customer', state = state)
+		mixer.cycle(2).blend('core.Risk', customer = customers[0], state = state, risk_type__state = state)
+		CustomerSummary.objects.filter(customer = customers[1]).delete()
+		CustomerSummary.objects.filter(customer = customers[0]).update(risk_count = 9)
+		out = StringIO()
+		call_command('reconcile_customer_summaries', '--batch-size', '2', stdout = out)
+		assert out.getvalue().strip() == 'Created 1 and updated 1 CustomerSummaries', 'Should report what it fixed'
+		counts = dict(Customer.objects.values_list('id', 'summary__risk_count'))
+		assert [counts[str(customer.id)] for customer in customers] == [2, 0, 0], 'Should summarize every Customer'
+		call_command('reconcile_customer_summaries', stdout = out)
+		assert out.getvalue().strip().endswith('Created 0 and updated 0 CustomerSummaries'), \
+			'Should leave the summaries that are current alone'
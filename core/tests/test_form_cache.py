@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the cached and ETag validated RiskType forms
+"""
+import json
+
+import pytest
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from mixer.backend.django import mixer
+
+from api.backend.interfaces import Interface
+from api.views import GetRiskType
+from base.backend.invalidation_bus import InvalidationBus
+from base.backend.query_cache import DjangoCacheBackend, LocMemLRUBackend, query_cache
+from core.models import RiskField
+
+# the forms are never cached from inside a transaction, so these tests need to commit their writes
+pytestmark = pytest.mark.django_db(transaction = True)
+
+
+@pytest.fixture
+def no_snapshot(settings):
+	settings.CATALOG_SNAPSHOT = {'ENABLED': False}
+
+
+class TestFormCache(object):
+	"""
+	Tests for the FormCache
+	"""
+	def test_get_risk_type(self, no_snapshot):
+		"""
+		Test that a form is served from the cache until its RiskFields change
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		risk_type = mixer.blend('core.RiskType', name = 'AutoMobile Cover', state = state)
+		mixer.cycle(3).blend('core.RiskField', risk_type = risk_type, state = state)
+		first = Interface().get_risk_type(risk_type.id)
+		with CaptureQueriesContext(connection) as queries:
+			second = Interface().get_risk_type(risk_type.id)
+		assert len(queries) == 0, 'Should serve the form from the cache'
+		assert first == second and first['digest'], 'Should return the same form and digest'
+
+		mixer.blend('core.RiskField', risk_type = risk_type, state = state)
+		third = Interface().get_risk_type(risk_type.id)
+		assert len(third['data']['risk_fields']) == 4, 'Should miss the cache once a RiskField is added'
+		assert third['digest'] != first['digest'], 'Should change the digest with the fields'
+
+	@pytest.mark.parametrize('backend', [LocMemLRUBackend, DjangoCacheBackend])
+	def test_other_process_write(self, no_snapshot, settings, monkeypatch, backend):
+		"""
+		Test that a form written to by another process is served again once the InvalidationBus is polled
+		"""
+		settings.INVALIDATION_BUS = dict(settings.INVALIDATION_BUS, POLL_INTERVAL = 0)
+		monkeypatch.setattr(query_cache, '_backend', backend())
+		state = mixer.blend('base.State', name = 'Active')
+		risk_type = mixer.blend('core.RiskType', name = 'AutoMobile Cover', state = state)
+		risk_field = mixer.blend('core.RiskField', risk_type = risk_type, caption = 'Old', state = state)
+		first = Interface().get_risk_type(risk_type.id)
+		assert Interface().get_risk_type(risk_type.id) == first, 'Should serve the form from the cache'
+
+		# a queryset update neither signals nor invalidates, as if another process had written and published it
+		RiskField.objects.filter(id = risk_field.id).update(caption = 'New')
+		InvalidationBus().publish(RiskField)
+		second = Interface().get_risk_type(risk_type.id)
+		assert second['data']['risk_fields'][0]['caption'] == 'New', 'Should read the form written by the other process'
+		assert second['digest'] != first['digest'], 'Should change the digest with the form'
+
+	def test_not_modified(self, no_snapshot):
+		"""
+		Test that the endpoint answers a current If-None-Match with a 304
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		risk_type = mixer.blend('core.RiskType', name = 'AutoMobile Cover', state = state)
+		mixer.cycle(2).blend('core.RiskField', risk_type = risk_type, state = state)
+		response = GetRiskType().get(RequestFactory().get('api/get_risk_type/', {'id': risk_type.id}))
+		etag = response['ETag']
+		assert json.loads(response.content)['status'] == 'success' and etag, 'Should tag the form with an ETag'
+		with CaptureQueriesContext(connection) as queries:
+			response = GetRiskType().get(RequestFactory().get(
+				'api/get_risk_type/', {'id': risk_type.id}, HTTP_IF_NONE_MATCH = etag))
+		assert response.status_code == 304 and len(queries) == 0, 'Should answer 304 without touching the db'
+		response = GetRiskType().get(RequestFactory().get(
+			'api/get_risk_type/', {'id': risk_type.id}, HTTP_IF_NONE_MATCH = '"stale"'))
+		assert response.status_code == 200 and response['ETag'] == etag, 'Should resend a stale form'
+
+	def test_form_schema_urls(self, no_snapshot, client):
+		"""
+		Test that the listed digest addresses an immutable form url, and that stale digests are redirected
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		risk_type = mixer.blend('core.RiskType', name = 'AutoMobile Cover', state = state)
+		mixer.cycle(2).blend('core.RiskField', risk_type = risk_type, state = state)
+		digest = Interface().risk_types({})['data'][0]['form_digest']
+		assert digest == Interface().get_risk_type(risk_type.id)['digest'], 'Should list the digest of the form'
+
+		response = client.get('/api/forms/%s/%s.json' % (risk_type.id, digest))
+		assert response.status_code == 200 and 'immutable' in response['Cache-Control'], 'Should be cacheable forever'
+		assert len(json.loads(response.content)['data']['risk_fields']) == 2, 'Should return the form'
+		response = client.get('/api/forms/%s/%s.json' % (risk_type.id, '0' * 40))
+		assert response.status_code == 302 and digest in response['Location'], 'Should redirect to the current form'
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the wide tables projecting the Risks of the RiskTypes
+"""
+import json
+from io import StringIO
+
+import pytest
+from django.core.management import call_command
+from django.db import connection
+from mixer.backend.django import mixer
+
+from api.backend.interfaces import Interface
+from core.backend.projections import WideTables, wide_tables
+from core.backend.services import RiskService
+from core.models import RiskData, RiskProjection
+
+# the wide tables are created with the schema editor, which sqlite cannot run within the transaction of a test
+pytestmark = pytest.mark.django_db(transaction = True)
+
+
+@pytest.fixture
+def automobile(settings):
+	"""
+	An AutoMobile Cover RiskType with a Year and a Make RiskField and a Risk for 2012, 2016 and 2019
+	"""
+	settings.CATALOG_SNAPSHOT = {'ENABLED': False}
+	state = mixer.blend('base.State', name = 'Active')
+	customer = mixer.blend('core.Customer', state = state)
+	risk_type = mixer.blend('core.RiskType', name = 'AutoMobile Cover', state = state)
+	year = mixer.blend(
+		'core.RiskField', risk_type = risk_type, caption = 'Year', field_type = 'number', order = 1, min_length = 0,
+		max_length = 4, max_digits = 4, decimal_places = 0, nullable = False, default_value = None, state = state)
+	make = mixer.blend(
+		'core.RiskField', risk_type = risk_type, caption = 'Make', field_type = 'text', order = 2, min_length = 0,
+		max_length = 50, nullable = True, default_value = None, state = state)
+	for value in ('2012', '2016', '2019'):
+		Interface().submit_risk(str(customer.id), str(risk_type.id), {str(year.id): value, str(make.id): 'Audi A4'})
+	return {'state': state, 'customer': customer, 'risk_type': risk_type, 'year': year, 'make': make}
+
+
+def table_exists(db_table):
+	"""
+	Checks whether a wide table exists in the test database
+	"""
+	return db_table in connection.introspection.table_names()
+
+
+class TestProjections(object):
+	"""
+	Tests for the wide tables of the RiskTypes
+	"""
+	def test_build(self, automobile):
+		"""
+		Test that the Risks are listed off the wide table the same as off the RiskData
+		"""
+		where = [{'field': 'Year', 'op': 'gt', 'value': 2015}, {'field': 'make', 'op': 'startswith', 'value': 'audi'}]
+		expected = Interface().search_risks('AutoMobile Cover', where)
+		call_command('build_risk_projections', 'AutoMobile Cover', stdout = StringIO())
+		projection = RiskProjection.objects.get(risk_type = automobile['risk_type'])
+		assert projection.rows == 3 and table_exists(projection.db_table), 'Should build the wide table'
+		response = Interface().search_risks('AutoMobile Cover', where)
+		assert response == expected and len(response['data']) == 2, 'Should list the same Risks off the wide table'
+
+		call_command('build_risk_projections', '--all', stdout = StringIO())
+		rebuilt = RiskProjection.objects.get(risk_type = automobile['risk_type'])
+		assert rebuilt.db_table != projection.db_table and not table_exists(projection.db_table), \
+			'Should swap in the rebuilt table and drop the previous one'
+		call_command('build_risk_projections', '--drop', 'AutoMobile Cover', stdout = StringIO())
+		assert not RiskProjection.objects.exists() and not table_exists(rebuilt.db_table), 'Should drop the table'
+
+	def test_incremental(self, automobile):
+		"""
+		Test that the wide table follows the writes of the Risks and RiskData
+		"""
+		projection = wide_tables.build(automobile['risk_type'].id)
+		year = str(automobile['year'].id)
+		response = Interface().submit_risk(
+			str(automobile['customer'].id), 'AutoMobile Cover', {year: '2020', str(automobile['make'].id): 'Mazda'})
+		form = Interface().get_risk_type('AutoMobile Cover')
+		model = wide_tables.current(form['data'], form['digest'])
+		assert model.objects.count() == 4, 'Should project the submitted Risk'
+
+		risk_data = RiskData.objects.get(risk_id = response['data']['id'], risk_field_id = year)
+		risk_data.value = '2021'
+		risk_data.save()
+		found = Interface().search_risks('AutoMobile Cover', [{'field': 'Year', 'value': 2021}])['data']
+		assert [risk['id'] for risk in found] == [str(response['data']['id'])], 'Should project the edited RiskData'
+		risk_data.risk.delete()
+		assert model.objects.count() == 3, 'Should remove the deleted Risk'
+
+		mixer.blend('core.RiskField', risk_type = automobile['risk_type'], state = automobile['state'])
+		form = Interface().get_risk_type('AutoMobile Cover')
+		assert wide_tables.current(form['data'], form['digest']) is None, \
+			'Should stop reading the table once the form changes'
+		assert table_exists(projection.db_table), 'Should keep the table until it is rebuilt'
+
+	def test_deleted(self, automobile):
+		"""
+		Test that the wide table leaves out the Deleted Risks and RiskData, as the listings off the RiskData do
+		"""
+		deleted = mixer.blend('base.State', name = 'Deleted')
+		year, make = str(automobile['year'].id), str(automobile['make'].id)
+		RiskService().update(RiskData.objects.get(risk_field_id = year, value = '2012').risk_id, state = deleted)
+		RiskData.objects.filter(risk__riskdata__value = '2016', risk_field_id = make).update(state = deleted)
+		where = [{'field': 'Make', 'value': 'audi a4'}]
+		expected = Interface().search_risks('AutoMobile Cover')
+		assert Interface().search_risks('AutoMobile Cover', where)['data'] == [
+			risk for risk in expected['data'] if make in risk['values']], 'Should not match the Deleted RiskData'
+		wide_tables.build(automobile['risk_type'].id)
+		assert Interface().search_risks('AutoMobile Cover') == expected, 'Should build the table without them'
+		assert len(Interface().search_risks('AutoMobile Cover', where)['data']) == 1, \
+			'Should not match the Deleted RiskData off the table'
+
+		RiskService().update(RiskData.objects.get(risk_field_id = year, value = '2019').risk_id, state = deleted)
+		found = Interface().search_risks('AutoMobile Cover')['data']
+		assert [risk['values'] for risk in found] == [{year: '2016'}], 'Should remove the Risk once it is Deleted'
+
+	def test_concurrent_writes(self, automobile, monkeypatch):
+		"""
+		Test that the writes made while a table is built end up in it, and that a failed build leaves no trace
+		"""
+		year, make = str(automobile['year'].id), str(automobile['make'].id)
+		where = [{'field': 'Year', 'op': 'gte', 'value': 2000}]
+		fill = WideTables._fill
+
+		def fill_then_write(tables, model, form, batch_size):
+			fill(tables, model, form, batch_size)
+			assert RiskProjection.objects.get().next_table == model._meta.db_table, 'Should record the table built'
+			Interface().submit_risk(str(automobile['customer'].id), 'AutoMobile Cover', {year: '2020', make: 'Mazda'})
+			RiskData.objects.filter(risk_field_id = year, value = '2016').first().risk.delete()
+			risk_data = RiskData.objects.get(risk_field_id = year, value = '2012')
+			risk_data.value = '2013'
+			risk_data.save()
+
+		monkeypatch.setattr(WideTables, '_fill', fill_then_write)
+		projection = wide_tables.build(automobile['risk_type'].id)
+		assert projection.rows == 3 and projection.next_table is None, 'Should swap in the table'
+		found = Interface().search_risks('AutoMobile Cover', where)['data']
+		assert sorted(risk['values'][year] for risk in found) == ['2013', '2019', '2020'], \
+			'Should project the Risks submitted, deleted and edited while the table was filled'
+
+		def fail(tables, model, form, batch_size):
+			raise ValueError('connection lost')
+
+		monkeypatch.setattr(WideTables, '_fill', fail)
+		tables = connection.introspection.table_names()
+		with pytest.raises(ValueError):
+			wide_tables.build(automobile['risk_type'].id)
+		assert RiskProjection.objects.get().next_table is None, 'Should stop writing to the table of the failed build'
+		assert connection.introspection.table_names() == tables, \
+			'Should drop the table of the failed build and keep the previous one'
+		RiskProjection.objects.all().delete()
+		with pytest.raises(ValueError):
+			wide_tables.build(automobile['risk_type'].id)
+		assert not RiskProjection.objects.exists(), 'Should not leave a RiskProjection without a table behind'
+
+	def test_export(self, automobile, client):
+		"""
+		Test that the export streams the same rows off the wide table as off the RiskData
+		"""
+		def export():
+			where = json.dumps([{'field': 'Year', 'op': 'gte', 'value': 2016}])
+			response = client.get('/api/export_risks/', {'risk_type_id': 'AutoMobile Cover', 'where': where})
+			return json.loads(b''.join(response.streaming_content))
+
+		expected = export()
+		assert expected['status'] == 'success', 'Should export the Risks'
+		assert expected['data']['columns'] == ['id', 'customer_id', 'date_created', 'Year', 'Make'], \
+			'Should export a column per RiskField'
+		assert sorted(row[3] for row in expected['data']['rows']) == ['2016', '2019'], 'Should filter the Risks'
+		wide_tables.build(automobile['risk_type'].id)
+		assert export() == expected, 'Should export the same rows off the wide table'
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the typed RiskData values and their queries
+"""
+from datetime import date
+from decimal import Decimal
+from io import StringIO
+
+import pytest
+from django.core.management import call_command
+from mixer.backend.django import mixer
+
+from core.backend.risk_query import backfill_typed_values, compile_predicate, filter_risks, form_fields, typed_columns
+from core.models import RiskData
+
+pytestmark = pytest.mark.django_db
+
+
+def form_of(risk_type, *risk_fields):
+	"""
+	Builds the form of a RiskType the way Interface.get_risk_type returns it
+	"""
+	return {
+		'risk_type': {'id': risk_type.id, 'name': risk_type.name},
+		'risk_fields': [
+			{'id': field.id, 'caption': field.caption, 'field_type': field.field_type} for field in risk_fields]}
+
+
+class TestRiskQuery(object):
+	"""
+	Tests for the typing of the RiskData values and the compiled predicates
+	"""
+	def test_typed_columns(self):
+		"""
+		Test that a value fills the typed column of its field_type
+		"""
+		assert typed_columns('number', '2015') == {
+			'value_number': Decimal('2015'), 'value_date': None, 'value_text': None}, 'Should type the numbers'
+		assert typed_columns('date', '2019-01-12')['value_date'] == date(2019, 1, 12), 'Should type the dates'
+		assert typed_columns('email', ' Jane@Example.com ')['value_text'] == 'jane@example.com', \
+			'Should normalize the text'
+		assert typed_columns('text', 'Straße ' * 40)['value_text'] == ('strasse ' * 40)[:255], \
+			'Should cut the text lengthened by case folding to the size of value_text'
+		assert typed_columns('number', 'many') == dict.fromkeys(('value_number', 'value_date', 'value_text')), \
+			'Should leave the values that cannot be typed as text only'
+
+	def test_compile_predicate(self):
+		"""
+		Test that the predicates compile into lookups on the typed columns
+		"""
+		fields = form_fields({'risk_fields': [
+			{'id': 'y', 'caption': 'Year', 'field_type': 'number'},
+			{'id': 'a', 'caption': 'Make', 'field_type': 'text'},
+			{'id': 'b', 'caption': 'make', 'field_type': 'text'}]})
+		assert compile_predicate(fields, {'field': 'year', 'op': 'range', 'value': [2015, '2019']}) == {
+			'risk_field_id': 'y', 'value_number__range': [Decimal(2015), Decimal(2019)]}, \
+			'Should resolve the caption and type the values'
+		for predicate in (
+				{'field': 'Make', 'value': 'Audi'}, {'field': 'Year', 'op': 'startswith', 'value': '20'},
+				{'field': 'Year', 'op': 'gt', 'value': 'recent'}, {'field': 'Year', 'op': 'in', 'value': 2015}):
+			with pytest.raises(ValueError):
+				compile_predicate(fields, predicate)
+
+	def test_filter_risks(self):
+		"""
+		Test that the Risks are filtered on all the predicates
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		risk_type = mixer.blend('core.RiskType', state = state)
+		year = mixer.blend(
+			'core.RiskField', risk_type = risk_type, caption = 'Year', field_type = 'number', state = state)
+		make = mixer.blend(
+			'core.RiskField', risk_type = risk_type, caption = 'Make', field_type = 'text', state = state)
+		risks = mixer.cycle(3).blend('core.Risk', risk_type = risk_type, state = state)
+		for risk, (value_year, value_make) in zip(risks, (('2014', 'Audi'), ('2016', 'AUDI'), ('2018', 'Mazda'))):
+			for field, value in ((year, value_year), (make, value_make)):
+				mixer.blend('core.RiskData', risk = risk, risk_field = field, value = value, state = state)
+		form = form_of(risk_type, year, make)
+		matched = filter_risks(
+			form, [{'field': 'Year', 'op': 'gt', 'value': 2015}, {'field': 'Make', 'value': 'audi'}])
+		assert [str(risk.id) for risk in matched] == [str(risks[1].id)], \
+			'Should match the Risks satisfying all the predicates'
+		assert filter_risks(form, []).count() == 3, 'Should list all the Risks of the RiskType without predicates'
+
+		deleted = mixer.blend('base.State', name = 'Deleted')
+		RiskData.objects.filter(risk = risks[2], risk_field = make).update(state = deleted)
+		assert not filter_risks(form, [{'field': 'Make', 'value': 'mazda'}]).exists(), \
+			'Should not match the Deleted RiskData'
+		risks[1].state = deleted
+		risks[1].save()
+		assert [str(risk.id) for risk in filter_risks(form, []).order_by('date_created')] == [
+			str(risks[0].id), str(risks[2].id)], 'Should leave out the Deleted Risks'
+
+	def test_backfill_typed_values(self):
+		"""
+		Test that the RiskData stored untyped get their typed values
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		field = mixer.blend('core.RiskField', field_type = 'date', state = state)
+		mixer.cycle(3).blend('core.RiskData', risk_field = field, value = '2019-01-12', state = state)
+		RiskData.objects.update(value_number = None, value_date = None, value_text = None)  # as stored before typing
+		assert backfill_typed_values(batch_size = 2) == 3, 'Should type every untyped RiskData'
+		assert set(RiskData.objects.values_list('value_date', flat = True)) == {date(2019, 1, 12)}, \
+			'Should store the typed values'
+		assert backfill_typed_values() == 0, 'Should leave the typed RiskData alone'
+		RiskData.objects.update(value_number = None, value_date = None, value_text = None)
+		out = StringIO()
+		call_command('backfill_typed_values', '--batch-size', '2', stdout = out)
+		assert out.getvalue().strip() == 'Typed 3 RiskData', 'Should type them through the command'
@@ -3,6 +3,8 @@
 Tests for the model services in the base module
 """
 import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from mixer.backend.django import mixer
 
 from core.backend.services import CustomerService, RiskFieldService, RiskService, RiskDataService, RiskTypeService
@@ -78,6 +80,23 @@ class TestCustomerService(object):
 		customer = CustomerService().update(obj, first_name = 'Kevin')
 		assert customer is None, 'Should fail since obj is not a valid uuid for the Customer object'
 
+	def test_bulk_upsert(self):
+		"""
+		Test for the CustomerService bulk_upsert(rows, unique_field, batch_size) method
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		obj = mixer.blend('core.Customer', first_name = 'Kevin', phone_number = '111222333', state = state)
+		row = {
+			'last_name': 'Macharia', 'salutation': 'Mr', 'gender': 'Male', 'date_of_birth': '1993-04-08',
+			'email': 'kelvinmacharia078@gmail.com', 'state': state}
+		ids, errors = CustomerService().bulk_upsert([
+			dict(row, first_name = 'John', phone_number = '111222333'),
+			dict(row, first_name = 'Jane', phone_number = '444555666')], 'phone_number')
+		assert not errors, 'Should upsert all the rows'
+		assert ids[0] == str(obj.id), 'Should update the existing Customer matching the phone number'
+		assert CustomerService().get(id = obj.id).first_name == 'John', 'Should persist the new first_name'
+		assert CustomerService().get(phone_number = '444555666').id == ids[1], 'Should create the new Customer'
+
 
 class TestRiskTypeService(object):
 	"""
@@ -138,6 +157,29 @@ class TestRiskTypeService(object):
 		risk_type = RiskTypeService().update(obj, name = 'Deleted')
 		assert risk_type is None, 'Should fail because obj is not a valid uuid'
 
+	def test_update_columns(self, monkeypatch):
+		"""
+		Test for the RiskTypeService update_columns(pk, expected_modified, **kwargs) method
+		"""
+		state = mixer.blend('base.State', name = 'Active')
+		obj = mixer.blend('core.RiskType', name = 'House Cover', state = state)
+		with CaptureQueriesContext(connection) as queries:
+			risk_type = RiskTypeService().update_columns(obj.id, obj.date_modified, has_form = True)
+		assert len(queries) == 1, 'Should update the RiskType in a single statement'
+		assert risk_type.has_form and risk_type.name == 'House Cover', 'Should return the updated row'
+		assert risk_type.date_modified > obj.date_modified, 'Should bump the date_modified'
+
+		risk_type = RiskTypeService().update_columns(obj.id, obj.date_modified, name = 'AutoMobile Cover')
+		assert risk_type is False, 'Should report a conflict since the RiskType changed after it was read'
+		assert RiskTypeService().get(id = obj.id).name == 'House Cover', 'Should not overwrite the newer row'
+
+		risk_type = RiskTypeService().update_columns('missing', name = 'AutoMobile Cover')
+		assert risk_type is None, 'Should return None since there is no RiskType with that id'
+
+		monkeypatch.setattr(RiskTypeService, '_supports_returning', staticmethod(lambda connection: False))
+		risk_type = RiskTypeService().update_columns(obj.id, name = 'AutoMobile Cover', state = state)
+		assert risk_type.name == 'AutoMobile Cover', 'Should read the updated row back without RETURNING'
+
 
 class TestRiskFieldService(object):
 	"""
@@ -362,3 +404,33 @@ class TestRiskDataService(object):
 
 		risk_data = RiskDataService().update(obj, value = 'KZQ001Y')
 		assert risk_data is None, 'Should return None since provided pk is invalid'
+
+	def test_profiles(self):
+		"""
+		Test for the RiskDataService get and filter methods with a projection profile
+		"""
+		class LabelledRiskDataService(RiskDataService):
+			profiles = {
+				'label': {
+					'select_related': ('risk__customer', 'risk__risk_type', 'risk_field'),
+					'only': (
+						'id', 'value', 'risk__customer__first_name', 'risk__customer__last_name',
+						'risk__risk_type__name', 'risk_field__caption')},
+			}
+
+		state = mixer.blend('base.State', name = 'Active')
+		customer = mixer.blend('core.Customer', first_name = 'Kevin', last_name = 'Macharia', state = state)
+		risk_type = mixer.blend('core.RiskType', name = 'AutoMobile Cover', state = state)
+		risk_field = mixer.blend(
+			'core.RiskField', risk_type = risk_type, field_type = 'text', caption = 'Registration Number', state = state)
+		risk = mixer.blend('core.Risk', customer = customer, risk_type = risk_type, state = state)
+		obj = mixer.blend('core.RiskData', risk_field = risk_field, risk = risk, value = 'KZQ 001Y', state = state)
+
+		with CaptureQueriesContext(connection) as queries:
+			risk_data = LabelledRiskDataService().get(id = obj.id, profile = 'label')
+			label = str(risk_data)
+		assert len(queries) == 1, 'Should load the RiskData and everything its label needs in one query'
+		assert label == 'AutoMobile Cover - Kevin Macharia - Registration Number : KZQ 001Y'
+
+		risk_data = LabelledRiskDataService().get(id = obj.id, profile = 'missing')
+		assert risk_data is None, 'Should return None since the profile is not declared'
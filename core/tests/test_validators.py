@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the compiled form validators
+"""
+from core.backend.validators import CompiledForm, FormValidators
+
+FORM = {'risk_type': {'name': 'AutoMobile Cover', 'id': 'rt'}, 'risk_fields': [
+	{'id': 'plate', 'field_type': 'text', 'min_length': 3, 'max_length': 10, 'nullable': False, 'default_value': None},
+	{'id': 'value', 'field_type': 'number', 'max_digits': 6, 'decimal_places': 2, 'nullable': False},
+	{'id': 'bought', 'field_type': 'date', 'nullable': True},
+	{'id': 'email', 'field_type': 'email', 'nullable': False, 'default_value': 'none@example.com'},
+]}
+
+
+class TestValidators(object):
+	"""
+	Tests for the compiled form validators
+	"""
+	def test_validate(self):
+		"""
+		Test that the values are checked against the constraints of their RiskField
+		"""
+		form = CompiledForm(FORM)
+		cleaned, errors = form.validate({'plate': 'KZB 302Y', 'value': 1500.5, 'bought': ''})
+		assert errors == {}, 'Should accept valid values'
+		assert cleaned == {'plate': 'KZB 302Y', 'value': '1500.5', 'email': 'none@example.com'}, \
+			'Should skip the empty nullable fields and fill in the defaults'
+		cleaned, errors = form.validate({
+			'plate': 'KZ', 'value': '12345.6', 'bought': '12/01/2019', 'email': 'nobody', 'colour': 'red'})
+		assert errors == {
+			'plate': 'must be at least 3 characters', 'value': 'must have at most 6 digits',
+			'bought': 'must be a date formatted as %Y-%m-%d', 'email': 'must be a valid email address',
+			'colour': 'is not a field of the form'}, 'Should report the error of each field'
+		assert form.validate({'plate': 'KZB 302Y', 'value': '1.234'})[1] == {
+			'value': 'must have at most 2 decimal places'}, 'Should check the decimal places'
+		assert form.validate({'plate': 'KZB 302Y'})[1] == {'value': 'is required'}, 'Should require the fields'
+
+	def test_compiled_once(self):
+		"""
+		Test that a form is compiled once per digest
+		"""
+		validators = FormValidators(max_entries = 2)
+		compiled = validators.get(FORM, 'a')
+		assert validators.get(FORM, 'a') is compiled and validators.compiled == 1, 'Should reuse the compiled form'
+		validators.get(FORM, 'b')
+		validators.get(FORM, 'c')
+		assert validators.get(FORM, 'a') is not compiled, 'Should evict the least recently used forms'